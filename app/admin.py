@@ -1,6 +1,8 @@
 from django.contrib import admin
 
-from .models import Contract
+from .models import Contract, ExportJob, RequestProfile
 
 # Register your models here.
 admin.site.register(Contract)
+admin.site.register(ExportJob)
+admin.site.register(RequestProfile)
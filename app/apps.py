@@ -2,4 +2,8 @@ from django.apps import AppConfig
 
 
 class WebappConfig(AppConfig):
-    name = 'webapp'
+    name = 'app'
+
+    def ready(self):
+        from route.core.reference import connect_reference_signals
+        connect_reference_signals()
@@ -0,0 +1,90 @@
+'''
+Async (ASGI) variants of the proxy api requests
+'''
+import json
+
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from route.core.constants import (DOCUMENT_DETAIL_URL, DOCUMENTS_LISTING_URL,
+                                  HTTP_API_ERROR, HTTP_BAD_REQUEST,
+                                  HTTP_SERVICE_UNAVAILABLE)
+from route.core.helper import async_request_mixin, get_cached_access_scope
+from route.core.upstream import async_upstream_client
+
+from .listing import MergedPage
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncAPIView(View):
+    '''
+    Base view for the async proxy api's, the request body is parsed as json.
+    Session and ORM access must be wrapped in sync_to_async.
+    '''
+    def get_data(self, request):
+        if not request.body:
+            return {}
+        try:
+            return json.loads(request.body)
+        except ValueError:
+            return request.POST.dict()
+
+
+class AsyncDocumentDetails(AsyncAPIView):
+    async def post(self, request):
+        return await async_request_mixin(request, DOCUMENT_DETAIL_URL, self.get_data(request))
+
+
+class AsyncDocumentsListing(AsyncAPIView):
+    async def post(self, request):
+        data = self.get_data(request)
+        data.update(await sync_to_async(get_cached_access_scope)(request.session))
+        if settings.IS_NOTIFICATION_REQUIRED is not True:
+            return await async_request_mixin(request, DOCUMENTS_LISTING_URL, data)
+
+        try:
+            page = await sync_to_async(MergedPage)(request)
+        except (KeyError, ValueError):
+            return JsonResponse({"message": "Invalid page or cursor"}, status=HTTP_BAD_REQUEST)
+
+        query_params = '?aggregator=AND&indexname=%s&%s' % (settings.ELASTIC_SEARCH_INDEX_KEY, page.upstream_query_string)
+        try:
+            response = await async_upstream_client.post(DOCUMENTS_LISTING_URL + query_params, content=json.dumps(data))
+        except requests.exceptions.RequestException:
+            return JsonResponse({"message": "Connection failed to the services"}, status=HTTP_SERVICE_UNAVAILABLE)
+
+        if response.status_code == status.HTTP_200_OK:
+            return JsonResponse(page.response_data(data["columns"], response.json()), status=response.status_code)
+        return JsonResponse({"message": "Something went wrong !!!"}, status=HTTP_API_ERROR)
+
+
+class AsyncDocumentTree(AsyncAPIView):
+    async def post(self, request):
+        return await async_request_mixin(request, DOCUMENTS_LISTING_URL, self.get_data(request), settings.DOCUMENT_TREE_INDEX_KEY, "OR")
+
+
+class AsyncAccessControlledList(AsyncAPIView):
+    '''
+    Listing proxied with the user access scope (PaymentTermsList, QualityKpisList, DocumentPrice)
+    '''
+    async def post(self, request):
+        data = self.get_data(request)
+        data.update(await sync_to_async(get_cached_access_scope)(request.session))
+        return await async_request_mixin(request, DOCUMENTS_LISTING_URL, data)
+
+
+class AsyncPaymentTermsList(AsyncAccessControlledList):
+    pass
+
+
+class AsyncQualityKpisList(AsyncAccessControlledList):
+    pass
+
+
+class AsyncDocumentPrice(AsyncAccessControlledList):
+    pass
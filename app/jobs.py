@@ -0,0 +1,93 @@
+'''
+Background export jobs (local worker pool, no external queue)
+'''
+import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from rest_framework import status
+from route.core.constants import (DOCUMENT_DETAIL_URL, DOCUMENTS_LISTING_URL,
+                                  EXPORT_FORMAT_CSV, EXPORT_FORMAT_PARQUET,
+                                  EXPORT_FORMAT_XLSX,
+                                  PAYMENT_TERMS_EXPORT_COLUMNS)
+from route.core.exporters import write_export
+from route.core.helper import get_documents_exported_data, upstream_request
+from route.core.storage import s3_storage
+
+from .models import ExportJob
+
+EXPORT_FILE_EXTENSIONS = {
+    EXPORT_FORMAT_XLSX: ".xlsx",
+    EXPORT_FORMAT_CSV: ".csv",
+    EXPORT_FORMAT_PARQUET: ".parquet",
+}
+
+export_executor = ThreadPoolExecutor(max_workers=settings.EXPORT_JOB_WORKERS, thread_name_prefix="export-job")
+
+
+def get_export_url(job, data):
+    if job.export_type == ExportJob.PAYMENT_TERMS or 'contains_quality_kpi' in data:
+        return DOCUMENT_DETAIL_URL
+    return DOCUMENTS_LISTING_URL
+
+
+def update_job(job, **fields):
+    for key, value in fields.items():
+        setattr(job, key, value)
+    job.save(update_fields=list(fields.keys()) + ['updated'])
+
+
+def run_export_job(job_id):
+    '''
+    Fetch the records, render the export and store it on s3 (S3_BUCKET_EXPORTS_PATH)
+    '''
+    close_old_connections()
+    job = ExportJob.objects.get(id=job_id)
+    try:
+        update_job(job, status=ExportJob.RUNNING, progress=10)
+        data = json.loads(job.request_data)
+        export_payment_terms = job.export_type == ExportJob.PAYMENT_TERMS
+        if export_payment_terms:
+            data["columns"] = PAYMENT_TERMS_EXPORT_COLUMNS
+
+        records = upstream_request("POST", get_export_url(job, data), job.query_string, data)
+        if records.status_code != status.HTTP_200_OK:
+            raise ValueError("Records request failed with status %s" % records.status_code)
+        update_job(job, progress=40)
+
+        records, new_columns, column_size, sheetname = get_documents_exported_data(records.data["data"], data, export_payment_terms)
+        with tempfile.TemporaryFile(dir=settings.EXPORT_TMP_DIR) as output:
+            row_count = write_export(output, job.export_format, records, new_columns, column_size, sheetname)
+            update_job(job, progress=80)
+
+            file_name = sheetname + EXPORT_FILE_EXTENSIONS[job.export_format]
+            file_path = settings.S3_BUCKET_EXPORTS_PATH.format("%s/%s" % (job.job_id, file_name))
+            s3_storage.upload(output, file_path, acl="private")
+
+        update_job(job, status=ExportJob.SUCCESS, progress=100, file_name=file_name, file_path=file_path, row_count=row_count)
+    except Exception as e:
+        update_job(job, status=ExportJob.FAILED, error=str(e))
+    finally:
+        close_old_connections()
+
+
+def fail_stale_job(job):
+    '''
+    Mark a queued/running job FAILED when it has not moved for EXPORT_JOB_STALE_SECONDS:
+    the local worker pool does not survive a restart, such a job will never finish
+    '''
+    stale_before = timezone.now() - timezone.timedelta(seconds=settings.EXPORT_JOB_STALE_SECONDS)
+    if job.status in (ExportJob.QUEUED, ExportJob.RUNNING) and job.updated < stale_before:
+        update_job(job, status=ExportJob.FAILED, error="Export job interrupted")
+    return job
+
+
+def submit_export_job(job):
+    '''
+    Queue the job on the local worker pool once the job row is committed
+    '''
+    transaction.on_commit(lambda: export_executor.submit(run_export_job, job.id))
+    return job
@@ -0,0 +1,116 @@
+'''
+Documents listing pagination: pending uploads (local) merged in front of the upstream results
+'''
+import base64
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Contract
+
+
+def pending_uploads(since):
+    '''
+    Uploaded contracts not yet known by the upstream, newest first (covered by the (status, updated) index)
+    '''
+    return Contract.objects.filter(status=Contract.UPLOADED, updated__gte=since).order_by('-updated', '-id')
+
+
+def encode_cursor(cursor):
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(value):
+    '''
+    Raise ValueError on a malformed cursor
+    '''
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(value.encode('ascii')))
+        since = parse_datetime(cursor["since"])
+        updated = parse_datetime(cursor["updated"]) if cursor["updated"] else None
+        offset = int(cursor["offset"])
+        pending_done = bool(cursor["pending_done"])
+        last_id = int(cursor["id"]) if cursor["id"] is not None else None
+    except (TypeError, KeyError, UnicodeError, json.JSONDecodeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+    if since is None or offset < 0:
+        raise ValueError("Invalid cursor")
+    return since, updated, last_id, pending_done, offset
+
+
+class MergedPage:
+    '''
+    One page of the merged listing (pending uploads first, then upstream results).
+    Page size is to - from. A page is addressed either by the from/to offsets or by the `cursor`
+    returned with the previous page (keyset on (updated, id) for pending rows + upstream offset).
+    The upstream is asked even for a page of pending rows only (from=X&to=X, a cached search):
+    its totalRecords and other metadata are part of every page.
+    '''
+    def __init__(self, request):
+        params = request.GET.copy()
+        page_from = int(params.get("from", 0))
+        page_to = int(params["to"])
+        self.size = page_to - page_from
+        if page_from < 0 or self.size < 0:
+            raise ValueError("Invalid page")
+
+        cursor = params.pop("cursor", None)
+        if cursor:
+            self.since, updated, last_id, pending_done, self.upstream_from = decode_cursor(cursor[-1])
+            self.pending = []
+            if not pending_done:
+                rows = pending_uploads(self.since)
+                if updated is not None:
+                    rows = rows.filter(Q(updated__lt=updated) | Q(updated=updated, id__lt=last_id))
+                self.pending = list(rows[:self.size])
+            self.pending_done = pending_done or len(self.pending) < self.size
+        else:
+            self.since = timezone.now() - timezone.timedelta(minutes=settings.PENDING_UPLOAD_WINDOW_MINUTES)
+            rows = pending_uploads(self.since)
+            pending_count = rows.count()
+            self.pending = list(rows[page_from:page_to]) if page_from < pending_count else []
+            self.upstream_from = max(0, page_from - pending_count)
+            self.pending_done = page_to >= pending_count
+
+        self.upstream_size = self.size - len(self.pending)
+        params["from"] = self.upstream_from
+        params["to"] = self.upstream_from + self.upstream_size
+        self.upstream_query_string = params.urlencode()
+
+    def records(self, columns, upstream_records):
+        '''
+        Merged page rows, pending uploads shaped like upstream records
+        '''
+        empty = dict.fromkeys(columns, '')
+        records = [dict(empty, status=contract.status, filename=contract.document_file_name,
+                        origin=contract.imported_by, import_datetime=contract.updated) for contract in self.pending]
+        records.extend(upstream_records)
+        return records
+
+    def next_cursor(self, upstream_count):
+        '''
+        Cursor of the following page, None once both sources are exhausted
+        '''
+        if self.pending_done and upstream_count < self.upstream_size:
+            return None
+        last = self.pending[-1] if self.pending else None
+        return encode_cursor({
+            "since": self.since.isoformat(),
+            "updated": last.updated.isoformat() if last else None,
+            "id": last.id if last else None,
+            "pending_done": self.pending_done,
+            "offset": self.upstream_from + upstream_count,
+        })
+
+    def response_data(self, columns, upstream_data):
+        '''
+        Listing response: the upstream answer with the merged rows and the cursor of the following page
+        '''
+        data = dict(upstream_data)
+        upstream_records = data.get("data", [])[:self.upstream_size]
+        data["data"] = self.records(columns, upstream_records)
+        data["next_cursor"] = self.next_cursor(len(upstream_records))
+        return data
@@ -1,17 +1,22 @@
+import logging
+
 from django.utils.deprecation import MiddlewareMixin
 from django.http import JsonResponse, HttpResponseRedirect, HttpResponse
 from django.conf import settings
-from .utils import *
+from .utils import request_logger
 
 class ApplicationMiddlewares(MiddlewareMixin):
     def __init__(self,get_response):
         self.get_response = get_response
         
     def __call__(self,request):
-        cprint("Application Authorization Values")
-        cprint(request.session["X-KC-Token"])
-        cprint(request.session["preferred_username"])
-        cprint(request.session["roles"])
-        cprint(request.session["groups"])
+        if request_logger.isEnabledFor(logging.INFO):
+            request_logger.info("Application Authorization Values", extra={"data": {
+                "path": request.path,
+                "method": request.method,
+                "username": request.session["preferred_username"],
+                "roles": request.session["roles"],
+                "groups": request.session["groups"],
+            }})
         
-        return self.get_response(request)
\ No newline at end of file
+        return self.get_response(request)
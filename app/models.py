@@ -1,4 +1,7 @@
+import uuid
+
 from django.db import models
+from django.db.models.functions import Upper
 from route.core.helper import TimestampModel
 
 
@@ -20,9 +23,90 @@ class Contract(TimestampModel):
     document_file_name = models.CharField(max_length=500)
     document_path = models.CharField(max_length=500)
     request_id = models.CharField(max_length=100)
-    contractId = models.CharField(max_length=100, null=True, blank=True)
+    contractId = models.CharField(max_length=100, null=True, blank=True, unique=True)
     status = models.SmallIntegerField(choices=DOCUMENT_STATUS, default=UPLOADED)
     imported_by = models.CharField(max_length=100)
 
+    class Meta:
+        indexes = [
+            # pending uploads merged in the documents listing
+            models.Index(fields=['status', 'updated'], name='contract_status_updated_idx'),
+            # case insensitive lookups by document name
+            models.Index(Upper('document_file_name'), name='contract_upper_file_name_idx'),
+        ]
+
     def __str__(self):
         return self.document_file_name
+
+
+class ExportJob(TimestampModel):
+    QUEUED = 1
+    RUNNING = 2
+    SUCCESS = 3
+    FAILED = 4
+
+    JOB_STATUS = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCESS, 'Success'),
+        (FAILED, 'Failed')
+    )
+
+    DOCUMENTS = 'documents'
+    PAYMENT_TERMS = 'payment_terms'
+
+    EXPORT_TYPE = (
+        (DOCUMENTS, 'Documents'),
+        (PAYMENT_TERMS, 'Payment Terms')
+    )
+
+    job_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    export_type = models.CharField(max_length=20, choices=EXPORT_TYPE, default=DOCUMENTS)
+    export_format = models.CharField(max_length=10)
+    request_data = models.TextField()
+    query_string = models.CharField(max_length=1000, blank=True)
+    status = models.SmallIntegerField(choices=JOB_STATUS, default=QUEUED)
+    progress = models.SmallIntegerField(default=0)
+    file_name = models.CharField(max_length=500, blank=True)
+    file_path = models.CharField(max_length=500, blank=True)
+    row_count = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    requested_by = models.CharField(max_length=100)
+
+    def __str__(self):
+        return str(self.job_id)
+
+
+class RequestProfile(TimestampModel):
+    HEADER = 'header'
+    SAMPLE = 'sample'
+
+    TRIGGER = (
+        (HEADER, 'Header'),
+        (SAMPLE, 'Sample')
+    )
+
+    profile_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=1000)
+    view_name = models.CharField(max_length=200, blank=True)
+    status_code = models.SmallIntegerField()
+    duration_ms = models.FloatField()
+    trigger = models.CharField(max_length=10, choices=TRIGGER)
+    file_path = models.CharField(max_length=500)
+    requested_by = models.CharField(max_length=100, blank=True)
+
+    def __str__(self):
+        return str(self.profile_id)
+
+
+class VersionStamp(models.Model):
+    '''
+    Named version counter shared by every worker through the database
+    (reference data version, response cache generation)
+    '''
+    name = models.CharField(max_length=100, unique=True)
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return "%s:%s" % (self.name, self.version)
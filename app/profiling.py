@@ -0,0 +1,131 @@
+'''
+On demand request profiling (cProfile), stored on s3 as pstats files
+'''
+import cProfile
+import logging
+import marshal
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.crypto import constant_time_compare
+from route.core.identity import get_identity
+from route.core.storage import s3_storage
+
+from .models import RequestProfile
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "HTTP_X_PROFILE"
+
+profile_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="request-profile")
+
+# one profiler at a time per process: since python 3.12 enabling a second one raises ValueError
+profile_lock = threading.Lock()
+
+
+def get_profile_trigger(request):
+    '''
+    RequestProfile.HEADER when the X-Profile header carries PROFILING_TOKEN,
+    RequestProfile.SAMPLE for PROFILING_SAMPLE_RATE of the requests, None otherwise
+    '''
+    token = request.META.get(PROFILE_HEADER)
+    if token and settings.PROFILING_TOKEN and constant_time_compare(token, settings.PROFILING_TOKEN):
+        return RequestProfile.HEADER
+    if settings.PROFILING_SAMPLE_RATE > 0 and random.random() < settings.PROFILING_SAMPLE_RATE:
+        return RequestProfile.SAMPLE
+    return None
+
+
+def store_profile(profile_id, stats, metadata):
+    '''
+    Upload the pstats file (readable with pstats.Stats / snakeviz) and record its metadata
+    '''
+    try:
+        file_path = settings.S3_BUCKET_PROFILES_PATH.format("%s.prof" % profile_id)
+        s3_storage.upload(marshal.dumps(stats), file_path, acl="private")
+        RequestProfile.objects.create(profile_id=profile_id, file_path=file_path, **metadata)
+    finally:
+        close_old_connections()
+
+
+def log_store_failure(future):
+    if future.exception() is not None:
+        logger.error("Request profile could not be stored", exc_info=future.exception())
+
+
+class ProfilingMiddleware:
+    '''
+    Profile the rest of the chain and the view of triggered requests (opt-in with PROFILING_ENABLED),
+    the profile id is returned in the X-Profile-Id header. Requests triggered while another one
+    is being profiled are served unprofiled.
+    Under ASGI only the event loop thread is profiled: sync views run in a worker thread and
+    show up as the await, other requests' coroutines running meanwhile are included
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        trigger = get_profile_trigger(request) if settings.PROFILING_ENABLED else None
+        if trigger is None or not profile_lock.acquire(blocking=False):
+            return self.get_response(request)
+
+        try:
+            profiler = cProfile.Profile()
+            started = time.perf_counter()
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+        finally:
+            profile_lock.release()
+        return self.record(request, response, trigger, profiler, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        trigger = get_profile_trigger(request) if settings.PROFILING_ENABLED else None
+        if trigger is None or not profile_lock.acquire(blocking=False):
+            return await self.get_response(request)
+
+        try:
+            profiler = cProfile.Profile()
+            started = time.perf_counter()
+            profiler.enable()
+            try:
+                response = await self.get_response(request)
+            finally:
+                profiler.disable()
+        finally:
+            profile_lock.release()
+        # the session is loaded from the database
+        await sync_to_async(get_identity)(request)
+        return self.record(request, response, trigger, profiler, time.perf_counter() - started)
+
+    def record(self, request, response, trigger, profiler, duration):
+        profiler.create_stats()
+        profile_id = uuid.uuid4()
+        match = request.resolver_match
+        future = profile_executor.submit(store_profile, profile_id, profiler.stats, {
+            "method": request.method,
+            "path": request.path[:1000],
+            "view_name": match.view_name if match else '',
+            "status_code": response.status_code,
+            "duration_ms": round(duration * 1000, 3),
+            "trigger": trigger,
+            "requested_by": get_identity(request).username or '',
+        })
+        future.add_done_callback(log_store_failure)
+        response["X-Profile-Id"] = str(profile_id)
+        return response
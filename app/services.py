@@ -0,0 +1,46 @@
+'''
+Contract status transitions, applied to a whole batch in a fixed number of queries
+'''
+from django.db import transaction
+from django.db.models import Value
+from django.db.models.functions import Upper
+
+from .models import Contract
+
+
+def contracts_by_filenames(filenames):
+    '''
+    Contracts matching any of the filenames case insensitively (uses the upper(document_file_name) index).
+    Both sides are upper cased by the database, like iexact (python and sql upper differ on some unicode)
+    '''
+    return Contract.objects.alias(upper_file_name=Upper('document_file_name')).filter(
+        upper_file_name__in=[Upper(Value(filename)) for filename in set(filenames)])
+
+
+def mark_contracts_success(contract_ids):
+    '''
+    One UPDATE for the whole batch, return the number of contracts updated
+    '''
+    if not contract_ids:
+        return 0
+    return Contract.objects.filter(contractId__in=contract_ids).update(status=Contract.SUCCESS)
+
+
+@transaction.atomic
+def delete_failed_contracts(contract_ids):
+    '''
+    Delete the failed contracts and every contract of the same documents (one SELECT, one DELETE).
+    Return the document filenames
+    '''
+    if not contract_ids:
+        return []
+    filenames = list(Contract.objects.filter(contractId__in=contract_ids).values_list('document_file_name', flat=True))
+    if filenames:
+        contracts_by_filenames(filenames).delete()
+    return filenames
+
+
+def delete_contracts_by_filenames(filenames):
+    if not filenames:
+        return 0
+    return contracts_by_filenames(filenames).delete()[0]
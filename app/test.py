@@ -1,9 +1,59 @@
+import asyncio
+import datetime
+import importlib
+import io
 import json
+import logging
+import marshal
+import os
+import queue
+import tempfile
+import threading
+import time
+import uuid
+from unittest import mock
 
+import httpx
+import openpyxl
+import pandas as pd
+import requests
+import xlsxwriter
+from asgiref.sync import iscoroutinefunction
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.module_loading import import_string
 from rest_framework import status
+from rest_framework.response import Response
 from rest_framework.test import APITestCase
+from route.core.cache import ResponseCache
+from route.core.constants import NO_RECORD_FOUND, ROLES_ADMIN, ROLES_IMPORT
+from route.core.exporters import stream_xlsx_export, write_parquet, write_xlsx
+from route.core.helper import (documents_export_result, get_admin_header_row, get_cached_access_scope,
+                               quality_kpis_export_result, upload_admin_document)
+from route.core.identity import RequestIdentity, get_identity, get_required_roles
+from route.core.logs import AsyncFileHandler, JsonFormatter
+from route.core.metrics import get_payload_size
+from route.core.middleware import QueryCountMiddleware
+from route.core.reference import bulk_upsert_supplier_groups, reference_index
+from route.core.removal import remove_documents
+from route.core.storage import S3Storage
+from route.core.tracing import TracingMiddleware, span
+from route.core.upstream import (AsyncUpstreamClient, CircuitBreaker, SingleFlight, UpstreamClient,
+                                 UpstreamUnavailable, breakers)
+from route.core.versions import SharedVersion
+from uam.models import SupplierGroup
 
-from .models import Contract
+from . import async_views, jobs, profiling, views
+from .listing import MergedPage
+from .models import Contract, ExportJob, RequestProfile
+from .services import contracts_by_filenames, delete_failed_contracts
 
 
 class DocumetsTestCase(APITestCase):
@@ -58,4 +108,1014 @@ class DocumetsTestCase(APITestCase):
         response = self.client.post('/orch/api/payment-terms/?from=0&to=5', data)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(json.loads(response.content)["totalRecords"], 1)
\ No newline at end of file
+        self.assertEqual(json.loads(response.content)["totalRecords"], 1)
+
+
+def make_export_record():
+    nested = {"target": "1", "liquidated_damages_min": "2", "liquidated_damages_max": "3"}
+    return {"filename": "contract.pdf", "import_datetime": "2021-01-31T10:20:30.123",
+            "zero_defect": nested, "paru": nested, "seqi": nested, "sar": nested, "stilt": nested,
+            "liquidated_damages_main_percent": {"liquidated_damages_percent": "5", "liquidated_damages_percent_min": "1",
+                                                "liquidated_damages_percent_max": "9"},
+            "liquidated_damages_main_raw": {"liquidated_damages_raw": "5", "liquidated_damages_raw_min": "1",
+                                            "liquidated_damages_raw_max": "9"},
+            "payment_terms": [{"payment_term_days": "-1"}, {"payment_term_days": "60"}],
+            "actual_kpi": [{"project": "-1", "actual_zd": "1", "actual_sar": "2", "actual_paru": "3"}]}
+
+
+class ExportResultTestCase(SimpleTestCase):
+    def test_documents_export_result(self):
+        records, new_columns, _, _ = documents_export_result([make_export_record()])
+        record = records.iloc[0]
+        self.assertEqual(record["import_datetime"], "31-01-2021 10:20:30")
+        self.assertEqual(record["zero_defect_liquidated_damages_max"], "3")
+        self.assertEqual(record["payment_term_days_1"], "Not Found")
+        self.assertEqual(record["payment_term_days_2"], "60")
+        self.assertIn("payment_term_days_2", new_columns)
+
+    def test_quality_kpis_export_result(self):
+        records, new_columns, _, _ = quality_kpis_export_result([make_export_record()])
+        record = records.iloc[0]
+        self.assertEqual(record["actual_kpis_project_1"], "Not Found")
+        self.assertEqual(record["actual_kpis_actual_paru_1"], "3")
+        self.assertEqual(new_columns["actual_kpis_actual_zd_1"], "Actual ZD _1")
+
+    def test_empty_export_result(self):
+        for export_result in [documents_export_result, quality_kpis_export_result]:
+            records, new_columns, _, _ = export_result([])
+            self.assertIsInstance(records, pd.DataFrame)
+            self.assertEqual(list(records.columns), list(new_columns))
+            self.assertEqual(len(records), 0)
+
+
+class ExportDocumentsTestCase(APITestCase):
+    def test_documents_export_csv(self):
+        records = Response({"data": [make_export_record()]}, status=200)
+        with mock.patch.object(views, "request_mixin", return_value=records):
+            response = self.client.post('/orch/api/export-documents/?from=0&to=5', {"format": "csv"}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b"".join(response.streaming_content).decode("utf-8").splitlines()
+        self.assertTrue(lines[0].startswith("Filename,Origin,Import Date,Document Number"))
+        self.assertTrue(lines[1].startswith("contract.pdf,,31-01-2021 10:20:30,"))
+        self.assertEqual(len(lines), 2)
+
+    def test_documents_export_unsupported_format(self):
+        with mock.patch.object(views, "request_mixin") as request_mixin:
+            response = self.client.post('/orch/api/export-documents/?from=0&to=5', {"format": "pdf"}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        request_mixin.assert_not_called()
+
+    def test_multipart_export(self):
+        with mock.patch.object(views, "request_mixin", return_value=Response({"data": []}, status=200)) as request_mixin:
+            response = self.client.post('/orch/api/export-documents/?from=0&to=5', {"format": "csv", "search": "contract"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        data = request_mixin.call_args[0][2]
+        self.assertNotIn("format", data)
+        self.assertEqual(data["search"], "contract")
+
+    def test_unsupported_format_is_rejected_before_upstream(self):
+        with mock.patch.object(views, "request_mixin") as request_mixin:
+            response = self.client.post('/orch/api/export-payment-terms/', {"format": "pdf"})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        request_mixin.assert_not_called()
+
+
+class ExportJobTestCase(APITestCase):
+    def test_export_job_submit(self):
+        records = Response({"data": [make_export_record()]}, status=200)
+        with mock.patch.object(jobs, "upstream_request", return_value=records) as upstream_request, \
+                mock.patch.object(jobs, "s3_storage") as s3_storage, \
+                mock.patch.object(jobs, "close_old_connections"), \
+                mock.patch.object(jobs.export_executor, "submit", side_effect=lambda func, *args: func(*args)), \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/orch/api/export-jobs/?from=0&to=5', {"format": "csv", "search": "contract"})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        job = ExportJob.objects.get(job_id=json.loads(response.content)["job_id"])
+        self.assertEqual(job.status, ExportJob.SUCCESS)
+        self.assertEqual(job.row_count, 1)
+        self.assertEqual(json.loads(job.request_data), {"search": "contract"})
+        self.assertEqual(upstream_request.call_args[0][2], "from=0&to=5")
+        self.assertEqual(s3_storage.upload.call_args[0][1], job.file_path)
+
+        response = self.client.post('/orch/api/export-job/', {"job_id": str(job.job_id)}, format='json')
+        self.assertEqual(json.loads(response.content)["status"], "Success")
+
+    def test_export_job_download_not_ready(self):
+        job = ExportJob.objects.create(export_format="csv", request_data="{}", requested_by='')
+        response = self.client.post('/orch/api/export-job-download/', {"job_id": str(job.job_id)}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        response = self.client.post('/orch/api/export-job-download/', {"job_id": "not-a-job"}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_export_job_status_not_found(self):
+        for data in [{}, {"job_id": "not-a-job"}, {"job_id": str(uuid.uuid4())}]:
+            response = self.client.post('/orch/api/export-job/', data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_stale_job_is_failed(self):
+        job = ExportJob.objects.create(export_format="csv", request_data="{}", requested_by='', status=ExportJob.RUNNING)
+        ExportJob.objects.filter(id=job.id).update(updated=job.updated - datetime.timedelta(hours=2))
+
+        response = self.client.post('/orch/api/export-job/', {"job_id": str(job.job_id)}, format='json')
+        self.assertEqual(json.loads(response.content)["status"], "Failed")
+        response = self.client.post('/orch/api/export-job-download/', {"job_id": str(job.job_id)}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        fresh = ExportJob.objects.create(export_format="csv", request_data="{}", requested_by='', status=ExportJob.RUNNING)
+        response = self.client.post('/orch/api/export-job/', {"job_id": str(fresh.job_id)}, format='json')
+        self.assertEqual(json.loads(response.content)["status"], "Running")
+
+
+class XlsxExportTestCase(SimpleTestCase):
+    columns = {"filename": "File Name", "start_date": "Start Date", "countries": "Countries"}
+
+    def read_rows(self, content):
+        workbook = openpyxl.load_workbook(io.BytesIO(content), read_only=True)
+        return [list(row) for row in workbook["Documents"].iter_rows(values_only=True)]
+
+    def test_write_xlsx_round_trip(self):
+        records = pd.DataFrame([{"filename": "a.pdf", "start_date": datetime.datetime(2021, 1, 31, 10, 30), "countries": ["FR", "DE"]},
+                                {"filename": "b.pdf", "start_date": float("nan"), "countries": None}])
+        output = io.BytesIO()
+        with mock.patch("xlsxwriter.Workbook", wraps=xlsxwriter.Workbook) as workbook:
+            row_count = write_xlsx(output, records, self.columns, [30, 20], "Documents")
+
+        self.assertEqual(row_count, 2)
+        self.assertTrue(workbook.call_args[0][1]["constant_memory"])
+        self.assertEqual(self.read_rows(output.getvalue()), [["File Name", "Start Date", "Countries"],
+                                                              ["a.pdf", datetime.datetime(2021, 1, 31, 10, 30), "['FR', 'DE']"],
+                                                              ["b.pdf", None, None]])
+
+    def test_stream_xlsx_export(self):
+        records = [{"filename": "a.pdf", "start_date": datetime.date(2021, 1, 31), "countries": "FR"}]
+        response = stream_xlsx_export(records, self.columns, [], "Documents")
+
+        self.assertEqual(response["Content-Disposition"], "attachment; filename=Documents.xlsx")
+        self.assertEqual(self.read_rows(b"".join(response.streaming_content)),
+                         [["File Name", "Start Date", "Countries"], ["a.pdf", datetime.datetime(2021, 1, 31), "FR"]])
+        response.close()
+
+
+class ParquetExportTestCase(SimpleTestCase):
+    def test_write_parquet_typed_schema(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        columns = {"filename": "Filename", "import_datetime": "Import Date", "start_date": "Start Date",
+                   "payment_term_days_1": "Payment Terms In Days - 1", "liquidated_damages_percent": "LD Percent"}
+        records = pd.DataFrame([{"filename": "a.pdf", "import_datetime": "31-01-2021 10:20:30", "start_date": "2021-01-01",
+                                 "payment_term_days_1": "60", "liquidated_damages_percent": 0.5},
+                                {"filename": "b.pdf", "import_datetime": "2021-02-01T08:00:00.000", "start_date": "",
+                                 "payment_term_days_1": "Not Found", "liquidated_damages_percent": float("nan")}])
+        output = io.BytesIO()
+        with self.settings(EXPORT_PARQUET_ROW_GROUP_SIZE=1):
+            row_count = write_parquet(output, records, columns)
+
+        table = pq.read_table(io.BytesIO(output.getvalue()))
+        self.assertEqual(row_count, 2)
+        self.assertEqual(table.schema.types, [pa.string(), pa.timestamp('us'), pa.date32(), pa.int64(), pa.float64()])
+        self.assertEqual(table.to_pylist(), [
+            {"Filename": "a.pdf", "Import Date": datetime.datetime(2021, 1, 31, 10, 20, 30),
+             "Start Date": datetime.date(2021, 1, 1), "Payment Terms In Days - 1": 60, "LD Percent": 0.5},
+            {"Filename": "b.pdf", "Import Date": datetime.datetime(2021, 2, 1, 8),
+             "Start Date": None, "Payment Terms In Days - 1": None, "LD Percent": None},
+        ])
+
+
+class SupplierGroupUploadTestCase(TestCase):
+    def test_bulk_upsert_supplier_groups(self):
+        SupplierGroup.objects.create(supplier_group="9074967", supplier_group_name="NEXWAVE")
+        SupplierGroup.objects.create(supplier_group="9088277", supplier_group_name="GURSAS")
+
+        counts = bulk_upsert_supplier_groups([("9074967", "NEXWAVE"), ("9088277", "TITAN 4"), ("9011705", "NOKIA")])
+        self.assertEqual(counts, {"inserted": 1, "updated": 1, "unchanged": 1})
+        self.assertEqual(SupplierGroup.objects.get(supplier_group="9088277").supplier_group_name, "TITAN 4")
+        self.assertTrue(SupplierGroup.objects.filter(supplier_group="9011705").exists())
+
+
+class DocumentsUploadTestCase(APITestCase):
+    def setUp(self):
+        session = self.client.session
+        session["preferred_username"] = "importer"
+        session["roles"] = ["ROLE_IMPORT"]
+        session.save()
+
+    def upload(self, failing):
+        def upload_image(image_obj, request_id):
+            if image_obj.name in failing:
+                raise ClientError({"Error": {"Code": "SlowDown"}}, "PutObject")
+            return "local/%s" % image_obj.name
+
+        files = [SimpleUploadedFile(name, b"%PDF") for name in ["a.pdf", "b.pdf", "c.pdf"]]
+        with mock.patch("route.core.helper.upload_image", side_effect=upload_image), \
+                mock.patch("route.core.storage.logger"), \
+                mock.patch.object(views, "request_mixin", return_value=Response({"message": "ok"})) as request_mixin:
+            response = self.client.post('/orch/api/document-upload/', {"myfile": files})
+        return response, request_mixin
+
+    def test_partial_failure_saves_uploaded_files_only(self):
+        Contract.objects.create(document_file_name="a.pdf", document_path="local/old-a.pdf", request_id="old",
+                                contractId="old-a", status=Contract.FAILED, imported_by="someone")
+        response, request_mixin = self.upload(failing={"b.pdf"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([failed["filename"] for failed in response.data["failed_files"]], ["b.pdf"])
+        request_data = request_mixin.call_args[0][2]
+        self.assertEqual([val["actual_name"] for val in request_data["files"]], ["a.pdf", "c.pdf"])
+
+        contracts = {contract.document_file_name: contract for contract in Contract.objects.all()}
+        self.assertEqual(sorted(contracts), ["a.pdf", "c.pdf"])
+        self.assertEqual(contracts["a.pdf"].document_path, "local/a.pdf")
+        self.assertEqual(contracts["a.pdf"].contractId, request_data["files"][0]["contractId"])
+        for contract in contracts.values():
+            self.assertEqual(contract.status, Contract.UPLOADED)
+            self.assertEqual(contract.imported_by, "importer")
+            self.assertEqual(contract.request_id, request_data["requestId"])
+
+    def test_all_uploads_failed(self):
+        response, request_mixin = self.upload(failing={"a.pdf", "b.pdf", "c.pdf"})
+
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(len(response.data["failed_files"]), 3)
+        request_mixin.assert_not_called()
+        self.assertFalse(Contract.objects.exists())
+
+
+class AdminUploadTestCase(APITestCase):
+    def make_workbook(self, rows, title="Sheet1"):
+        workbook = openpyxl.Workbook()
+        workbook.active.title = title
+        for row in rows:
+            workbook.active.append(row)
+        content = io.BytesIO()
+        workbook.save(content)
+        return SimpleUploadedFile("report.xlsx", content.getvalue())
+
+    def upload(self, document_type, document):
+        with mock.patch.object(views, "upload_admin_document") as upload_admin_document:
+            response = self.client.post('/orch/api/admin-upload/', {"document_type": document_type, "document": document})
+        return response, upload_admin_document
+
+    def test_tpd_report_is_stored_header_first(self):
+        document = self.make_workbook([["TPD monthly report"], [], ["Supplier text", "PT_days"],
+                                       ["NEXWAVE", 60], ["GURSAS", 30], ["GURSAS", 30]])
+        response, upload_admin_document = self.upload("tpd_monthly_report", document)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        stored = pd.read_excel(io.BytesIO(upload_admin_document.call_args[0][0]))
+        self.assertEqual(stored.values.tolist(), [["NEXWAVE", 60]])
+        self.assertEqual(list(stored.columns), ["Supplier text", "PT_days"])
+
+    def test_reports_are_deduplicated(self):
+        rows = [["EnterpriseID", "Project", "KPI Value"], [1, "A", 0.5], [2, "B", 0.7], [2, "B", 0.7]]
+        for document_type in ["spe_zero_defect_report", "spe_paru_monthly_report", "spe_sar_monthly_report"]:
+            response, upload_admin_document = self.upload(document_type, self.make_workbook(rows))
+            stored = pd.read_excel(io.BytesIO(upload_admin_document.call_args[0][0]))
+            self.assertEqual(stored.values.tolist(), [[1, "A", 0.5]])
+
+    def test_upload_without_duplicates_is_forwarded(self):
+        document = self.make_workbook([["EnterpriseID", "Project", "KPI Value"], [1, "A", 0.5], [1, "A", 0.7]], title="ZD")
+        with mock.patch.object(views.pd, "ExcelFile") as excel_file:
+            response, upload_admin_document = self.upload("spe_zero_defect_report", document)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        excel_file.assert_not_called()
+        self.assertNotIsInstance(upload_admin_document.call_args[0][0], bytes)
+
+    def test_missing_columns_rejected_from_header(self):
+        document = self.make_workbook([["EnterpriseID", "Project"], [1, "A"]])
+        with mock.patch.object(views.pd, "ExcelFile") as excel_file:
+            response, upload_admin_document = self.upload("spe_zero_defect_report", document)
+        self.assertEqual(response.status_code, NO_RECORD_FOUND)
+        excel_file.assert_not_called()
+        upload_admin_document.assert_not_called()
+
+    def test_header_row_of_report_variants(self):
+        self.assertEqual(get_admin_header_row("tpd_monthly_report"), 3)
+        self.assertEqual(get_admin_header_row("tpd_monthly_report_v2"), 3)
+        self.assertEqual(get_admin_header_row("spe_sar_monthly_report"), 1)
+
+    def test_unreadable_file(self):
+        response, upload_admin_document = self.upload("spe_sar_monthly_report", SimpleUploadedFile("report.xls", b"not excel"))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        upload_admin_document.assert_not_called()
+
+
+class ReferenceDataTestCase(TestCase):
+    def setUp(self):
+        # version stamps restart with every test transaction, drop the index loaded by a previous test
+        reference_index.version = None
+        cache.clear()
+
+    @override_settings(SHARED_VERSION_CHECK_INTERVAL=0)
+    def test_version_bump_reaches_every_worker(self):
+        self.assertEqual(reference_index.supplier_group_names(["9074967"]), [])
+        SupplierGroup.objects.create(supplier_group="9074967", supplier_group_name="NEXWAVE")
+
+        # bumped by another worker (own in-process copy of the stamp)
+        SharedVersion("reference_data").bump()
+        self.assertEqual(reference_index.supplier_group_names(["9074967"]), ["NEXWAVE"])
+
+    @override_settings(SHARED_VERSION_CHECK_INTERVAL=0)
+    def test_access_scope_invalidated_on_reference_bump(self):
+        session = {"regionCountry": [], "supplyGroup": "9074967"}
+        self.assertEqual(get_cached_access_scope(session)["access_supplier"], [])
+        SupplierGroup.objects.create(supplier_group="9074967", supplier_group_name="NEXWAVE")
+
+        with mock.patch("route.core.helper.get_access_scope") as get_access_scope:
+            self.assertEqual(get_cached_access_scope(session)["access_supplier"], [])
+        get_access_scope.assert_not_called()
+
+        SharedVersion("reference_data").bump()
+        self.assertEqual(get_cached_access_scope(session)["access_supplier"], ["NEXWAVE"])
+        self.assertEqual(get_cached_access_scope(dict(session, supplyGroup="All"))["access_supplier"], ["*"])
+
+    @override_settings(SHARED_VERSION_CHECK_INTERVAL=0)
+    def test_supplier_group_with_several_rows(self):
+        SupplierGroup.objects.create(supplier_group="9088277", supplier_group_name="GURSAS")
+        SupplierGroup.objects.create(supplier_group="9074967", supplier_group_name="NEXWAVE")
+        SupplierGroup.objects.create(supplier_group="9088277", supplier_group_name="TITAN 4")
+        SharedVersion("reference_data").bump()
+
+        names = reference_index.supplier_group_names(["9088277", "9074967", "9088277"])
+        self.assertEqual(names, list(SupplierGroup.objects.filter(supplier_group__in=["9088277", "9074967"])
+                                     .order_by('id').values_list('supplier_group_name', flat=True)))
+
+
+class ResponseCacheTestCase(TestCase):
+    @override_settings(SHARED_VERSION_CHECK_INTERVAL=0)
+    def test_invalidation_reaches_every_worker(self):
+        worker_1, worker_2 = ResponseCache(), ResponseCache()
+        key = worker_2.make_key('/dkm/v2/search', {"columns": ["filename"]}, "from=0&to=5")
+        worker_2.get_or_fetch(key, lambda: (200, {"data": []}))
+
+        worker_1.invalidate()
+        self.assertNotEqual(worker_2.make_key('/dkm/v2/search', {"columns": ["filename"]}, "from=0&to=5"), key)
+
+
+class CircuitBreakerTestCase(SimpleTestCase):
+    def test_state_changes(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        with mock.patch("route.core.upstream.time.monotonic", return_value=100):
+            breaker.record_failure()
+            self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+            breaker.record_success()
+            breaker.record_failure()
+            self.assertTrue(breaker.allow_request())
+            breaker.record_failure()
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+            self.assertFalse(breaker.allow_request())
+
+        with mock.patch("route.core.upstream.time.monotonic", return_value=130):
+            self.assertTrue(breaker.allow_request())
+            self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+            self.assertFalse(breaker.allow_request())
+            breaker.record_failure()
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        with mock.patch("route.core.upstream.time.monotonic", return_value=160):
+            self.assertTrue(breaker.allow_request())
+            breaker.record_success()
+            self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+            self.assertEqual(breaker.failures, 0)
+
+    @override_settings(UPSTREAM_BREAKER_FAILURE_THRESHOLD=2)
+    def test_client_stops_calling_open_upstream(self):
+        client = UpstreamClient()
+        session, _ = client.get_session("http://es:5000")
+        with mock.patch.dict(breakers, clear=True), \
+                mock.patch.object(session, "request", side_effect=[make_upstream_response(503, "{}"),
+                                                                   requests.exceptions.ConnectTimeout()]) as request:
+            self.assertEqual(client.get("http://es:5000/dkm/search").status_code, 503)
+            with self.assertRaises(requests.exceptions.ConnectTimeout):
+                client.get("http://es:5000/dkm/search")
+            with self.assertRaises(UpstreamUnavailable):
+                client.get("http://es:5000/dkm/search")
+            self.assertEqual(request.call_count, 2)
+            self.assertEqual(breakers["http://es:5000"].state, CircuitBreaker.OPEN)
+
+
+@override_settings(UPSTREAM_POOL_MAXSIZE=1, UPSTREAM_POOL_TIMEOUT=0.05)
+class UpstreamClientTestCase(SimpleTestCase):
+    def test_full_pool_fails_fast(self):
+        client = UpstreamClient()
+        session, _ = client.get_session("http://es:5000")
+        started = threading.Event()
+        release = threading.Event()
+
+        def request(method, url, **kwargs):
+            started.set()
+            release.wait(5)
+            return make_upstream_response(200, json.dumps({"data": []}))
+
+        with mock.patch.object(session, "request", side_effect=request) as session_request:
+            thread = threading.Thread(target=client.get, args=("http://es:5000/dkm/search",))
+            thread.start()
+            self.assertTrue(started.wait(5))
+            try:
+                with self.assertRaises(UpstreamUnavailable):
+                    client.get("http://es:5000/dkm/search")
+            finally:
+                release.set()
+                thread.join()
+            self.assertEqual(session_request.call_count, 1)
+
+            client.get("http://es:5000/dkm/search")
+            self.assertEqual(session_request.call_count, 2)
+
+
+class AsyncUpstreamClientTestCase(SimpleTestCase):
+    def test_client_per_loop_closed_with_it(self):
+        upstream_client = AsyncUpstreamClient()
+
+        async def call():
+            client = await upstream_client.get_client("http://es:5000")
+            self.assertIs(await upstream_client.get_client("http://es:5000"), client)
+            with mock.patch.object(client, "request", mock.AsyncMock(return_value=httpx.Response(200, json={}))):
+                await upstream_client.get("http://es:5000/dkm/search")
+            return client
+
+        first = asyncio.run(call())
+        second = asyncio.run(call())
+        self.assertIsNot(first, second)
+        self.assertTrue(first.is_closed)
+        self.assertTrue(second.is_closed)
+        self.assertTrue(all(loop.is_closed() for loop in upstream_client.clients))
+        self.assertEqual(len(upstream_client.clients), 1)
+
+
+class RemoveDocumentsTestCase(SimpleTestCase):
+    def test_results_per_file_and_target(self):
+        def delete(url):
+            if "b.pdf" in url and "indexname=extracted" in url:
+                raise requests.exceptions.ConnectionError("es down")
+            if "indexname=search" in url:
+                return make_upstream_response(404, "not json")
+            return make_upstream_response(200, json.dumps({"deleted": url.split("?")[0].rsplit("/", 1)[1]}))
+
+        def delete_keys(keys):
+            if "b.pdf/source" in keys:
+                return [{"Deleted": [{"Key": "b.pdf/source"}], "Errors": [{"Key": "b.pdf/image.png"}]}]
+            return [{"Deleted": [{"Key": key} for key in keys]}]
+
+        with mock.patch("route.core.removal.upstream_client") as upstream_client, \
+                mock.patch("route.core.removal.s3_storage") as s3_storage, \
+                mock.patch("route.core.removal.get_s3_object_keys", lambda filename: [filename + "/source",
+                                                                                     filename + "/image.png"]):
+            upstream_client.delete.side_effect = delete
+            s3_storage.delete_keys.side_effect = delete_keys
+            results = remove_documents(["a.pdf", "b.pdf"], ["extracted", "search"], 'aggregator=AND')
+
+        self.assertEqual(results, {
+            "a.pdf": {"extracted": {"status": 200, "data": {"deleted": "a.pdf"}},
+                      "search": {"status": 404, "data": {}},
+                      "s3": {"status": "success"}},
+            "b.pdf": {"extracted": {"error": "es down"},
+                      "search": {"status": 404, "data": {}},
+                      "s3": {"status": "failed", "errors": ["b.pdf/image.png"]}},
+        })
+        self.assertEqual(upstream_client.delete.call_count, 4)
+        self.assertTrue(all(call[1]["url"].endswith("&aggregator=AND") for call in upstream_client.delete.call_args_list))
+
+    def test_without_s3_and_files(self):
+        with mock.patch("route.core.removal.upstream_client") as upstream_client, \
+                mock.patch("route.core.removal.s3_storage") as s3_storage:
+            upstream_client.delete.return_value = make_upstream_response(200, "{}")
+            self.assertEqual(remove_documents(["a.pdf"], ["search"], remove_s3=False),
+                             {"a.pdf": {"search": {"status": 200, "data": {}}}})
+            self.assertEqual(remove_documents([], ["search"]), {})
+        s3_storage.delete_keys.assert_not_called()
+
+
+class SingleFlightTestCase(SimpleTestCase):
+    def test_concurrent_calls_are_coalesced(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 200, {"data": []}
+
+        def call():
+            results.append(flight.do("key", fetch))
+
+        threads = [threading.Thread(target=call) for _ in range(5)]
+        threads[0].start()
+        self.assertTrue(started.wait(5))
+        for thread in threads[1:]:
+            thread.start()
+        # the leader is blocked in fetch until the 4 other calls wait on it
+        deadline = time.monotonic() + 5
+        while flight.calls["key"].waiters < 4 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [(200, {"data": []})] * 5)
+        self.assertEqual(len({id(result[1]) for result in results}), 5)
+
+
+class MergedPageTestCase(TestCase):
+    def test_cursor_pages_cover_pending_and_upstream_rows(self):
+        for idx in range(3):
+            Contract.objects.create(document_file_name="file%s.pdf" % idx, document_path="", request_id="1", imported_by="test")
+        upstream = [{"filename": "upstream%s.pdf" % idx} for idx in range(4)]
+        factory = RequestFactory()
+
+        filenames = []
+        page = MergedPage(factory.post('/orch/api/documents/?from=0&to=2'))
+        while True:
+            params = dict(param.split("=") for param in page.upstream_query_string.split("&"))
+            records = upstream[int(params["from"]):int(params["to"])]
+            filenames.extend(record["filename"] for record in page.records(["filename"], records))
+            cursor = page.next_cursor(len(records))
+            if cursor is None:
+                break
+            page = MergedPage(factory.post('/orch/api/documents/?from=0&to=2&cursor=%s' % cursor))
+
+        self.assertEqual(filenames, ["file2.pdf", "file1.pdf", "file0.pdf",
+                                     "upstream0.pdf", "upstream1.pdf", "upstream2.pdf", "upstream3.pdf"])
+
+
+@override_settings(IS_NOTIFICATION_REQUIRED=True)
+class AsyncDocumentsListingTestCase(TestCase):
+    def setUp(self):
+        for idx in range(2):
+            Contract.objects.create(document_file_name="file%s.pdf" % idx, document_path="", request_id="1", imported_by="test")
+
+    def post(self, query_string, upstream_records):
+        upstream_data = {"data": upstream_records, "totalRecords": 7}
+        with mock.patch.object(async_views, "async_upstream_client") as upstream_client:
+            upstream_client.post = mock.AsyncMock(return_value=httpx.Response(200, json=upstream_data))
+            response = self.client.post('/orch/api/async/documents/?' + query_string, {"columns": ["filename"]},
+                                        content_type='application/json')
+        return response, upstream_client.post
+
+    def test_pending_and_upstream_rows(self):
+        response, upstream_post = self.post("from=0&to=4", [{"filename": "upstream0.pdf"}, {"filename": "upstream1.pdf"}])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([record["filename"] for record in json.loads(response.content)["data"]],
+                         ["file1.pdf", "file0.pdf", "upstream0.pdf", "upstream1.pdf"])
+        self.assertIn("&from=0&to=2", upstream_post.call_args[0][0])
+
+    def test_pending_only_page_keeps_upstream_total(self):
+        response, upstream_post = self.post("from=0&to=2", [])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(response.content)
+        self.assertEqual([record["filename"] for record in data["data"]], ["file1.pdf", "file0.pdf"])
+        self.assertEqual(data["totalRecords"], 7)
+        self.assertIsNotNone(data["next_cursor"])
+        self.assertIn("&from=0&to=0", upstream_post.call_args[0][0])
+
+
+@override_settings(IS_NOTIFICATION_REQUIRED=True)
+class DocumentsListingTestCase(APITestCase):
+    def test_pending_only_page_keeps_upstream_total(self):
+        for idx in range(2):
+            Contract.objects.create(document_file_name="file%s.pdf" % idx, document_path="", request_id="1", imported_by="test")
+        upstream = Response({"data": [], "totalRecords": 7}, status=200)
+        with mock.patch.object(views, "user_access_control"), \
+                mock.patch.object(views, "request_mixin", return_value=upstream) as request_mixin:
+            response = self.client.post('/orch/api/documents/?from=0&to=2', {"columns": ["filename"]}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(response.content)
+        self.assertEqual([record["filename"] for record in data["data"]], ["file1.pdf", "file0.pdf"])
+        self.assertEqual(data["totalRecords"], 7)
+        self.assertEqual(request_mixin.call_args[1]["query_string"], "from=0&to=0")
+
+
+class ContractServicesTestCase(TestCase):
+    def test_delete_failed_contracts(self):
+        for idx in range(10):
+            Contract.objects.create(document_file_name="File%s.pdf" % idx, document_path="", request_id="1",
+                                    contractId="contract%s" % idx, imported_by="test")
+        Contract.objects.create(document_file_name="FILE1.PDF", document_path="", request_id="2", imported_by="test")
+
+        with CaptureQueriesContext(connection) as single:
+            delete_failed_contracts(["contract0"])
+        with CaptureQueriesContext(connection) as batch:
+            filenames = delete_failed_contracts(["contract%s" % idx for idx in range(1, 5)])
+
+        self.assertEqual(len(single.captured_queries), len(batch.captured_queries))
+        self.assertEqual(sorted(filenames), ["File%s.pdf" % idx for idx in range(1, 5)])
+        self.assertEqual(sorted(Contract.objects.values_list("contractId", flat=True)),
+                         ["contract%s" % idx for idx in range(5, 10)])
+
+    def test_contracts_by_filenames(self):
+        for name in ["Report.pdf", "REPORT.PDF", "report.pdf.bak", "Other.pdf"]:
+            Contract.objects.create(document_file_name=name, document_path="", request_id="1", imported_by="test")
+
+        matched = contracts_by_filenames(["report.PDF", "missing.pdf"])
+
+        self.assertEqual(sorted(matched.values_list("document_file_name", flat=True)), ["REPORT.PDF", "Report.pdf"])
+        self.assertEqual(sorted(contracts_by_filenames(["report.pdf"]).values_list("document_file_name", flat=True)),
+                         sorted(contract.document_file_name
+                                for contract in Contract.objects.filter(document_file_name__iexact="report.pdf")))
+
+
+class TracingTestCase(SimpleTestCase):
+    def test_server_timing_header(self):
+        def view(request):
+            with span("upstream", "POST /dkm/v2/search"):
+                with span("upstream", "retry"):
+                    pass
+            with span("s3", "get"):
+                pass
+            return HttpResponse("ok")
+
+        response = TracingMiddleware(view)(RequestFactory().get('/orch/api/documents/'))
+        metrics = [metric.split(";")[0] for metric in response["Server-Timing"].split(", ")]
+        self.assertEqual(metrics, ["upstream", "s3", "total"])
+        self.assertIn('upstream;dur=', response["Server-Timing"])
+        self.assertIn('desc="1"', response["Server-Timing"])
+
+    def test_async_chain(self):
+        async def view(request):
+            with span("upstream", "POST /dkm/v2/search"):
+                await asyncio.sleep(0)
+            return HttpResponse("ok")
+
+        middleware = TracingMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        response = asyncio.run(middleware(RequestFactory().get('/orch/api/async/documents/')))
+        metrics = [metric.split(";")[0] for metric in response["Server-Timing"].split(", ")]
+        self.assertEqual(metrics, ["upstream", "total"])
+
+    def test_streamed_response_timed_until_exhausted(self):
+        def rows():
+            yield "filename\r\n"
+            time.sleep(0.01)
+            yield "a.pdf\r\n"
+
+        middleware = TracingMiddleware(lambda request: StreamingHttpResponse(rows(), content_type="text/csv"))
+        with self.settings(SLOW_REQUEST_THRESHOLD_MS=0), \
+                mock.patch("route.core.tracing.slow_request_logger") as slow_request_logger:
+            response = middleware(RequestFactory().get('/orch/api/documents-export/'))
+            self.assertFalse(response.has_header("Server-Timing"))
+            slow_request_logger.info.assert_not_called()
+
+            self.assertEqual(b"".join(response.streaming_content), b"filename\r\na.pdf\r\n")
+        data = slow_request_logger.info.call_args[1]["extra"]["data"]
+        self.assertGreaterEqual(data["duration_ms"], 10)
+
+
+class IdentityTestCase(SimpleTestCase):
+    def test_session_claims(self):
+        identity = RequestIdentity({"preferred_username": "admin", "roles": "[ROLE_IMPORT, ROLE_READ_ONLY]",
+                                    "groups": ["group"]})
+        self.assertTrue(identity.authenticated)
+        self.assertEqual(identity.username, "admin")
+        self.assertEqual(identity.roles, {"ROLE_IMPORT", "ROLE_READ_ONLY"})
+        self.assertTrue(identity.has_any_role(ROLES_IMPORT))
+        self.assertFalse(identity.has_any_role(ROLES_ADMIN))
+
+        identity = RequestIdentity({"preferred_username": "admin"})
+        self.assertFalse(identity.authenticated)
+        self.assertFalse(identity.has_any_role(ROLES_ADMIN))
+
+    def test_identity_read_once(self):
+        session = mock.MagicMock()
+        session.__contains__.return_value = True
+        session.get.return_value = ["ROLE_ADMIN"]
+        request = RequestFactory().get('/orch/api/documents/')
+        request.session = session
+
+        self.assertIs(get_identity(request), get_identity(request))
+        self.assertEqual(session.get.call_count, 3)
+        session.__setitem__.assert_not_called()
+
+    def test_required_roles(self):
+        self.assertEqual(get_required_roles('/orch/api/verify-document/'), ROLES_IMPORT)
+        self.assertEqual(get_required_roles('/orch/uam/users/'), ROLES_ADMIN)
+        self.assertIsNone(get_required_roles('/orch/uam/key-cloak-logout/'))
+        self.assertIsNone(get_required_roles('/metrics'))
+
+
+class SessionStoreTestCase(TestCase):
+    def get_store(self, session_key=None):
+        return importlib.import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+
+    def test_session_cache_is_shared(self):
+        if settings.SESSION_ENGINE.endswith(("cache", "cached_db")):
+            self.assertNotIsInstance(caches[settings.SESSION_CACHE_ALIAS], LocMemCache)
+
+    def test_changes_are_seen_by_other_workers(self):
+        store = self.get_store()
+        store["preferred_username"] = "admin"
+        store["roles"] = ["ROLE_ADMIN"]
+        store.save(must_create=True)
+        self.assertEqual(self.get_store(store.session_key)["roles"], ["ROLE_ADMIN"])
+
+        store["roles"] = ["ROLE_READ_ONLY"]
+        store.save()
+        self.assertEqual(self.get_store(store.session_key)["roles"], ["ROLE_READ_ONLY"])
+
+        store.delete()
+        self.assertNotIn("roles", self.get_store(store.session_key))
+
+
+class MiddlewareChainTestCase(SimpleTestCase):
+    def test_asgi_chain_runs_without_threads(self):
+        # one sync only middleware makes django run the whole chain in a thread per request
+        for middleware in settings.MIDDLEWARE:
+            self.assertTrue(getattr(import_string(middleware), "async_capable", False), middleware)
+
+
+class MetricsTestCase(TestCase):
+    def test_json_payload_size(self):
+        payload = {"filters": {"query": "contract"}}
+        self.assertEqual(get_payload_size(None, payload), len(json.dumps(payload)))
+        self.assertEqual(get_payload_size(b"abc", payload), 3)
+        self.assertEqual(get_payload_size(), 0)
+
+    def test_query_count_per_view(self):
+        def view(request):
+            list(Contract.objects.all())
+            list(Contract.objects.all())
+            return HttpResponse("ok")
+
+        request = RequestFactory().get('/orch/api/documents/')
+        request.resolver_match = mock.Mock(view_name="documents")
+        with mock.patch("route.core.middleware.VIEW_DB_QUERIES") as metric:
+            QueryCountMiddleware(view)(request)
+        metric.labels.assert_called_once_with("documents")
+        metric.labels.return_value.observe.assert_called_once_with(2)
+
+    async def test_query_count_under_asgi(self):
+        job = await ExportJob.objects.acreate(export_format="csv", request_data="{}", requested_by='')
+        with mock.patch("route.core.middleware.VIEW_DB_QUERIES") as metric:
+            response = await self.async_client.post('/orch/api/export-job/', {"job_id": str(job.job_id)},
+                                                    content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        metric.labels.assert_called_once_with("export_job_status")
+        self.assertGreaterEqual(metric.labels.return_value.observe.call_args[0][0], 1)
+
+
+class AsyncFileHandlerTestCase(SimpleTestCase):
+    def make_handler(self, **kwargs):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        handler = AsyncFileHandler(os.path.join(directory.name, "app.log"), **kwargs)
+        handler.setFormatter(JsonFormatter())
+        return handler
+
+    def make_record(self, message, level=logging.INFO):
+        return logging.LogRecord("app.request", level, __file__, 1, message, None, None)
+
+    def test_queued_records_written_in_batches(self):
+        handler = self.make_handler(batch_size=2)
+        records = queue.Queue()
+        for line in ["1", "2", "3", "4", "5", None]:
+            records.put(line)
+        with mock.patch.object(handler, "write") as write:
+            handler.run(records)
+        self.assertEqual([call[0][0] for call in write.call_args_list], [["1", "2"], ["3", "4"], ["5"]])
+
+    def test_records_flushed_on_close(self):
+        handler = self.make_handler(batch_size=2)
+        for idx in range(5):
+            handler.emit(self.make_record("request %d" % idx))
+        handler.close()
+
+        with open(handler.file_handler.baseFilename) as log_file:
+            entries = [json.loads(line) for line in log_file]
+        self.assertEqual([entry["message"] for entry in entries], ["request %d" % idx for idx in range(5)])
+        self.assertEqual(entries[0]["logger"], "app.request")
+
+    def test_full_queue_drops_records(self):
+        handler = self.make_handler(queue_size=1)
+        # no writer thread: the queue is never drained
+        handler.queue = queue.Queue(maxsize=1)
+        handler.pid = os.getpid()
+        with mock.patch("route.core.logs.LOG_RECORDS_DROPPED") as dropped:
+            handler.emit(self.make_record("kept"))
+            handler.emit(self.make_record("dropped"))
+        dropped.inc.assert_called_once_with()
+        self.assertEqual(json.loads(handler.queue.get_nowait())["message"], "kept")
+
+    def test_sampled_below_warning(self):
+        handler = self.make_handler(sample_rate=0.5)
+        handler.queue = queue.Queue()
+        handler.pid = os.getpid()
+        with mock.patch("route.core.logs.random.random", return_value=0.7):
+            handler.emit(self.make_record("info"))
+            handler.emit(self.make_record("warning", logging.WARNING))
+        self.assertEqual(json.loads(handler.queue.get_nowait())["message"], "warning")
+        self.assertTrue(handler.queue.empty())
+
+
+class S3DownloadTestCase(TestCase):
+    def test_unsatisfiable_range(self):
+        client = mock.Mock()
+        client.get_object.side_effect = ClientError({"Error": {"Code": "InvalidRange", "ActualObjectSize": "10"}}, "GetObject")
+        with mock.patch.object(S3Storage, "client", client):
+            response = self.client.post('/orch/api/source-document/', {"document_id": "contract.pdf"}, HTTP_RANGE="bytes=20-")
+
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(response["Content-Range"], "bytes */10")
+        self.assertEqual(client.get_object.call_count, 1)
+
+    def test_body_closed_with_response(self):
+        body = mock.Mock()
+        body.iter_chunks.return_value = iter([b"%PDF", b"-1.4"])
+        client = mock.Mock()
+        client.get_object.return_value = {"Body": body, "ContentLength": 8}
+        with mock.patch.object(S3Storage, "client", client):
+            response = self.client.post('/orch/api/source-document/', {"document_id": "contract.pdf"})
+
+        self.assertEqual(b"".join(response.streaming_content), b"%PDF-1.4")
+        response.close()
+        body.close.assert_called_once_with()
+
+
+@override_settings(PROFILING_ENABLED=True, PROFILING_TOKEN="secret", PROFILING_SAMPLE_RATE=0)
+class ProfilingTestCase(APITestCase):
+    def login(self, roles):
+        session = self.client.session
+        session["preferred_username"] = "admin"
+        session["roles"] = roles
+        session.save()
+
+    def test_middleware_profiles_header_requests(self):
+        request = RequestFactory().get('/orch/api/documents/', HTTP_X_PROFILE="secret")
+        request.session = {"preferred_username": "admin", "roles": ["ROLE_ADMIN"]}
+        with mock.patch.object(profiling.profile_executor, "submit") as submit:
+            response = profiling.ProfilingMiddleware(lambda request: HttpResponse("ok"))(request)
+
+        func, profile_id, stats, metadata = submit.call_args[0]
+        self.assertIs(func, profiling.store_profile)
+        self.assertEqual(response["X-Profile-Id"], str(profile_id))
+        self.assertIsInstance(stats, dict)
+        self.assertEqual(metadata["trigger"], RequestProfile.HEADER)
+        self.assertEqual(metadata["requested_by"], "admin")
+        self.assertEqual(metadata["status_code"], 200)
+
+    async def test_middleware_under_asgi(self):
+        with mock.patch.object(profiling.profile_executor, "submit") as submit:
+            response = await self.async_client.post('/orch/api/export-job/', {"job_id": "not-a-job"},
+                                                    content_type='application/json', headers={"X-Profile": "secret"})
+        self.assertEqual(response["X-Profile-Id"], str(submit.call_args[0][1]))
+        self.assertEqual(submit.call_args[0][3]["view_name"], "export_job_status")
+
+    def test_middleware_skips_other_requests(self):
+        request = RequestFactory().get('/orch/api/documents/', HTTP_X_PROFILE="wrong")
+        with mock.patch.object(profiling.profile_executor, "submit") as submit:
+            response = profiling.ProfilingMiddleware(lambda request: HttpResponse("ok"))(request)
+        submit.assert_not_called()
+        self.assertFalse(response.has_header("X-Profile-Id"))
+
+    def test_middleware_skips_overlapping_requests(self):
+        request = RequestFactory().get('/orch/api/documents/', HTTP_X_PROFILE="secret")
+        request.session = {"preferred_username": "admin", "roles": ["ROLE_ADMIN"]}
+        middleware = profiling.ProfilingMiddleware(lambda request: HttpResponse("ok"))
+        with mock.patch.object(profiling.profile_executor, "submit") as submit:
+            with profiling.profile_lock:
+                response = middleware(request)
+            submit.assert_not_called()
+            self.assertFalse(response.has_header("X-Profile-Id"))
+
+            response = middleware(request)
+        self.assertTrue(response.has_header("X-Profile-Id"))
+
+    def test_store_failure_is_logged(self):
+        request = RequestFactory().get('/orch/api/documents/', HTTP_X_PROFILE="secret")
+        request.session = {"preferred_username": "admin", "roles": ["ROLE_ADMIN"]}
+        with mock.patch.object(profiling, "store_profile", side_effect=ClientError({"Error": {"Code": "AccessDenied"}},
+                                                                                  "PutObject")), \
+                mock.patch.object(profiling.logger, "error") as error:
+            profiling.ProfilingMiddleware(lambda request: HttpResponse("ok"))(request)
+            profiling.profile_executor.submit(lambda: None).result()
+        self.assertIsInstance(error.call_args[1]["exc_info"], ClientError)
+
+    def test_store_profile(self):
+        profile_id = uuid.uuid4()
+        stats = {("views.py", 1, "post"): (1, 1, 0.1, 0.1, {})}
+        with mock.patch.object(profiling, "s3_storage") as s3_storage, \
+                mock.patch.object(profiling, "close_old_connections"):
+            profiling.store_profile(profile_id, stats, {"method": "GET", "path": "/orch/api/documents/",
+                                                        "status_code": 200, "duration_ms": 1.5,
+                                                        "trigger": RequestProfile.SAMPLE})
+
+        profile = RequestProfile.objects.get(profile_id=profile_id)
+        body, file_path = s3_storage.upload.call_args[0]
+        self.assertEqual(marshal.loads(body), stats)
+        self.assertEqual(file_path, profile.file_path)
+        self.assertTrue(file_path.endswith("%s.prof" % profile_id))
+
+    def test_profile_download(self):
+        profile = RequestProfile.objects.create(method="GET", path="/", status_code=200, duration_ms=1,
+                                                trigger=RequestProfile.SAMPLE, file_path="profiles/1.prof")
+        body = mock.Mock()
+        body.iter_chunks.return_value = iter([b"stats"])
+        client = mock.Mock()
+        client.get_object.return_value = {"Body": body, "ContentLength": 5}
+
+        self.login(["ROLE_READ_ONLY"])
+        response = self.client.post('/orch/api/profile-download/', {"profile_id": str(profile.profile_id)})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.login(["ROLE_ADMIN"])
+        response = self.client.post('/orch/api/profile-download/', {"profile_id": "not-a-profile"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        with mock.patch.object(S3Storage, "client", client):
+            response = self.client.post('/orch/api/profile-download/', {"profile_id": str(profile.profile_id)})
+        self.assertEqual(b"".join(response.streaming_content), b"stats")
+        self.assertEqual(client.get_object.call_args[1]["Key"], "profiles/1.prof")
+
+        client.get_object.side_effect = ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        with mock.patch.object(S3Storage, "client", client):
+            response = self.client.post('/orch/api/profile-download/', {"profile_id": str(profile.profile_id)})
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class S3UploadTestCase(SimpleTestCase):
+    def test_retried_upload_after_file_closed(self):
+        uploaded = []
+
+        def upload_fileobj(fileobj, bucket, key, **kwargs):
+            uploaded.append(fileobj.read())
+            fileobj.close()
+            if len(uploaded) == 1:
+                raise ClientError({"Error": {"Code": "SlowDown"}}, "PutObject")
+
+        client = mock.Mock()
+        client.upload_fileobj.side_effect = upload_fileobj
+        with mock.patch.object(S3Storage, "client", client), self.settings(S3_BUCKET="bucket"):
+            upload_admin_document(b"report", "report.xlsx", "tpd_report")
+
+        self.assertEqual(uploaded, [b"report", b"report"])
+
+
+def make_upstream_response(status_code, content):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content.encode("utf-8")
+    return response
+
+
+class VerifyExistingDocumentsTestCase(APITestCase):
+    files = ["uploaded-document.pdf", "not-uploaded-document.pdf"]
+
+    def setUp(self):
+        caches[settings.EXISTENCE_CACHE_ALIAS].clear()
+
+    def verify(self, *responses):
+        with mock.patch("route.core.helper.upstream_client") as upstream_client:
+            upstream_client.post.side_effect = responses
+            return self.client.post('/orch/api/verify-document/', {"files": self.files}, format='json')
+
+    def test_verify_multiple_documents_are_exists(self):
+        body = {"totalRecords": 1, "data": [{"document_id": "uploaded-document.pdf"}]}
+        response = self.verify(make_upstream_response(200, json.dumps(body)))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), [{"filename": "uploaded-document.pdf", "already_exists": True},
+                                                        {"filename": "not-uploaded-document.pdf", "already_exists": False}])
+
+    def test_records_without_document_id(self):
+        response = self.verify(make_upstream_response(200, json.dumps({"totalRecords": 1, "data": [{}]})),
+                               make_upstream_response(200, json.dumps({"totalRecords": 1, "data": [{}]})),
+                               make_upstream_response(200, json.dumps({"totalRecords": 0, "data": []})))
+
+        self.assertEqual([rec["already_exists"] for rec in json.loads(response.content)], [True, False])
+
+    def test_upstream_failure_is_not_cached(self):
+        response = self.verify(make_upstream_response(502, "<html>Bad Gateway</html>"))
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        response = self.verify(make_upstream_response(200, "<html>maintenance</html>"))
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        response = self.verify(make_upstream_response(200, json.dumps({"totalRecords": 0, "data": []})))
+        self.assertEqual([rec["already_exists"] for rec in json.loads(response.content)], [False, False])
+
+    @override_settings(SHARED_VERSION_CHECK_INTERVAL=0)
+    def test_invalidation_reaches_every_worker(self):
+        response = self.verify(make_upstream_response(200, json.dumps({"totalRecords": 0, "data": []})))
+        self.assertEqual([rec["already_exists"] for rec in json.loads(response.content)], [False, False])
+
+        # another worker: its own local cache entries, the shared stamp is bumped in the database
+        other_worker = SharedVersion("document_existence")
+        other_worker.bump()
+
+        body = {"totalRecords": 1, "data": [{"document_id": "uploaded-document.pdf"}]}
+        response = self.verify(make_upstream_response(200, json.dumps(body)))
+        self.assertEqual([rec["already_exists"] for rec in json.loads(response.content)], [True, False])
@@ -16,11 +16,25 @@ from .views import (DocumentsListing,
                     DocumentPrice,
                     AdminDownload,
                     PaymentTermDetails,
-                    ExportPaymentTerms)
+                    ExportPaymentTerms,
+                    ExportJobSubmit,
+                    ExportJobStatus,
+                    ExportJobDownload,
+                    ProfileDownload)
+from .async_views import (AsyncDocumentDetails,
+                          AsyncDocumentsListing,
+                          AsyncDocumentTree,
+                          AsyncPaymentTermsList,
+                          AsyncQualityKpisList,
+                          AsyncDocumentPrice)
 
 urlpatterns = [
     path(r'export-documents/', ExportDocuments.as_view(), name="export_documents"),
     path(r'export-payment-terms/', ExportPaymentTerms.as_view(), name="export_payment_terms"),
+    path(r'export-jobs/', ExportJobSubmit.as_view(), name="export_job_submit"),
+    path(r'export-job/', ExportJobStatus.as_view(), name="export_job_status"),
+    path(r'export-job-download/', ExportJobDownload.as_view(), name="export_job_download"),
+    path(r'profile-download/', ProfileDownload.as_view(), name="profile_download"),
     path(r'document/', DocumentDetails.as_view(), name="documents_details"),
     path(r'documents/', DocumentsListing.as_view(), name="documents_list"),
     path(r'document-upload/', DocumentsUpload.as_view(), name="document_upload"),
@@ -37,4 +51,12 @@ urlpatterns = [
     path(r'document-tree/', DocumentTree.as_view(), name="document_tree"),
     path(r'admin-upload/', AdminUpload.as_view(), name="admin_upload"),
     path(r'admin-download/', AdminDownload.as_view(), name="admin_download"),
+
+    # async variants, served by route/asgi.py
+    path(r'async/document/', AsyncDocumentDetails.as_view(), name="async_documents_details"),
+    path(r'async/documents/', AsyncDocumentsListing.as_view(), name="async_documents_list"),
+    path(r'async/document-tree/', AsyncDocumentTree.as_view(), name="async_document_tree"),
+    path(r'async/payment-terms/', AsyncPaymentTermsList.as_view(), name="async_payment_terms_list"),
+    path(r'async/quality-kpis/', AsyncQualityKpisList.as_view(), name="async_quality_kpis_list"),
+    path(r'async/document-price/', AsyncDocumentPrice.as_view(), name="async_price_list"),
 ]
@@ -1,14 +1,13 @@
-import os
+import logging
 
 ENABLE_PRINT = True
 
+request_logger = logging.getLogger("app.request")
+
+
 def cprint(msg=''):
+    '''
+    Kept for old call sites, goes through the buffered request log
+    '''
     if ENABLE_PRINT:
-        local_msg = msg
-        if os.name == 'nt': #Check Windows(nt)
-            pass
-            # with open('D:/proxy_logs.log', 'a') as f:
-            #     print(local_msg, file=f)
-        else:
-            with open('/var/app_middleware_logs.log', 'a') as f:
-                print(local_msg, file=f)
\ No newline at end of file
+        request_logger.info(msg)
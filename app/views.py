@@ -4,75 +4,172 @@ Api requests for module
 import json
 import uuid
 from io import BytesIO as IO
+from zipfile import BadZipFile
 
 import pandas as pd
-import requests
+from botocore.exceptions import BotoCoreError, ClientError
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import transaction
 from django.http import HttpResponse
 from django.utils import timezone
+from openpyxl.utils.exceptions import InvalidFileException
+from requests.exceptions import RequestException
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from route.core.cache import response_cache
 from route.core.constants import (ADMIN_UPLOAD_COLUMNS, ADMIN_UPLOAD_URL,
                                   DOCUMENT_DETAIL_URL, DOCUMENT_UPLOAD_URL,
-                                  DOCUMENTS_LISTING_URL, HTTP_API_ERROR,
+                                  DOCUMENTS_LISTING_URL, EXPORT_FORMAT_XLSX,
+                                  EXPORT_FORMATS, HTTP_API_ERROR,
+                                  HTTP_BAD_REQUEST, HTTP_SERVICE_UNAVAILABLE,
                                   HTTP_SUCCESS, NO_RECORD_FOUND,
-                                  REMOVE_DOCUMENT_URL)
-from route.core.helper import (documents_export, download_admin_files,
-                               download_s3_object,
+                                  PAYMENT_TERMS_EXPORT_COLUMNS, ROLES_ADMIN)
+from route.core.helper import (are_documents_in_elastic_db, documents_export,
+                               download_admin_files, download_s3_object,
                                download_searchable_s3_object,
-                               is_document_in_elastic_db, remove_s3_object,
-                               request_mixin, upload_admin_document,
-                               upload_image, user_access_control)
-from uam.models import SupplierGroup
-
-from .models import Contract
+                               get_admin_header_row, get_byte_range,
+                               invalidate_document_existence,
+                               range_not_satisfiable, request_mixin,
+                               scan_excel, stream_s3_object,
+                               upload_admin_document, upload_images,
+                               user_access_control, without_keys)
+from route.core.exporters import get_export_content_type
+from route.core.identity import get_identity
+from route.core.reference import bulk_upsert_supplier_groups
+from route.core.removal import remove_documents
+from route.core.storage import InvalidByteRange, s3_storage
+from route.core.upstream import upstream_client
+
+from .jobs import fail_stale_job, submit_export_job
+from .listing import MergedPage
+from .models import Contract, ExportJob, RequestProfile
+from .services import (delete_contracts_by_filenames, delete_failed_contracts,
+                       mark_contracts_success)
 
 
 class ExportDocuments(APIView):
     def post(self, request, format=None):
-        if 'contains_quality_kpi' in self.request.data:
-            records = request_mixin(request, DOCUMENT_DETAIL_URL, self.request.data)
+        export_format = request.data.get("format", EXPORT_FORMAT_XLSX)
+        if export_format not in EXPORT_FORMATS:
+            return Response({"message": "Unsupported export format"}, status=HTTP_BAD_REQUEST)
+
+        data = without_keys(request.data, "format")
+        if 'contains_quality_kpi' in data:
+            records = request_mixin(request, DOCUMENT_DETAIL_URL, data)
         else:
-            records = request_mixin(request, DOCUMENTS_LISTING_URL, self.request.data)
+            records = request_mixin(request, DOCUMENTS_LISTING_URL, data)
 
         if records.status_code == status.HTTP_200_OK:
-            return documents_export(records, self.request.data, False)
+            return documents_export(records, data, False, export_format)
         return Response({"message": "Something went wrong!!!"}, status=HTTP_API_ERROR)
 
 
 class ExportPaymentTerms(APIView):
     def post(self, request, format=None):
-        self.request.data["columns"] = ["filename", "document_number", "document_type", "supplier_group", "supplier_legal_entity",
-                                        "country","payment_terms","actual_pt_days"]
+        export_format = request.data.get("format", EXPORT_FORMAT_XLSX)
+        if export_format not in EXPORT_FORMATS:
+            return Response({"message": "Unsupported export format"}, status=HTTP_BAD_REQUEST)
+
+        data = without_keys(request.data, "format")
+        data["columns"] = PAYMENT_TERMS_EXPORT_COLUMNS
         export_payment_terms = True
-        records = request_mixin(request, DOCUMENT_DETAIL_URL, self.request.data)
+        records = request_mixin(request, DOCUMENT_DETAIL_URL, data)
 
         if records.status_code == status.HTTP_200_OK:
-            return documents_export(records, self.request.data, export_payment_terms)
+            return documents_export(records, data, export_payment_terms, export_format)
         return Response({"message": "Something went wrong!!!"}, status=HTTP_API_ERROR)
 
 
+class ExportJobSubmit(APIView):
+    def post(self, request, format=None):
+        export_type = request.data.get("export_type", ExportJob.DOCUMENTS)
+        export_format = request.data.get("format", EXPORT_FORMAT_XLSX)
+        if export_format not in EXPORT_FORMATS or export_type not in dict(ExportJob.EXPORT_TYPE):
+            return Response({"message": "Unsupported export"}, status=HTTP_BAD_REQUEST)
+
+        with transaction.atomic():
+            job = ExportJob.objects.create(export_type=export_type,
+                                           export_format=export_format,
+                                           request_data=json.dumps(without_keys(request.data, "export_type", "format")),
+                                           query_string=request.META['QUERY_STRING'],
+                                           requested_by=get_identity(request).username)
+            submit_export_job(job)
+        return Response({"job_id": str(job.job_id), "status": job.get_status_display()}, status=status.HTTP_202_ACCEPTED)
+
+
+class ExportJobStatus(APIView):
+    def post(self, request, format=None):
+        try:
+            job = ExportJob.objects.get(job_id=self.request.data["job_id"], requested_by=get_identity(request).username)
+        except (KeyError, ExportJob.DoesNotExist, ValueError, ValidationError):
+            return Response({"message": "Requested job not exist"}, status=status.HTTP_404_NOT_FOUND)
+        fail_stale_job(job)
+        return Response({"job_id": str(job.job_id),
+                         "status": job.get_status_display(),
+                         "progress": job.progress,
+                         "row_count": job.row_count,
+                         "error": job.error}, status=HTTP_SUCCESS)
+
+
+class ExportJobDownload(APIView):
+    def post(self, request, format=None):
+        try:
+            job = ExportJob.objects.get(job_id=self.request.data["job_id"], requested_by=get_identity(request).username)
+        except (KeyError, ExportJob.DoesNotExist, ValueError, ValidationError):
+            return Response({"message": "Requested job not exist"}, status=status.HTTP_404_NOT_FOUND)
+        if fail_stale_job(job).status != ExportJob.SUCCESS:
+            return Response({"message": "Requested job is not finished", "status": job.get_status_display()},
+                            status=status.HTTP_409_CONFLICT)
+
+        try:
+            file = s3_storage.get(job.file_path, get_byte_range(request))
+        except InvalidByteRange as e:
+            return range_not_satisfiable(e.size)
+        except (ClientError, BotoCoreError):
+            return Response({"message": "Requested file not exist"}, status=HTTP_API_ERROR)
+        return stream_s3_object(file, job.file_name, get_export_content_type(job.export_format))
+
+
+class ProfileDownload(APIView):
+    def post(self, request, format=None):
+        # checked here, the route roles table is not enforced (TokenVerifyMiddleware is not registered)
+        if not get_identity(request).has_any_role(ROLES_ADMIN):
+            return Response({"message": "User is not valid"}, status=status.HTTP_403_FORBIDDEN)
+        try:
+            profile = RequestProfile.objects.get(profile_id=self.request.data["profile_id"])
+        except (KeyError, RequestProfile.DoesNotExist, ValueError, ValidationError):
+            return Response({"message": "Requested profile not exist"}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            file = s3_storage.get(profile.file_path)
+        except (ClientError, BotoCoreError):
+            return Response({"message": "Requested profile not exist"}, status=HTTP_API_ERROR)
+        return stream_s3_object(file, "%s.prof" % profile.profile_id, 'application/octet-stream')
+
+
 class SearchableDocument(APIView):
     def post(self, request):
         filename = self.request.data["document_id"]
-        file_status, file =  download_searchable_s3_object(filename)
+        try:
+            file_status, file = download_searchable_s3_object(filename, get_byte_range(request))
+        except InvalidByteRange as e:
+            return range_not_satisfiable(e.size)
         if file_status is True:
-            response = HttpResponse(file['Body'], content_type='application/pdf')
-            response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
-            return response
+            return stream_s3_object(file, filename, 'application/pdf')
         return Response({"message": "Requested file not exist"}, status=HTTP_API_ERROR)
 
 
 class SourceDocument(APIView):
     def post(self, request):
         filename = self.request.data["document_id"]
-        file_status, file =  download_s3_object(filename)
+        try:
+            file_status, file = download_s3_object(filename, get_byte_range(request))
+        except InvalidByteRange as e:
+            return range_not_satisfiable(e.size)
         if file_status is True:
-            response = HttpResponse(file['Body'], content_type='application/pdf')
-            response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
-            return response
+            return stream_s3_object(file, filename, 'application/pdf')
         return Response({"message": "Requested file not exist"}, status=HTTP_API_ERROR)
 
 
@@ -82,138 +179,174 @@ class DocumentDetails(APIView):
 
 
 class DocumentsListing(APIView):
-    def update_user_request(self, request):
-        page_to =  int(request.GET.get("to"))
-        page_from =  int(request.GET.get("from"))
-        contract_list = Contract.objects.filter(status=Contract.UPLOADED,
-            updated__gte=timezone.now() - timezone.timedelta(minutes=15)).order_by("updated")[page_from:page_to]
-
-        try:
-            param_list =  request.META['QUERY_STRING'].split('&')
-            com_list = [n for n, x in enumerate(param_list) if 'to=' in x]
-            param_list[com_list[0]] = 'to={0}'.format(page_to - contract_list.count())
-            request.META['QUERY_STRING'] = '&'.join(param_list)
-        except Exception as e:
-            pass
-        return contract_list
-
-    def update_user_data(self, request, contract_list, data):
-        for contract in contract_list:
-            record = {}
-            for rec in request.data["columns"]:
-                record[rec] = ''
-            record["status"] = contract.status
-            record['filename'] = contract.document_file_name
-            record['origin'] = contract.imported_by
-            record["import_datetime"] = contract.updated
-            data["data"].insert(0, record)
-        return data
-
     def post(self, request, format=None):
         user_access_control(request)
-        if settings.IS_NOTIFICATION_REQUIRED is True:
-            contract_list = self.update_user_request(request)
+        if settings.IS_NOTIFICATION_REQUIRED is not True:
+            return request_mixin(request, DOCUMENTS_LISTING_URL, request.data, cached=True)
 
-        query_params = '?aggregator=AND&indexname=%s&%s' % (settings.ELASTIC_SEARCH_INDEX_KEY, request.META['QUERY_STRING'])
-        response = requests.post(url=DOCUMENTS_LISTING_URL + query_params, data=json.dumps(request.data))
-        
-        if response.status_code == status.HTTP_200_OK:
-            data = json.loads(response.content)
+        try:
+            page = MergedPage(request)
+        except (KeyError, ValueError):
+            return Response({"message": "Invalid page or cursor"}, status=HTTP_BAD_REQUEST)
 
-            if settings.IS_NOTIFICATION_REQUIRED is True:
-                data = self.update_user_data(request, contract_list, data)
+        response = request_mixin(request, DOCUMENTS_LISTING_URL, request.data, cached=True,
+                                 query_string=page.upstream_query_string)
+        if response.status_code == HTTP_SERVICE_UNAVAILABLE:
+            return response
 
-            return Response(data, status=response.status_code)
+        if response.status_code == status.HTTP_200_OK:
+            return Response(page.response_data(request.data["columns"], response.data), status=response.status_code)
         return Response({"message": "Something went wrong !!!"}, status=HTTP_API_ERROR)
 
 
 class RemoveDocument(APIView):
     def post(self, request):
         filename = self.request.data["document_id"]
-        remove_s3_object(filename)
-        Contract.objects.filter(document_file_name__iexact=filename).delete()
-        query_params = '?indexname=%s&%s' % (settings.ELASTIC_EXTRACTED_INDEX_KEY, request.META['QUERY_STRING'])
-        requests.delete(url=REMOVE_DOCUMENT_URL.format(filename.replace(" ", "")) + query_params)
+        delete_contracts_by_filenames([filename])
+        invalidate_document_existence([filename])
+        indices = [settings.ELASTIC_EXTRACTED_INDEX_KEY, settings.APTTUS_DOCUMENTS_INDEX_KEY, settings.ELASTIC_SEARCH_INDEX_KEY]
+        results = remove_documents([filename], indices, request.META['QUERY_STRING'])[filename]
+        response_cache.invalidate()
 
-        query_params = '?indexname=%s&%s' % (settings.APTTUS_DOCUMENTS_INDEX_KEY, request.META['QUERY_STRING'])
-        requests.delete(url=REMOVE_DOCUMENT_URL.format(filename.replace(" ", "")) + query_params)
-
-        query_params = '?indexname=%s&%s' % (settings.ELASTIC_SEARCH_INDEX_KEY, request.META['QUERY_STRING'])
-        response = requests.delete(url=REMOVE_DOCUMENT_URL.format(filename.replace(" ", "")) + query_params)
-
-        data = json.loads(response.content)
-        return Response(data, status=response.status_code)
+        result = results[settings.ELASTIC_SEARCH_INDEX_KEY]
+        if "error" in result:
+            return Response({"message": "Connection failed to the services"}, status=HTTP_SERVICE_UNAVAILABLE)
+        return Response(result["data"], status=result["status"])
 
 
 class DocumentsUpload(APIView):
     def process_user_data(self, request, username, request_id):
         files = []
+        failed_files = []
         overwrite = "True" if request.POST.get('already_exists') == 'true' else "False"
 
-        for myfile in request.FILES.getlist('myfile'):
+        for myfile, new_file_name, error in upload_images(request.FILES.getlist('myfile'), request_id):
+            if error is not None:
+                failed_files.append({"filename": myfile.name, "error": error})
+                continue
             contractId = str(uuid.uuid4())
-            new_file_name = upload_image(myfile, request_id)
             files.append({"filename": new_file_name, "overwrite": overwrite, "contractId": contractId, "actual_name": myfile.name})
 
-        for val in files:
-            Contract.objects.update_or_create(document_file_name=val["actual_name"],
-                                              defaults={'document_path': val["filename"],
-                                                        'request_id': request_id,
-                                                        'contractId': val["contractId"],
-                                                        'status': Contract.UPLOADED,
-                                                        'imported_by': username,
-                                                        'updated': timezone.now()})
-        return files
+        self.save_contracts(files, username, request_id)
+        invalidate_document_existence([val["actual_name"] for val in files])
+        response_cache.invalidate()
+        return files, failed_files
+
+    @transaction.atomic
+    def save_contracts(self, files, username, request_id):
+        '''
+        Bulk upsert of the uploaded contracts (matched on document_file_name)
+        '''
+        now = timezone.now()
+        uploaded = {val["actual_name"]: val for val in files}
+        existing = list(Contract.objects.filter(document_file_name__in=uploaded.keys()))
+
+        for contract in existing:
+            val = uploaded[contract.document_file_name]
+            contract.document_path = val["filename"]
+            contract.request_id = request_id
+            contract.contractId = val["contractId"]
+            contract.status = Contract.UPLOADED
+            contract.imported_by = username
+            contract.updated = now
+        Contract.objects.bulk_update(existing, ['document_path', 'request_id', 'contractId', 'status', 'imported_by', 'updated'])
+
+        existing_names = {contract.document_file_name for contract in existing}
+        Contract.objects.bulk_create([Contract(document_file_name=name,
+                                               document_path=val["filename"],
+                                               request_id=request_id,
+                                               contractId=val["contractId"],
+                                               status=Contract.UPLOADED,
+                                               imported_by=username)
+                                      for name, val in uploaded.items() if name not in existing_names])
 
     def post(self, request, format=None):
         request_id = str(uuid.uuid4())
-        username = request.session.get('name', '')
-        files = self.process_user_data(request, username, request_id)
+        username = get_identity(request).username
+        files, failed_files = self.process_user_data(request, username, request_id)
+
+        if not files:
+            return Response({"message": "Files upload failed", "failed_files": failed_files}, status=HTTP_API_ERROR)
 
         request_data = {
             "userId": username,
             "requestId": request_id,
             "files": files
         }
-        return request_mixin(request, DOCUMENT_UPLOAD_URL, request_data)
+        response = request_mixin(request, DOCUMENT_UPLOAD_URL, request_data)
+        if failed_files and isinstance(response.data, dict):
+            response.data["failed_files"] = failed_files
+        return response
 
 
 class AdminUpload(APIView):
     @transaction.atomic
     def saving_supplier_group(self, records):
         records = records.fillna('')
-        for data in records.values:
-            if data.size > 5 and data[5] != '' and data[6] != '':
-                try:
-                    supplier, created = SupplierGroup.objects.get_or_create(supplier_group=data[5], defaults={'supplier_group_name': data[6]})
-                    if not created:
-                        supplier.supplier_group_name = data[6]
-                        supplier.save()
-                except SupplierGroup.DoesNotExist:
-                    pass
+        if records.shape[1] < 7:
+            return bulk_upsert_supplier_groups([])
+
+        supplier_groups = records.iloc[:, [5, 6]]
+        supplier_groups = supplier_groups[(supplier_groups.iloc[:, 0] != '') & (supplier_groups.iloc[:, 1] != '')]
+        return bulk_upsert_supplier_groups(supplier_groups.itertuples(index=False, name=None))
+
+    def deduplicate_document(self, document, header_row):
+        '''
+        Parse the first sheet (xlsx or xls) and drop duplicated rows. Return the DataFrame and the bytes to store,
+        None when nothing has to change (no dropped rows, header on the first row)
+        '''
+        with pd.ExcelFile(document) as excel:
+            df = excel.parse(0, skiprows=header_row - 1)
+        document.seek(0)
+
+        row_count = len(df)
+        df.drop_duplicates(keep=False, inplace=True)
+        if len(df) == row_count and header_row == 1:
+            return df, None
+
+        excel_file = IO()
+        with pd.ExcelWriter(excel_file, engine='xlsxwriter') as xlwriter:
+            df.to_excel(xlwriter, sheet_name="Sheet1", index=False)
+        return df, excel_file.getvalue()
 
     def post(self, request, format=None):
         document_type = request.POST.get('document_type')
-        if 'tpd_monthly_report' in  document_type:
-            df = pd.read_excel(self.request.FILES["document"], skiprows = [0,1])
-        else:
-            df = pd.read_excel(self.request.FILES["document"])
-        df.drop_duplicates(keep=False, inplace=True)
-        if all(elem in df.columns  for elem in ADMIN_UPLOAD_COLUMNS[document_type]):
-            if 'supplier_reference_file' == document_type:
-                self.saving_supplier_group(df)
-            excel_file = IO()
-            xlwriter = pd.ExcelWriter(excel_file, engine='xlsxwriter')
-            df.to_excel(xlwriter, sheet_name="Sheet1", index=False)
-            xlwriter.save()
-            xlwriter.close()
-            excel_file.seek(0)
-            upload_admin_document(excel_file.read(), ADMIN_UPLOAD_COLUMNS[document_type + "_name"], document_type)
-            if 'supplier_reference_file' == document_type:
-                requests.get(url=ADMIN_UPLOAD_URL)
-            return Response({"message": "File processed successfully !!!"}, status=HTTP_SUCCESS)
-        else:
-          return Response({"message": "Required columns are not exists"}, status=NO_RECORD_FOUND)
+        document = self.request.FILES["document"]
+        required_columns = ADMIN_UPLOAD_COLUMNS[document_type]
+        header_row = get_admin_header_row(document_type)
+        # xlsx: header and duplicates checked in read only mode, .xls: parsed by pandas
+        try:
+            header, duplicated = scan_excel(document, header_row)
+        except (BadZipFile, KeyError, InvalidFileException):
+            header, duplicated = None, True
+        if header is not None and not all(elem in header for elem in required_columns):
+            return Response({"message": "Required columns are not exists"}, status=NO_RECORD_FOUND)
+
+        # uploads without duplicated rows or title rows are forwarded untouched
+        df, content = None, None
+        if duplicated or header_row != 1 or 'supplier_reference_file' == document_type:
+            try:
+                df, content = self.deduplicate_document(document, header_row)
+            except (ValueError, ImportError, BadZipFile):
+                return Response({"message": "Unsupported file format"}, status=HTTP_BAD_REQUEST)
+            if not all(elem in df.columns for elem in required_columns):
+                return Response({"message": "Required columns are not exists"}, status=NO_RECORD_FOUND)
+
+        supplier_groups = None
+        if 'supplier_reference_file' == document_type:
+            supplier_groups = self.saving_supplier_group(df)
+
+        upload_admin_document(content if content is not None else document,
+                              ADMIN_UPLOAD_COLUMNS[document_type + "_name"], document_type)
+        if 'supplier_reference_file' == document_type:
+            try:
+                upstream_client.get(url=ADMIN_UPLOAD_URL)
+            except RequestException:
+                return Response({"message": "Connection failed to the services"}, status=HTTP_SERVICE_UNAVAILABLE)
+        response = {"message": "File processed successfully !!!"}
+        if supplier_groups is not None:
+            response["supplier_groups"] = supplier_groups
+        return Response(response, status=HTTP_SUCCESS)
 
 
 class AdminDownload(APIView):
@@ -229,7 +362,7 @@ class AdminDownload(APIView):
 
 class DocumentTree(APIView):
     def post(self, request, format=None):
-        return request_mixin(request, DOCUMENTS_LISTING_URL, self.request.data, settings.DOCUMENT_TREE_INDEX_KEY, "OR")
+        return request_mixin(request, DOCUMENTS_LISTING_URL, self.request.data, settings.DOCUMENT_TREE_INDEX_KEY, "OR", cached=True)
 
 
 class PaymentTermDetails(APIView):
@@ -240,12 +373,12 @@ class PaymentTermDetails(APIView):
 class PaymentTermsList(APIView):
     def post(self, request, format=None):
         user_access_control(request)
-        return request_mixin(request, DOCUMENTS_LISTING_URL, self.request.data)
+        return request_mixin(request, DOCUMENTS_LISTING_URL, self.request.data, cached=True)
 
 class DocumentPrice(APIView):
     def post(self, request, format=None):
         user_access_control(request)
-        return request_mixin(request, DOCUMENTS_LISTING_URL, self.request.data)
+        return request_mixin(request, DOCUMENTS_LISTING_URL, self.request.data, cached=True)
 
 
 class QualityKpiDetails(APIView):
@@ -256,15 +389,19 @@ class QualityKpiDetails(APIView):
 class QualityKpisList(APIView):
     def post(self, request, format=None):
         user_access_control(request)
-        return request_mixin(request, DOCUMENTS_LISTING_URL, self.request.data)
+        return request_mixin(request, DOCUMENTS_LISTING_URL, self.request.data, cached=True)
 
 
 class VerifyExistingDocuments(APIView):
     def post(self, request, format=None):
         coming_document_list = self.request.data.get('files')
+        try:
+            existing_documents = are_documents_in_elastic_db(coming_document_list)
+        except RequestException:
+            return Response({"message": "Connection failed to the services"}, status=HTTP_SERVICE_UNAVAILABLE)
         response = []
         for rec in coming_document_list:
-           response.append({"filename": rec, "already_exists": is_document_in_elastic_db(rec)})
+           response.append({"filename": rec, "already_exists": existing_documents[rec]})
         return Response(response, status=HTTP_SUCCESS)
 
 
@@ -278,23 +415,16 @@ class PushNotification(APIView):
             response.append({"status": "Processing"})
         
         if status == '200':
-            Contract.objects.filter(contractId__in=contractId).update(status=Contract.SUCCESS)
+            mark_contracts_success(contractId)
+            response_cache.invalidate()
             response.append({"status": "success"})
 
         if status == '111':
-            contract_list = Contract.objects.filter(contractId__in=contractId)
-            for contract_id in contract_list:
-                filename = contract_id.document_file_name
-
-                Contract.objects.filter(document_file_name__iexact=filename).delete()
-                remove_document_url = REMOVE_DOCUMENT_URL.format(filename.replace(" ", ""))
-
-                query_params = '?aggregator=AND&indexname=%s' % settings.ELASTIC_SEARCH_INDEX_KEY
-                requests.delete(url=remove_document_url + query_params)
-
-                query_params = '?aggregator=AND&indexname=%s' % settings.ELASTIC_EXTRACTED_INDEX_KEY
-                requests.delete(url=remove_document_url + query_params)
+            filenames = delete_failed_contracts(contractId)
+            invalidate_document_existence(filenames)
 
-                remove_s3_object(filename)
-                response.append({"status": "failed"})
+            indices = [settings.ELASTIC_SEARCH_INDEX_KEY, settings.ELASTIC_EXTRACTED_INDEX_KEY]
+            remove_documents(filenames, indices, 'aggregator=AND')
+            response_cache.invalidate()
+            response.extend({"status": "failed"} for _ in filenames)
         return Response(response, status=HTTP_SUCCESS)
@@ -0,0 +1,56 @@
+'''
+Compare two benchmark reports (python -m benchmarks.run --output ...).
+
+    python -m benchmarks.compare baseline.json results.json --threshold 1.2
+
+Exit code 1 when a median time or peak memory grew by more than the threshold ratio,
+or when a benchmark (name, scale) is in only one of the two reports.
+'''
+import argparse
+import json
+import sys
+
+METRICS = ["median_seconds", "peak_memory_bytes"]
+
+
+def load_results(path):
+    with open(path) as report:
+        return {(result["name"], result["scale"]): result for result in json.load(report)["results"]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=1.2)
+    args = parser.parse_args(argv)
+
+    baseline = load_results(args.baseline)
+    current = load_results(args.current)
+
+    regressions = 0
+    for key in sorted(baseline.keys() & current.keys()):
+        ratios = []
+        for metric in METRICS:
+            before, after = baseline[key][metric], current[key][metric]
+            ratio = after / before if before else 1.0
+            ratios.append(ratio)
+            if ratio > args.threshold:
+                regressions += 1
+        print("%-32s %8d  time x%.2f  memory x%.2f" % (key[0], key[1], *ratios))
+
+    missing = 0
+    for label, keys in (("current", baseline.keys() - current.keys()), ("baseline", current.keys() - baseline.keys())):
+        for key in sorted(keys):
+            print("%-32s %8d  missing from %s" % (key[0], key[1], label))
+            missing += 1
+
+    if regressions:
+        print("%d regression(s) above x%.2f" % (regressions, args.threshold))
+    if missing:
+        print("%d benchmark(s) in only one report" % missing)
+    return 1 if regressions or missing else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
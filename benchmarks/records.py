@@ -0,0 +1,69 @@
+'''
+Synthetic elasticsearch shaped records (same fields the export transforms read)
+'''
+import random
+
+REGIONS = ["APA", "CHI", "EUR", "IND", "LAT", "MEA", "NAM"]
+
+CURRENCIES = ["EUR", "USD", "INR", "CNY"]
+
+
+def make_limits(rng):
+    return {"target": str(rng.randint(0, 100)),
+            "liquidated_damages_min": str(rng.randint(0, 10)),
+            "liquidated_damages_max": str(rng.randint(10, 50))}
+
+
+def make_payment_terms(rng):
+    return [{"payment_term_days": rng.choice(["30", "60", "90", "-1"])} for _ in range(rng.randint(0, 3))]
+
+
+def make_record(rng, idx):
+    return {
+        "filename": "contract_%s.pdf" % idx,
+        "origin": rng.choice(["Upload", "Apttus"]),
+        "import_datetime": "2021-%02d-%02dT10:20:30.%06d" % (rng.randint(1, 12), rng.randint(1, 28), idx % 1000000),
+        "document_number": "DOC-%08d" % idx,
+        "document_type": rng.choice(["Contract", "Amendment", "Purchase Order"]),
+        "parent_document_number": "DOC-%08d" % rng.randint(0, idx) if idx and rng.random() < 0.3 else "",
+        "region": rng.choice(REGIONS),
+        "country": "Country %s" % rng.randint(0, 249),
+        "project_name": "Project %s" % rng.randint(0, 999),
+        "_legal_entity": "Legal Entity %s" % rng.randint(0, 99),
+        "supplier_legal_entity": "Supplier Entity %s" % rng.randint(0, 9999),
+        "supplier_group": "Supplier Group %s" % rng.randint(0, 999),
+        "start_date": "2021-01-01",
+        "end_date": "2024-12-31",
+        "signed": rng.choice(["Yes", "No"]),
+        "zero_defect": make_limits(rng),
+        "paru": make_limits(rng),
+        "seqi": make_limits(rng),
+        "sar": make_limits(rng),
+        "stilt": make_limits(rng),
+        "liquidated_damages_formula": "min(%s%%, cap)" % rng.randint(1, 20),
+        "liquidated_damages_main_percent": {"liquidated_damages_percent": str(rng.randint(1, 20)),
+                                            "liquidated_damages_percent_min": "1",
+                                            "liquidated_damages_percent_max": "20"},
+        "liquidated_damages_main_raw": {"liquidated_damages_raw": str(rng.randint(100, 10000)),
+                                        "liquidated_damages_raw_min": "100",
+                                        "liquidated_damages_raw_max": "10000"},
+        "payment_terms": make_payment_terms(rng),
+        "actual_pt_days": make_payment_terms(rng),
+        "actual_kpi": [{"project": "Project %s" % rng.randint(0, 999),
+                        "actual_zd": str(rng.randint(0, 100)),
+                        "actual_sar": str(rng.randint(0, 100)),
+                        "actual_paru": rng.choice([str(rng.randint(0, 100)), "-1"])} for _ in range(rng.randint(0, 3))],
+        "pricing_table": [{"material_number": "MAT-%06d" % rng.randint(0, 999999),
+                           "description": "Material description %s" % rng.randint(0, 9999),
+                           "unit_price": round(rng.uniform(1, 1000), 2),
+                           "currency": rng.choice(CURRENCIES),
+                           "quantity": rng.randint(1, 500),
+                           "quantity_unit": "EA",
+                           "multiple_price_flag": rng.choice(["Y", "N"]),
+                           "page": rng.randint(1, 40)} for _ in range(rng.randint(0, 4))],
+    }
+
+
+def make_records(count, seed=0):
+    rng = random.Random(seed)
+    return [make_record(rng, idx) for idx in range(count)]
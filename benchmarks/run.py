@@ -0,0 +1,212 @@
+'''
+Microbenchmarks of the export transforms and the access control resolution.
+
+    python -m benchmarks.run --scales 1000 10000 --repeat 3 --output results.json
+    python -m benchmarks.compare baseline.json results.json
+
+Every result has the min/median wall time of `repeat` runs and the peak python memory
+(tracemalloc) of one extra run. Input records are generated outside the timed section.
+'''
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.core.cache import cache  # noqa: E402
+from django.db import connection  # noqa: E402
+from route.core.constants import EXPORT_FORMATS  # noqa: E402
+from route.core.helper import (documents_export, documents_export_result,  # noqa: E402
+                               payment_terms_export_result, price_export_result,
+                               quality_kpis_export_result, user_access_control)
+from route.core.reference import bump_reference_version, reference_index  # noqa: E402
+from uam.models import Country, Region, RegionCountry, SupplierGroup  # noqa: E402
+
+from .records import REGIONS, make_records  # noqa: E402
+
+DEFAULT_SCALES = [1000, 10000, 50000, 100000, 500000]
+
+COUNTRIES_PER_REGION = 36
+
+SESSION_SUPPLIER_GROUPS = 200
+
+
+def consume(response):
+    '''
+    Read the whole body of a (streaming) response
+    '''
+    size = 0
+    if getattr(response, "streaming", False):
+        for chunk in response:
+            size += len(chunk)
+    else:
+        size = len(response.content)
+    response.close()
+    return size
+
+
+def export_benchmark(transform):
+    def setup(scale):
+        return make_records(scale)
+
+    def run(records):
+        return transform(records)
+    return setup, run
+
+
+def documents_export_benchmark(export_format):
+    def setup(scale):
+        return SimpleNamespace(data={"data": make_records(scale)})
+
+    def run(records):
+        return consume(documents_export(records, {}, False, export_format))
+    return setup, run
+
+
+def seed_reference_data(scale):
+    '''
+    7 regions x 36 countries and `scale` supplier groups
+    '''
+    RegionCountry.objects.all().delete()
+    Region.objects.all().delete()
+    Country.objects.all().delete()
+    SupplierGroup.objects.all().delete()
+
+    regions = Region.objects.bulk_create([Region(display_name=name) for name in REGIONS])
+    countries = Country.objects.bulk_create([Country(display_name="Country %s" % idx)
+                                             for idx in range(len(REGIONS) * COUNTRIES_PER_REGION)])
+    RegionCountry.objects.bulk_create([RegionCountry(region=regions[idx // COUNTRIES_PER_REGION], country=country)
+                                       for idx, country in enumerate(countries)], batch_size=1000)
+    SupplierGroup.objects.bulk_create([SupplierGroup(supplier_group=str(9000000 + idx),
+                                                     supplier_group_name="Supplier Group %s" % idx)
+                                       for idx in range(scale)], batch_size=1000)
+    bump_reference_version()
+
+
+def make_access_request(scale):
+    step = max(1, scale // SESSION_SUPPLIER_GROUPS)
+    session = {
+        "regionCountry": [{"region": "APA", "country": "Country 0,Country 1"},
+                          {"region": "CHI", "country": "All"},
+                          {"region": "EUR", "country": "All"}],
+        "supplyGroup": ",".join(str(9000000 + idx) for idx in range(0, scale, step)),
+    }
+    return SimpleNamespace(session=session, data={})
+
+
+def access_control_benchmark(warm):
+    '''
+    cold: reference index reload + scope resolution, warm: cached scope
+    '''
+    def setup(scale):
+        if getattr(setup, "seeded", None) != scale:
+            seed_reference_data(scale)
+            setup.seeded = scale
+        request = make_access_request(scale)
+        cache.clear()
+        reference_index.version = None
+        if warm:
+            user_access_control(request)
+        return request
+
+    def run(request):
+        return user_access_control(request)
+    return setup, run
+
+
+def get_benchmarks():
+    benchmarks = [
+        ("documents_export_result", export_benchmark(documents_export_result)),
+        ("payment_terms_export_result", export_benchmark(payment_terms_export_result)),
+        ("quality_kpis_export_result", export_benchmark(quality_kpis_export_result)),
+        ("price_export_result", export_benchmark(price_export_result)),
+    ]
+    benchmarks += [("documents_export[%s]" % export_format, documents_export_benchmark(export_format))
+                   for export_format in EXPORT_FORMATS]
+    benchmarks += [("user_access_control[cold]", access_control_benchmark(warm=False)),
+                   ("user_access_control[warm]", access_control_benchmark(warm=True))]
+    return benchmarks
+
+
+def measure(setup, run, scale, repeat):
+    timings = []
+    for _ in range(repeat):
+        args = setup(scale)
+        started = time.perf_counter()
+        run(args)
+        timings.append(time.perf_counter() - started)
+        # released before the next input is built, 500000 records take a few GB
+        del args
+
+    args = setup(scale)
+    tracemalloc.start()
+    try:
+        run(args)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "min_seconds": min(timings),
+        "median_seconds": statistics.median(timings),
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=DEFAULT_SCALES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="+", default=None, help="benchmark names (prefix match)")
+    parser.add_argument("--output", default=None, help="json file, stdout when omitted")
+    args = parser.parse_args(argv)
+
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+    results = []
+    for name, (setup, run) in get_benchmarks():
+        if args.only and not any(name.startswith(prefix) for prefix in args.only):
+            continue
+        for scale in args.scales:
+            result = {"name": name, "scale": scale, **measure(setup, run, scale, args.repeat)}
+            results.append(result)
+            print("%-32s %8d %10.4fs %12d bytes" % (name, scale, result["median_seconds"],
+                                                    result["peak_memory_bytes"]), file=sys.stderr)
+
+    report = {
+        "meta": {
+            "commit": get_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
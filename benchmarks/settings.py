@@ -0,0 +1,31 @@
+'''
+Benchmark settings: the application settings with an in-memory database and local caches
+'''
+from route.settings import *  # noqa
+
+if 'uam' not in INSTALLED_APPS:
+    INSTALLED_APPS += ['uam']
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'responses',
+    },
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+}
+
+EXPORT_STREAMING = True
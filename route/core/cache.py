@@ -0,0 +1,91 @@
+"""upstream response cache (short ttl, stale while revalidate)"""
+import hashlib
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from django.conf import settings
+from django.core.cache import caches
+from prometheus_client import Counter
+
+from .versions import SharedVersion
+
+RESPONSE_CACHE_REQUESTS = Counter("response_cache_requests_total",
+                                  "Upstream response cache lookups", ["result"])
+
+
+class ResponseCache:
+    '''
+    Cache of successful upstream search responses.
+    fresh for RESPONSE_CACHE_TTL seconds, then served stale for RESPONSE_CACHE_STALE_TTL seconds
+    while a single background refresh runs. invalidate() drops every entry of every worker
+    (generation bump, the generation is a database stamp even when the entries are process local)
+    '''
+    def __init__(self):
+        self.generation = SharedVersion("response_cache")
+        self.executor = ThreadPoolExecutor(max_workers=settings.RESPONSE_CACHE_REFRESH_WORKERS,
+                                           thread_name_prefix="response-cache")
+
+    @property
+    def backend(self):
+        return caches[settings.RESPONSE_CACHE_ALIAS]
+
+    def get_generation(self):
+        return self.generation.get()
+
+    def invalidate(self):
+        return self.generation.bump()
+
+    def make_key(self, url, data, query_string, indexname=None, aggregator="AND"):
+        '''
+        Normalized body (access_region/access_country/access_supplier scope included) + query string + index
+        '''
+        normalized = json.dumps({
+            "url": url,
+            "data": data,
+            "query": sorted(parse_qsl(query_string, keep_blank_values=True)),
+            "indexname": indexname or settings.ELASTIC_SEARCH_INDEX_KEY,
+            "aggregator": aggregator,
+        }, sort_keys=True, default=str)
+        return "response_cache:%s:%s" % (self.get_generation(), hashlib.sha256(normalized.encode("utf-8")).hexdigest())
+
+    def store(self, key, status_code, content):
+        if status_code == 200:
+            self.backend.set(key, (time.time(), status_code, content),
+                             settings.RESPONSE_CACHE_TTL + settings.RESPONSE_CACHE_STALE_TTL)
+
+    def refresh(self, key, fetch):
+        try:
+            self.store(key, *fetch())
+        finally:
+            self.backend.delete("%s:refresh" % key)
+
+    def schedule_refresh(self, key, fetch):
+        if not self.backend.add("%s:refresh" % key, 1, settings.UPSTREAM_READ_TIMEOUT):
+            return
+        self.executor.submit(self.refresh, key, fetch)
+
+    def get_or_fetch(self, key, fetch):
+        '''
+        fetch() -> (status_code, content), only 200 responses are stored
+        '''
+        entry = self.backend.get(key)
+        if entry is not None:
+            stored_at, status_code, content = entry
+            age = time.time() - stored_at
+            if age < settings.RESPONSE_CACHE_TTL:
+                RESPONSE_CACHE_REQUESTS.labels(result="hit").inc()
+                return status_code, content
+            if age < settings.RESPONSE_CACHE_TTL + settings.RESPONSE_CACHE_STALE_TTL:
+                RESPONSE_CACHE_REQUESTS.labels(result="stale").inc()
+                self.schedule_refresh(key, fetch)
+                return status_code, content
+
+        RESPONSE_CACHE_REQUESTS.labels(result="miss").inc()
+        status_code, content = fetch()
+        self.store(key, status_code, content)
+        return status_code, content
+
+
+response_cache = ResponseCache()
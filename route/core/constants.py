@@ -9,6 +9,27 @@ HTTP_SUCCESS = 200
 
 NO_RECORD_FOUND = 202
 
+HTTP_SERVICE_UNAVAILABLE = 503
+
+HTTP_BAD_REQUEST = 400
+
+HTTP_RANGE_NOT_SATISFIABLE = 416
+
+UPLOAD_RETRY_ATTEMPTS = 3
+
+UPLOAD_RETRY_WAIT = 500
+
+EXPORT_FORMAT_XLSX = "xlsx"
+
+EXPORT_FORMAT_CSV = "csv"
+
+EXPORT_FORMAT_PARQUET = "parquet"
+
+EXPORT_FORMATS = [EXPORT_FORMAT_XLSX, EXPORT_FORMAT_CSV, EXPORT_FORMAT_PARQUET]
+
+PAYMENT_TERMS_EXPORT_COLUMNS = ["filename", "document_number", "document_type", "supplier_group", "supplier_legal_entity",
+                                "country", "payment_terms", "actual_pt_days"]
+
 DOCUMENT_EXPORT_SHEET_NAME = "Documents"
 
 PAYMENT_TERM_EXPORT_SHEET_NAME = "Payment Term Documents"
@@ -28,6 +49,30 @@ ADMIN_UPLOAD_COLUMNS = {
     "spe_sar_monthly_report_name": "SAR.xlsx",
 }
 
+# header row (1 based) of the uploaded reports whose type contains the key, TPD reports start with 2 title rows
+ADMIN_UPLOAD_HEADER_ROW = {
+    "tpd_monthly_report": 3,
+}
+
+ROLES_ADMIN = frozenset(["ROLE_ADMIN", "ROLE_SUPER_ADMIN", "ROLE_SUPPORT_ADMIN"])
+
+ROLES_IMPORT = ROLES_ADMIN | {"ROLE_IMPORT"}
+
+ROLES_ALL = ROLES_IMPORT | {"ROLE_READ_ONLY"}
+
+# /orch/<section>/<endpoint> -> roles of which the user needs one, None = no role check.
+# Only applied by TokenVerifyMiddleware, which is not in settings.MIDDLEWARE
+ROUTE_REQUIRED_ROLES = {
+    ("uam", "key-cloak-logout"): None,
+    ("api", "verify-document"): ROLES_IMPORT,
+    ("api", "document-upload"): ROLES_IMPORT,
+    ("api", "profile-download"): ROLES_ADMIN,
+}
+
+SECTION_REQUIRED_ROLES = {
+    "uam": ROLES_ADMIN,
+}
+
 DOCUMENT_DETAIL_URL = "http://"+str(os.environ.get("BUSINESS"))+"-"+str(os.environ.get("DOMAIN"))+"-es:5000/dkm/search"
 DOCUMENTS_LISTING_URL = "http://"+str(os.environ.get("BUSINESS"))+"-"+str(os.environ.get("DOMAIN"))+"-es:5000/dkm/v2/search"
 DOCUMENT_UPLOAD_URL = "http://"+str(os.environ.get("BUSINESS"))+"-"+str(os.environ.get("DOMAIN"))+"-de:5001/submit"
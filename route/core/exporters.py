@@ -0,0 +1,250 @@
+"""streaming export writers (xlsx, csv, parquet)"""
+import csv
+import datetime
+import io
+import math
+import tempfile
+from itertools import islice
+
+import pandas as pd
+import xlsxwriter
+from django.conf import settings
+from django.http import FileResponse, StreamingHttpResponse
+
+from .constants import EXPORT_FORMAT_CSV, EXPORT_FORMAT_PARQUET, EXPORT_FORMAT_XLSX
+from .metrics import record_export
+from .tracing import traced
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+CSV_CONTENT_TYPE = 'text/csv'
+
+PARQUET_CONTENT_TYPE = 'application/vnd.apache.parquet'
+
+# format of import_datetime once reformatted by helper.reformat_import_datetime
+EXPORT_DATETIME_FORMAT = '%d-%m-%Y %H:%M:%S'
+
+# typed parquet columns of the known export fields (integer ones by key prefix for the numbered payment term columns)
+PARQUET_TIMESTAMP_FIELDS = {'import_datetime'}
+
+PARQUET_DATE_FIELDS = {'start_date', 'end_date'}
+
+PARQUET_INTEGER_FIELDS = ('payment_term_days_', 'paryment_terms_', 'actual_pt_days_', 'price_page')
+
+# same header style pandas.ExcelWriter applies
+XLSX_HEADER_FORMAT = {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}
+
+
+def is_empty_value(value):
+    return value is None or value is pd.NaT or (isinstance(value, float) and math.isnan(value))
+
+
+def iter_export_rows(records, keys):
+    '''
+    Yield one list of cell values per record (list of dicts or DataFrame), in keys order
+    '''
+    if isinstance(records, pd.DataFrame):
+        yield from records.reindex(columns=keys).itertuples(index=False, name=None)
+        return
+    for rec in records:
+        yield [rec.get(key) for key in keys]
+
+
+def write_xlsx(output, records, new_columns, column_size, sheetname):
+    '''
+    Write records row by row with xlsxwriter constant_memory mode (rows are flushed as they are written)
+    '''
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True,
+                                            'remove_timezone': True,
+                                            'tmpdir': settings.EXPORT_TMP_DIR})
+    worksheet = workbook.add_worksheet(sheetname)
+    header_format = workbook.add_format(XLSX_HEADER_FORMAT)
+    datetime_format = workbook.add_format({'num_format': 'dd-MM-yyyy hh:mm:ssa'})
+    date_format = workbook.add_format({'num_format': 'dd-MM-yyyy'})
+
+    keys = list(new_columns.keys())
+    for idx in range(min(len(keys), len(column_size))):
+        worksheet.set_column(idx, idx, column_size[idx])
+
+    for idx, key in enumerate(keys):
+        worksheet.write_string(0, idx, new_columns[key], header_format)
+
+    row_count = 0
+    for row_count, row in enumerate(iter_export_rows(records, keys), start=1):
+        for idx, value in enumerate(row):
+            if is_empty_value(value):
+                continue
+            if isinstance(value, datetime.datetime):
+                worksheet.write_datetime(row_count, idx, value, datetime_format)
+            elif isinstance(value, datetime.date):
+                worksheet.write_datetime(row_count, idx, value, date_format)
+            elif isinstance(value, (list, dict)):
+                worksheet.write_string(row_count, idx, str(value))
+            else:
+                worksheet.write(row_count, idx, value)
+    workbook.close()
+    return row_count
+
+
+def stream_xlsx_export(records, new_columns, column_size, sheetname):
+    '''
+    Build the workbook in a temporary file and stream it, the file is removed once the response is closed
+    '''
+    output = tempfile.TemporaryFile(dir=settings.EXPORT_TMP_DIR)
+    row_count = write_xlsx(output, records, new_columns, column_size, sheetname)
+    record_export(EXPORT_FORMAT_XLSX, row_count, output.tell())
+    output.seek(0)
+
+    response = FileResponse(output, content_type=XLSX_CONTENT_TYPE)
+    response['Content-Disposition'] = 'attachment; filename=' + sheetname + '.xlsx'
+    return response
+
+
+class Echo:
+    '''
+    File like object which returns the written value, used to stream csv rows
+    '''
+    def write(self, value):
+        return value
+
+
+def iter_csv(records, new_columns):
+    keys = list(new_columns.keys())
+    writer = csv.writer(Echo())
+    yield writer.writerow([new_columns[key] for key in keys])
+    for row in iter_export_rows(records, keys):
+        yield writer.writerow(['' if is_empty_value(value) else value for value in row])
+
+
+def iter_recorded_csv(records, new_columns):
+    row_count = -1
+    size = 0
+    for row_count, line in enumerate(iter_csv(records, new_columns)):
+        size += len(line.encode('utf-8'))
+        yield line
+    record_export(EXPORT_FORMAT_CSV, row_count, size)
+
+
+def write_csv(output, records, new_columns):
+    text = io.TextIOWrapper(output, encoding='utf-8', newline='')
+    row_count = -1
+    for row_count, line in enumerate(iter_csv(records, new_columns)):
+        text.write(line)
+    text.flush()
+    text.detach()
+    return row_count
+
+
+def stream_csv_export(records, new_columns, sheetname):
+    '''
+    Stream the export as csv, one row at a time
+    '''
+    response = StreamingHttpResponse(iter_recorded_csv(records, new_columns), content_type=CSV_CONTENT_TYPE)
+    response['Content-Disposition'] = 'attachment; filename=' + sheetname + '.csv'
+    return response
+
+
+def parquet_type(records, key):
+    '''
+    Arrow type of an export column: the known date and integer fields are typed, the other columns
+    follow their DataFrame dtype (string for object columns and list of dicts records)
+    '''
+    import pyarrow as pa
+
+    if key in PARQUET_TIMESTAMP_FIELDS:
+        return pa.timestamp('us')
+    if key in PARQUET_DATE_FIELDS:
+        return pa.date32()
+    if key.startswith(PARQUET_INTEGER_FIELDS):
+        return pa.int64()
+    if isinstance(records, pd.DataFrame) and key in records:
+        dtype = records[key].dtype
+        if not isinstance(dtype, pd.api.extensions.ExtensionDtype) and dtype.kind in 'biufM':
+            return pa.from_numpy_dtype(dtype)
+    return pa.string()
+
+
+def parquet_column(values, arrow_type):
+    '''
+    Arrow array of one row group column, values which do not parse as arrow_type ('', "Not Found") are stored as null
+    '''
+    import pyarrow as pa
+
+    if pa.types.is_string(arrow_type):
+        return pa.array([None if is_empty_value(value) else str(value) for value in values], type=arrow_type)
+    values = pd.Series(values, dtype=object)
+    if pa.types.is_date(arrow_type):
+        values = pd.to_datetime(values, format='ISO8601', errors='coerce').dt.normalize()
+    elif pa.types.is_timestamp(arrow_type):
+        # import_datetime is reformatted for the xlsx/csv exports, values left as is by reformat_import_datetime are ISO
+        values = pd.to_datetime(values, format=EXPORT_DATETIME_FORMAT, errors='coerce').fillna(
+            pd.to_datetime(values, format='ISO8601', errors='coerce'))
+    elif pa.types.is_integer(arrow_type):
+        values = pd.to_numeric(values, errors='coerce')
+        values = values.where(values % 1 == 0).astype('Int64')
+    elif pa.types.is_floating(arrow_type):
+        values = pd.to_numeric(values, errors='coerce')
+    return pa.Array.from_pandas(values, type=arrow_type)
+
+
+def write_parquet(output, records, new_columns):
+    '''
+    Write records in row groups of EXPORT_PARQUET_ROW_GROUP_SIZE rows, with a schema typed by parquet_type
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    keys = list(new_columns.keys())
+    types = [parquet_type(records, key) for key in keys]
+    schema = pa.schema([(new_columns[key], arrow_type) for key, arrow_type in zip(keys, types)])
+    rows = iter_export_rows(records, keys)
+    row_count = 0
+    with pq.ParquetWriter(output, schema) as writer:
+        while True:
+            chunk = list(islice(rows, settings.EXPORT_PARQUET_ROW_GROUP_SIZE))
+            if not chunk:
+                break
+            columns = [parquet_column(column, arrow_type) for column, arrow_type in zip(zip(*chunk), types)]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+            row_count += len(chunk)
+    return row_count
+
+
+def parquet_export(records, new_columns, sheetname):
+    '''
+    Build the parquet file in a temporary file and stream it
+    '''
+    output = tempfile.TemporaryFile(dir=settings.EXPORT_TMP_DIR)
+    row_count = write_parquet(output, records, new_columns)
+    record_export(EXPORT_FORMAT_PARQUET, row_count, output.tell())
+    output.seek(0)
+
+    response = FileResponse(output, content_type=PARQUET_CONTENT_TYPE)
+    response['Content-Disposition'] = 'attachment; filename=' + sheetname + '.parquet'
+    return response
+
+
+EXPORT_CONTENT_TYPES = {
+    EXPORT_FORMAT_CSV: CSV_CONTENT_TYPE,
+    EXPORT_FORMAT_PARQUET: PARQUET_CONTENT_TYPE,
+}
+
+
+def get_export_content_type(export_format):
+    return EXPORT_CONTENT_TYPES.get(export_format, XLSX_CONTENT_TYPE)
+
+
+@traced("export")
+def write_export(output, export_format, records, new_columns, column_size, sheetname):
+    '''
+    Write the export in the requested format into a binary file object, return the row count
+    '''
+    if export_format == EXPORT_FORMAT_CSV:
+        row_count = write_csv(output, records, new_columns)
+    elif export_format == EXPORT_FORMAT_PARQUET:
+        row_count = write_parquet(output, records, new_columns)
+    else:
+        export_format = EXPORT_FORMAT_XLSX
+        row_count = write_xlsx(output, records, new_columns, column_size, sheetname)
+    record_export(export_format, row_count, output.tell())
+    return row_count
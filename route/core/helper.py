@@ -1,23 +1,40 @@
+import hashlib
 import json
+import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from io import BytesIO as IO
 
-import boto3
-from botocore.client import Config
+import openpyxl
 import pandas as pd
 import requests
+from botocore.exceptions import BotoCoreError, ClientError
 from django.conf import settings
+from django.core.cache import cache, caches
 from django.db import models
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from rest_framework.response import Response
 from retrying import retry
-from uam.models import Country, Region, RegionCountry, SupplierGroup
 
-from .constants import (DOCUMENT_DETAIL_URL, DOCUMENT_EXPORT_SHEET_NAME,
+from .cache import response_cache
+from .constants import (ADMIN_UPLOAD_HEADER_ROW, DOCUMENT_DETAIL_URL, DOCUMENT_EXPORT_SHEET_NAME,
+                        EXPORT_FORMAT_CSV, EXPORT_FORMAT_PARQUET,
+                        EXPORT_FORMAT_XLSX, EXPORT_FORMATS, HTTP_BAD_REQUEST,
+                        HTTP_RANGE_NOT_SATISFIABLE, HTTP_SERVICE_UNAVAILABLE,
                         PAYMENT_TERM_EXPORT_SHEET_NAME,
-                        QUALITY_KPIS_EXPORT_SHEET_NAME)
+                        QUALITY_KPIS_EXPORT_SHEET_NAME,
+                        UPLOAD_RETRY_ATTEMPTS, UPLOAD_RETRY_WAIT)
+from .exporters import parquet_export, stream_csv_export, stream_xlsx_export
+from .metrics import record_export
+from .reference import get_reference_version, reference_index
+from .storage import s3_storage
+from .tracing import traced
+from .upstream import async_upstream_client, upstream_client, upstream_flight
+from .versions import SharedVersion
+
+# document existence answers are cached under this stamp (bumped by every upload/removal)
+existence_version = SharedVersion("document_existence")
 
-config = Config(connect_timeout=100, read_timeout=100, retries={'max_attempts': 10})
 
 class TimestampModel(models.Model):
     created = models.DateTimeField(auto_now_add=True)
@@ -28,9 +45,44 @@ class TimestampModel(models.Model):
         abstract = True
 
 
-def request_mixin(request, url, data=None, indexname=None, aggregator="AND", headers=None):
+def request_mixin(request, url, data=None, indexname=None, aggregator="AND", headers=None, cached=False, query_string=None):
     '''
     Common request mixin for all third party call (work like a proxy server)
+    cached=True is for read only searches: they are served through the response cache and identical
+    concurrent ones share one upstream call (same url, body/access scope, query string, index)
+    query_string overrides the query string of the incoming request
+    '''
+    if query_string is None:
+        query_string = request.META['QUERY_STRING']
+    if request.method != 'POST' or not cached:
+        return upstream_request(request.method, url, query_string, data, indexname, aggregator, headers)
+
+    key = response_cache.make_key(url, data, query_string, indexname, aggregator)
+    # plain values only, a stale entry is refreshed after the request is gone
+    call = get_upstream_call(request.method, url, query_string, data, indexname, aggregator, headers)
+
+    def fetch():
+        if settings.UPSTREAM_SINGLE_FLIGHT:
+            return upstream_flight.do(key, lambda: send_upstream(*call))
+        return send_upstream(*call)
+
+    status_code, content = response_cache.get_or_fetch(key, fetch)
+    return Response(content, status=status_code)
+
+
+def without_keys(data, *keys):
+    '''
+    Copy of the request data without keys (request.data can be an immutable QueryDict)
+    '''
+    data = data.copy()
+    for key in keys:
+        data.pop(key, None)
+    return data
+
+
+def get_upstream_call(method, url, query_string='', data=None, indexname=None, aggregator="AND", headers=None):
+    '''
+    (method, url, headers, body) of an es/de services call
     '''
     if not indexname:
         indexname = settings.ELASTIC_SEARCH_INDEX_KEY
@@ -40,196 +92,352 @@ def request_mixin(request, url, data=None, indexname=None, aggregator="AND", hea
             'Content-Type': 'application/json'
         }
 
-    query_params = '?aggregator=%s&indexname=%s&%s' % (aggregator, indexname, request.META['QUERY_STRING'])
-    if request.method == 'POST':
-        response = requests.post(url=url + query_params, headers=headers, data=json.dumps(data))
-    elif request.method == 'DELETE':
-        response = requests.delete(url=url + query_params, headers=headers)
+    query_params = '?aggregator=%s&indexname=%s&%s' % (aggregator, indexname, query_string)
+    return method, url + query_params, headers, json.dumps(data) if method == 'POST' else None
+
+
+def send_upstream(method, url, headers, body=None):
+    '''
+    Call the es/de services, return (status_code, content)
+    '''
+    try:
+        if method == 'POST':
+            response = upstream_client.post(url=url, headers=headers, data=body)
+        elif method == 'DELETE':
+            response = upstream_client.delete(url=url, headers=headers)
+        else:
+            response = upstream_client.get(url=url, headers=headers)
+    except requests.exceptions.RequestException:
+        return HTTP_SERVICE_UNAVAILABLE, {"message": "Connection failed to the services"}
+
+    if response.status_code == requests.codes.ok:
+        return response.status_code, json.loads(response.content)
     else:
-        response = requests.get(url=url + query_params, headers=headers)
+        return response.status_code, {"message": "Connection failed to the services"}
+
+
+def upstream_request(method, url, query_string='', data=None, indexname=None, aggregator="AND", headers=None):
+    '''
+    Proxy call to the es/de services without an incoming request (request_mixin, background jobs)
+    '''
+    status_code, content = send_upstream(*get_upstream_call(method, url, query_string, data, indexname, aggregator, headers))
+    return Response(content, status=status_code)
+
+
+async def async_request_mixin(request, url, data=None, indexname=None, aggregator="AND", headers=None):
+    '''
+    Non blocking request_mixin for the ASGI views (returns a JsonResponse)
+    '''
+    if not indexname:
+        indexname = settings.ELASTIC_SEARCH_INDEX_KEY
+
+    if not headers:
+        headers = {
+            'Content-Type': 'application/json'
+        }
+
+    query_params = '?aggregator=%s&indexname=%s&%s' % (aggregator, indexname, request.META['QUERY_STRING'])
+    try:
+        if request.method == 'POST':
+            response = await async_upstream_client.post(url + query_params, headers=headers, content=json.dumps(data))
+        elif request.method == 'DELETE':
+            response = await async_upstream_client.delete(url + query_params, headers=headers)
+        else:
+            response = await async_upstream_client.get(url + query_params, headers=headers)
+    except requests.exceptions.RequestException:
+        return JsonResponse({"message": "Connection failed to the services"}, status=HTTP_SERVICE_UNAVAILABLE)
 
     if response.status_code == requests.codes.ok:
-        return Response(json.loads(response.content), status=response.status_code)
+        return JsonResponse(response.json(), status=response.status_code, safe=False)
     else:
-        return Response({"message": "Connection failed to the services"}, status=response.status_code)
+        return JsonResponse({"message": "Connection failed to the services"}, status=response.status_code)
 
 
 def get_s3_client():
     '''
-    Create a connect with aws s3 server/bucket
+    Shared boto3 s3 client of the storage gateway
     '''
-    connection_kwargs = {
-        "region_name": settings.S3DIRECT_REGION,
-        "aws_access_key_id": settings.S3_ACCESS_KEY,
-        "aws_secret_access_key": settings.S3_SECRET_KEY,
-        "endpoint_url": settings.S3_ENDPOINT_URL
-    }
-    return boto3.client("s3", **connection_kwargs)
+    return s3_storage.client
 
 
-@retry
+def get_source_document_key(file_name):
+    return '%s/%s/%s' % (settings.S3_BUCKET_PATH, settings.S3_BUCKET_LOCAL_PATH, file_name)
+
+
+@retry(stop_max_attempt_number=UPLOAD_RETRY_ATTEMPTS, wait_fixed=UPLOAD_RETRY_WAIT)
 def upload_image(image_obj, request_id):
     '''
     Upload image object on s3 bucket. Location /dkm/ENVIRONMENT/se/file_name
     '''
     new_file_path = "%s/%s" % (settings.S3_BUCKET_LOCAL_PATH, image_obj.name)
-    file_name="%s/%s" % (settings.S3_BUCKET_PATH, new_file_path)
-    
-    params = {
-        "ACL": "public-read",
-        'Key': file_name
-    }
-
-    connection_kwargs = {
-        "region_name": settings.S3DIRECT_REGION,
-        "aws_access_key_id": settings.S3_ACCESS_KEY,
-        "aws_secret_access_key": settings.S3_SECRET_KEY,
-        "endpoint_url": settings.S3_ENDPOINT_URL
-    }
-    s3_obj = boto3.resource("s3", **connection_kwargs)
-    s3_obj.Bucket(settings.S3_BUCKET).put_object(Body=image_obj, **params)
+    s3_storage.upload(image_obj, get_source_document_key(image_obj.name))
     return new_file_path
 
 
-@retry
+def upload_images(image_objs, request_id):
+    '''
+    Upload image objects concurrently through the storage gateway.
+    Return [(image_obj, new_file_path, error)], error is None for uploaded files
+    '''
+    return s3_storage.run_batch(lambda image_obj: upload_image(image_obj, request_id),
+                                image_objs, settings.UPLOAD_MAX_WORKERS)
+
+
+def get_admin_document_key(document_name, document_type):
+    if "supplier_reference_file" == document_type:
+        return "%s/%s" % (settings.S3_BUCKET_CUSTOMER_FILES_PATH, document_name)
+    return "%s/%s" % (settings.S3_BUCKET_DE_FILES_PATH, document_name)
+
+
+@retry(stop_max_attempt_number=UPLOAD_RETRY_ATTEMPTS, wait_fixed=UPLOAD_RETRY_WAIT)
 def upload_admin_document(document, document_name, document_type):
     '''
     Upload admin uploaded documents in dkm/customer_file/ location
     '''
-    if "supplier_reference_file" == document_type:
-        file_name="%s/%s" % (settings.S3_BUCKET_CUSTOMER_FILES_PATH, document_name)
-    else:
-        file_name="%s/%s" % (settings.S3_BUCKET_DE_FILES_PATH, document_name)
+    return s3_storage.upload(document, get_admin_document_key(document_name, document_type))
 
-    params = {
-        "ACL": "public-read",
-        'Key': file_name
-    }
 
-    connection_kwargs = {
-        "region_name": settings.S3DIRECT_REGION,
-        "aws_access_key_id": settings.S3_ACCESS_KEY,
-        "aws_secret_access_key": settings.S3_SECRET_KEY,
-        "endpoint_url": settings.S3_ENDPOINT_URL,
-        "config" : config
-    }
-    s3_obj = boto3.resource("s3", **connection_kwargs)
-    s3_obj.Bucket(settings.S3_BUCKET).put_object(Body=document, **params)
-    return file_name
+def get_admin_header_row(document_type):
+    '''
+    Header row (1 based) of an admin upload, matched on a part of the type like "tpd_monthly_report"
+    '''
+    return next((row for name, row in ADMIN_UPLOAD_HEADER_ROW.items() if name in document_type), 1)
+
+
+def scan_excel(file, header_row=1):
+    '''
+    Header cells of the first sheet and whether rows below it look duplicated, in one read only pass
+    (openpyxl, rows are hashed not kept). A hash collision only reports a false duplicate.
+    Raise BadZipFile when the file is not an xlsx
+    '''
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(min_row=header_row, values_only=True)
+        header = list(next(rows, ()))
+        seen = set()
+        for row in rows:
+            row = list(row)
+            while row and row[-1] is None:
+                row.pop()
+            row_hash = hash(tuple(row))
+            if row_hash in seen:
+                return header, True
+            seen.add(row_hash)
+        return header, False
+    finally:
+        workbook.close()
+        file.seek(0)
 
 
 def is_s3_object_exist(file_name):
     '''
     Verify if object is already uploaded on s3 bucket return True/False
     '''
-    s3_obj = get_s3_client()
-    filename = '%s/%s/%s' % (settings.S3_BUCKET_PATH, settings.S3_BUCKET_LOCAL_PATH, file_name)
-    response = s3_obj.list_objects_v2(Bucket=settings.S3_BUCKET, Prefix=filename)
-
-    for obj in response.get('Contents', []):
-        if obj['Key'] == filename:
-            return True
+    return (s3_storage.exists(get_source_document_key(file_name))
+            or s3_storage.exists(settings.S3_BUCKET_APTTUS_PDF_PATH.format(file_name)))
 
-    filename = settings.S3_BUCKET_APTTUS_PDF_PATH.format(file_name)
-    response = s3_obj.list_objects_v2(Bucket=settings.S3_BUCKET, Prefix=filename)
 
-    for obj in response.get('Contents', []):
-        if obj['Key'] == filename:
-            return True
-    return False
+def get_s3_object_keys(file_name):
+    '''
+    All s3 keys of a document (source, derived files and extracted images)
+    '''
+    keys = list(s3_storage.list_keys(settings.S3_BUCKET_EXTRACTED_IMAGES_PATH.format(file_name)))
+    keys.append(get_source_document_key(file_name))
+    keys.append(settings.S3_BUCKET_TESTING_SG_PATH.format(file_name))
+    keys.append(settings.S3_BUCKET_TXT_VERSION_PATH.format(file_name))
+    keys.append(settings.S3_BUCKET_CSV_VERSION_PATH.format(file_name))
+    keys.append(settings.S3_BUCKET_SEARCHABLE_PDF_PATH.format(file_name))
+    keys.append(settings.S3_BUCKET_OUTPUT_PATH.format(file_name))
+    keys.append(settings.S3_BUCKET_APTTUS_PDF_PATH.format(file_name))
+    keys.append(settings.S3_BUCKET_SEARCHABLE_APTTUS_PDF_PATH.format(file_name))
+    return keys
 
 
-@retry
+@retry(stop_max_attempt_number=UPLOAD_RETRY_ATTEMPTS, wait_fixed=UPLOAD_RETRY_WAIT)
 def remove_s3_object(file_name):
     '''
     Remove s3 objects and related files on s3 bucket
     '''
-    s3_obj = get_s3_client()
-    extracted_images_filename = settings.S3_BUCKET_EXTRACTED_IMAGES_PATH.format(file_name)
+    return s3_storage.delete_keys(get_s3_object_keys(file_name))
 
-    objects_to_delete = s3_obj.list_objects(Bucket=settings.S3_BUCKET, Prefix=extracted_images_filename)
-    delete_keys = [{'Key' : k} for k in [obj['Key'] for obj in objects_to_delete.get('Contents', [])]]
 
-    delete_keys.append({'Key': '%s/%s/%s' % (settings.S3_BUCKET_PATH, settings.S3_BUCKET_LOCAL_PATH, file_name)})
-    delete_keys.append({'Key': settings.S3_BUCKET_TESTING_SG_PATH.format(file_name)})
-    delete_keys.append({'Key': settings.S3_BUCKET_TXT_VERSION_PATH.format(file_name)})
-    delete_keys.append({'Key': settings.S3_BUCKET_CSV_VERSION_PATH.format(file_name)})
-    delete_keys.append({'Key': settings.S3_BUCKET_SEARCHABLE_PDF_PATH.format(file_name)})
-    delete_keys.append({'Key': settings.S3_BUCKET_OUTPUT_PATH.format(file_name)})
-    delete_keys.append({'Key': settings.S3_BUCKET_APTTUS_PDF_PATH.format(file_name)})
-    delete_keys.append({'Key': settings.S3_BUCKET_SEARCHABLE_APTTUS_PDF_PATH.format(file_name)})
+def get_byte_range(request):
+    '''
+    Single byte range of the Range header (bytes=start-end), None if absent/unsupported
+    '''
+    byte_range = request.META.get('HTTP_RANGE', '').strip()
+    if re.match(r'^bytes=(\d+-\d*|-\d+)$', byte_range):
+        return byte_range
+    return None
+
 
-    return s3_obj.delete_objects(Bucket=settings.S3_BUCKET, Delete={'Objects': delete_keys})
+def download_first_s3_object(keys, byte_range=None):
+    '''
+    First of the keys that can be downloaded, an unsatisfiable byte range raises InvalidByteRange
+    '''
+    for key in keys:
+        try:
+            return True, s3_storage.get(key, byte_range)
+        except (ClientError, BotoCoreError):
+            continue
+    return False, {}
 
 
-def download_s3_object(file_name):
+def download_s3_object(file_name, byte_range=None):
     '''
     Download s3 object (Source Document File)
     '''
-    filename = '%s/%s/%s' % (settings.S3_BUCKET_PATH, settings.S3_BUCKET_LOCAL_PATH, file_name)
-    s3_obj = get_s3_client()
-    try:
-        return True, s3_obj.get_object(Bucket=settings.S3_BUCKET, Key=filename)
-    except:
-        try:
-            return True, s3_obj.get_object(Bucket=settings.S3_BUCKET, Key=settings.S3_BUCKET_APTTUS_PDF_PATH.format(file_name))
-        except:
-            return False, {}
+    return download_first_s3_object([get_source_document_key(file_name),
+                                     settings.S3_BUCKET_APTTUS_PDF_PATH.format(file_name)], byte_range)
 
 
-def download_searchable_s3_object(file_name):
+def download_searchable_s3_object(file_name, byte_range=None):
     '''
     Download Searchable pdf file which containes images..
     '''
-    s3_obj = get_s3_client()
-    try:
-        return True, s3_obj.get_object(Bucket=settings.S3_BUCKET, Key=settings.S3_BUCKET_SEARCHABLE_PDF_PATH.format(file_name))
-    except:
-        try:
-            return True, s3_obj.get_object(Bucket=settings.S3_BUCKET, Key=settings.S3_BUCKET_APTTUS_PDF_PATH.format(file_name))
-        except:
-            return False, {}
+    return download_first_s3_object([settings.S3_BUCKET_SEARCHABLE_PDF_PATH.format(file_name),
+                                     settings.S3_BUCKET_APTTUS_PDF_PATH.format(file_name)], byte_range)
+
+
+class S3BodyIterator:
+    '''
+    Fixed size chunks of a s3 object body, closed with the response
+    '''
+    def __init__(self, body):
+        self.body = body
+
+    def __iter__(self):
+        return self.body.iter_chunks(settings.S3_STREAM_CHUNK_SIZE)
+
+    def close(self):
+        self.body.close()
+
+
+def stream_s3_object(file, filename, content_type):
+    '''
+    Stream s3 object body in fixed size chunks (206 Partial Content for ranged objects)
+    '''
+    response = StreamingHttpResponse(S3BodyIterator(file['Body']), content_type=content_type)
+    if file.get('ContentRange'):
+        response.status_code = 206
+        response['Content-Range'] = file['ContentRange']
+    if 'ContentLength' in file:
+        response['Content-Length'] = file['ContentLength']
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+    return response
+
+
+def range_not_satisfiable(size):
+    '''
+    416 answer for a byte range outside of an object of size bytes
+    '''
+    response = HttpResponse(status=HTTP_RANGE_NOT_SATISFIABLE)
+    response['Content-Range'] = 'bytes */%s' % size
+    return response
 
 
 def download_admin_files(filename, file_type):
     '''
     Download admin uploaded files
     '''
-    s3_obj = get_s3_client()
-    if "supplier_reference_file" == file_type:
-        filename="%s/%s" % (settings.S3_BUCKET_CUSTOMER_FILES_PATH, filename)
-    else:
-        filename="%s/%s" % (settings.S3_BUCKET_DE_FILES_PATH, filename)
-
     try:
-        return True, s3_obj.get_object(Bucket=settings.S3_BUCKET, Key=filename)
-    except:
+        return True, s3_storage.get(get_admin_document_key(filename, file_type))
+    except (ClientError, BotoCoreError):
         return False, {}
 
 
+def get_existence_cache():
+    return caches[settings.EXISTENCE_CACHE_ALIAS]
+
+
+def get_existence_cache_key(file):
+    return "document_exists:%s:%s" % (existence_version.get(), hashlib.sha1(file.encode("utf-8")).hexdigest())
+
+
+def invalidate_document_existence(files):
+    '''
+    Drop cached existence of uploaded/removed documents, on every worker: the entries are deleted from the
+    shared cache and the version stamp of the keys is bumped (process local entries of the other workers)
+    '''
+    get_existence_cache().delete_many([get_existence_cache_key(file) for file in files])
+    existence_version.bump()
+
+
+def query_document_details(data, size):
+    '''
+    Document details search, raise RequestException for failed or non json answers
+    '''
+    query_params = "?indexname=%s&from=0&to=%s" % (settings.ELASTIC_SEARCH_INDEX_KEY, size)
+    response = upstream_client.post(url=DOCUMENT_DETAIL_URL + query_params, data=json.dumps(data))
+    response.raise_for_status()
+    return response.json()
+
+
+def find_documents_in_elastic_db(files):
+    '''
+    One terms query on document_id for a chunk of filenames, return the filenames found.
+    Records without document_id/filename are resolved with one totalRecords count per file
+    '''
+    records = query_document_details({"document_id.keyword": files}, len(files))
+    if records["totalRecords"] == 0:
+        return set()
+
+    found = set()
+    for rec in records.get("data", []):
+        document_id = rec.get("document_id", rec.get("filename"))
+        if document_id is None:
+            return {file for file in files
+                    if query_document_details({"document_id.keyword": file}, 1)["totalRecords"] > 0}
+        found.add(document_id)
+    return found
+
+
+def are_documents_in_elastic_db(files):
+    '''
+    Verify documents are exists on elastice db or not return {filename: True/False}.
+    Answers are cached for EXISTENCE_CACHE_TTL seconds, misses are resolved with chunked concurrent queries.
+    Raise RequestException when a chunk failed, only the answered chunks are cached
+    '''
+    existence_cache = get_existence_cache()
+    cache_keys = {file: get_existence_cache_key(file) for file in files}
+    cached = existence_cache.get_many(cache_keys.values())
+    result = {file: cached[key] for file, key in cache_keys.items() if key in cached}
+
+    missing = [file for file in cache_keys if file not in result]
+    chunk_size = settings.EXISTENCE_QUERY_CHUNK_SIZE
+    chunks = [missing[start:start + chunk_size] for start in range(0, len(missing), chunk_size)]
+    if chunks:
+        fetched = {}
+        try:
+            with ThreadPoolExecutor(max_workers=min(len(chunks), settings.EXISTENCE_QUERY_MAX_WORKERS)) as executor:
+                for chunk, found in zip(chunks, executor.map(find_documents_in_elastic_db, chunks)):
+                    fetched.update((file, file in found) for file in chunk)
+        finally:
+            existence_cache.set_many({cache_keys[file]: exists for file, exists in fetched.items()},
+                                     settings.EXISTENCE_CACHE_TTL)
+        result.update(fetched)
+    return result
+
+
 def is_document_in_elastic_db(file):
     '''
     Verify document is exists on elastice db or not return True/False
     '''
-    data = {"document_id.keyword":file}
-    response = requests.post(url=DOCUMENT_DETAIL_URL + "?indexname="+settings.ELASTIC_SEARCH_INDEX_KEY, data=json.dumps(data))
-    records = json.loads(response.content)
-    return records["totalRecords"] > 0
+    return are_documents_in_elastic_db([file])[file]
 
 
 def get_all_region_country(user_region, user_country):
     '''
     Get user assigned regions/countries
     '''
-    all_region = Region.objects.all()
-    for region in all_region:
-        if region.display_name not in user_region:
-            user_region.append(region.display_name)
+    for region in reference_index.region_names():
+        if region not in user_region:
+            user_region.append(region)
 
-    all_country = Country.objects.all()
-    for country in all_country:
-        if country.display_name not in user_country:
-            user_country.append(country.display_name)
+    for country in reference_index.country_names():
+        if country not in user_country:
+            user_country.append(country)
     return user_region, user_country
 
 
@@ -237,14 +445,9 @@ def get_region_countries(region, user_country):
     '''
     Get user assigned regions/countries
     '''
-    try:
-        slt_region = Region.objects.get(display_name__iexact=region)
-        slt_countries = RegionCountry.objects.filter(region_id=slt_region.id)
-        for country in slt_countries:
-            if country.country.display_name not in user_country:
-                user_country.append(country.country.display_name.strip())
-    except (Region.DoesNotExist, RegionCountry.DoesNotExist):
-        pass
+    for country in reference_index.region_countries(region) or []:
+        if country not in user_country:
+            user_country.append(country.strip())
     return user_country
 
 
@@ -267,81 +470,152 @@ def get_user_region_country(data, user_region, user_country):
                 user_country = user_country + [c.strip() for c in data["country"].split(",") if c != " "]
     return user_country, user_region
 
-def get_user_suppliers(request):
+def get_user_suppliers(session):
     '''
     user_supplier = request.session.get("supplyGroup", "")
     access_supplier = ["*"] if 'All' in user_supplier else [string.strip() for string in user_supplier.split(',') if string != '']
     user_supplier = "9074967,9088277,9011705,9075447"
     '''
-    supplier_groups = request.session.get("supplyGroup", "")
+    supplier_groups = session.get("supplyGroup", "")
     if "All" in supplier_groups:
         return ["*"]
     else:
         suppliers = [string.strip() for string in supplier_groups.split(',') if string != '']
-        suppliers_obj = SupplierGroup.objects.filter(supplier_group__in=suppliers).values('supplier_group_name')
-        return [supplier["supplier_group_name"] for supplier in suppliers_obj]
+        return reference_index.supplier_group_names(suppliers)
 
 
-def user_access_control(request):
+def get_access_scope(session):
     ''' 
     regionCountry = [{'region': 'APA', 'country': 'Bhutan,Bangladesh'}, {'region': 'CHI', 'country': 'All'},
     {'region': 'EUR', 'country': 'Belarus,Bulgaria'}]
     user_supplier = ",NEXWAVE,GURSAS,TITAN 4,"
-    user_suppliers = get_user_suppliers(request)
+    user_suppliers = get_user_suppliers(session)
     '''
     user_country = []
     user_region = []
 
-    regionCountry = request.session.get("regionCountry", "")
+    regionCountry = session.get("regionCountry", "")
 
     for data in regionCountry:
         user_country, user_region = get_user_region_country(data, user_region, user_country)
 
-    user_suppliers = get_user_suppliers(request)
+    user_suppliers = get_user_suppliers(session)
+
+    return {
+        "access_region": user_region,
+        "access_country": user_country,
+        "access_supplier": user_suppliers
+    }
+
 
-    request.data["access_region"] = user_region
-    request.data["access_country"] = user_country
-    request.data["access_supplier"] = user_suppliers
+def get_access_scope_cache_key(session):
+    '''
+    Hash of the session claims the scope is resolved from + reference data version
+    '''
+    claims = json.dumps([session.get("regionCountry", ""), session.get("supplyGroup", "")], sort_keys=True)
+    return "access_scope:%s:%s" % (get_reference_version(), hashlib.sha256(claims.encode("utf-8")).hexdigest())
+
+
+def get_cached_access_scope(session):
+    '''
+    Resolved access scope, cached per session claims (invalidated on reference data changes)
+    '''
+    cache_key = get_access_scope_cache_key(session)
+    scope = cache.get(cache_key)
+    if scope is None:
+        scope = get_access_scope(session)
+        cache.set(cache_key, scope, settings.ACCESS_SCOPE_CACHE_TTL)
+    return scope
+
+
+@traced("access_control")
+def user_access_control(request):
+    '''
+    Add the user access scope (regions/countries/suppliers) to the request data
+    '''
+    for key, value in get_cached_access_scope(request.session).items():
+        request.data[key] = value
     return request
 
 
+DOCUMENT_NESTED_EXPORT_FIELDS = {
+    "zero_defect": {"zero_defect_target": "target",
+                    "zero_defect_liquidated_damages_min": "liquidated_damages_min",
+                    "zero_defect_liquidated_damages_max": "liquidated_damages_max"},
+    "paru": {"paru_target": "target",
+             "paru_liquidated_damages_min": "liquidated_damages_min",
+             "paru_liquidated_damages_max": "liquidated_damages_max"},
+    "seqi": {"seqi_target": "target",
+             "seqi_liquidated_damages_min": "liquidated_damages_min",
+             "seqi_liquidated_damages_max": "liquidated_damages_max"},
+    "sar": {"sar_target": "target",
+            "sar_liquidated_damages_min": "liquidated_damages_min",
+            "sar_liquidated_damages_max": "liquidated_damages_max"},
+    "stilt": {"stilt_target": "target",
+              "stilt_liquidated_damages_min": "liquidated_damages_min",
+              "stilt_liquidated_damages_max": "liquidated_damages_max"},
+    "liquidated_damages_main_percent": {"liquidated_damages_percent": "liquidated_damages_percent",
+                                        "liquidated_damages_percent_min": "liquidated_damages_percent_min",
+                                        "liquidated_damages_percent_max": "liquidated_damages_percent_max"},
+    "liquidated_damages_main_raw": {"liquidated_damages_raw": "liquidated_damages_raw",
+                                    "liquidated_damages_raw_min": "liquidated_damages_raw_min",
+                                    "liquidated_damages_raw_max": "liquidated_damages_raw_max"},
+}
+
+QUALITY_KPIS_NESTED_EXPORT_FIELDS = {key: DOCUMENT_NESTED_EXPORT_FIELDS[key]
+                                     for key in ["liquidated_damages_main_percent", "liquidated_damages_main_raw",
+                                                 "zero_defect", "paru", "sar"]}
+
+
+def flatten_nested_columns(df, nested_fields):
+    '''
+    Copy nested dict fields into flat columns, one DataFrame build per nested field
+    '''
+    for parent, children in nested_fields.items():
+        nested_df = pd.DataFrame(df[parent].tolist(), index=df.index)
+        for column, child in children.items():
+            df[column] = nested_df[child]
+    return df
+
+
+def list_item_column(series, position, key):
+    '''
+    series[position][key] for every row (NaN when the list/key is missing)
+    '''
+    if series.dtype != object:
+        return pd.Series(float("nan"), index=series.index)
+    return series.str.get(position).str.get(key)
+
+
+def not_found_column(series):
+    return series.where(series != "-1", "Not Found")
+
+
+def reformat_import_datetime(df):
+    '''
+    2021-01-31T10:20:30.123 -> 31-01-2021 10:20:30, unparsable values are kept as is
+    '''
+    if "import_datetime" in df:
+        parsed = pd.to_datetime(df["import_datetime"], format='%Y-%m-%dT%H:%M:%S.%f', errors='coerce')
+        df["import_datetime"] = parsed.dt.strftime('%d-%m-%Y %H:%M:%S').where(parsed.notna(), df["import_datetime"])
+    return df
+
+
 def documents_export_result(records):
     '''
-    Document Listing : Modify Exported data..
+    Document Listing : Modify Exported data (columnar, records are returned as a DataFrame)
     '''
-    for rec in records:
-        try:
-            rec["import_datetime"] = datetime.strptime(rec["import_datetime"], '%Y-%m-%dT%H:%M:%S.%f').strftime('%d-%m-%Y %H:%M:%S')
-        except Exception as e:
-            rec["import_datetime"] = rec["import_datetime"]
-
-        rec["zero_defect_target"] = rec["zero_defect"]["target"]
-        rec["zero_defect_liquidated_damages_min"] = rec["zero_defect"]["liquidated_damages_min"]
-        rec["zero_defect_liquidated_damages_max"] = rec["zero_defect"]["liquidated_damages_max"]
-        rec["paru_target"] = rec["paru"]["target"]
-        rec["paru_liquidated_damages_min"] = rec["paru"]["liquidated_damages_min"]
-        rec["paru_liquidated_damages_max"] = rec["paru"]["liquidated_damages_max"]
-        rec["seqi_target"] = rec["seqi"]["target"]
-        rec["seqi_liquidated_damages_min"] = rec["seqi"]["liquidated_damages_min"]
-        rec["seqi_liquidated_damages_max"] = rec["seqi"]["liquidated_damages_max"]
-        rec["sar_target"] = rec["sar"]["target"]
-        rec["sar_liquidated_damages_min"] = rec["sar"]["liquidated_damages_min"]
-        rec["sar_liquidated_damages_max"] = rec["sar"]["liquidated_damages_max"]
-        rec["stilt_target"] = rec["stilt"]["target"]
-        rec["stilt_liquidated_damages_min"] = rec["stilt"]["liquidated_damages_min"]
-        rec["stilt_liquidated_damages_max"] = rec["stilt"]["liquidated_damages_max"]
-        rec["liquidated_damages_percent"] = rec["liquidated_damages_main_percent"]["liquidated_damages_percent"]
-        rec["liquidated_damages_percent_min"] = rec["liquidated_damages_main_percent"]["liquidated_damages_percent_min"]
-        rec["liquidated_damages_percent_max"] = rec["liquidated_damages_main_percent"]["liquidated_damages_percent_max"]
-        rec["liquidated_damages_raw"] = rec["liquidated_damages_main_raw"]["liquidated_damages_raw"]
-        rec["liquidated_damages_raw_min"] = rec["liquidated_damages_main_raw"]["liquidated_damages_raw_min"]
-        rec["liquidated_damages_raw_max"] = rec["liquidated_damages_main_raw"]["liquidated_damages_raw_max"]
-        try:
-            rec["payment_term_days_1"] = "Not Found" if rec["payment_terms"][0]["payment_term_days"] == "-1" else rec["payment_terms"][0]["payment_term_days"]
-            rec["payment_term_days_2"] = "Not Found" if rec["payment_terms"][1]["payment_term_days"] == "-1" else rec["payment_terms"][1]["payment_term_days"]
-        except Exception as e:
-            rec["payment_term_days_1"] = ''
-            rec["payment_term_days_2"] = ''
+    records = pd.DataFrame(records)
+    if not records.empty:
+        reformat_import_datetime(records)
+        flatten_nested_columns(records, DOCUMENT_NESTED_EXPORT_FIELDS)
+
+        payment_terms = records["payment_terms"] if "payment_terms" in records else pd.Series(index=records.index, dtype=float)
+        payment_term_days_1 = list_item_column(payment_terms, 0, "payment_term_days")
+        payment_term_days_2 = list_item_column(payment_terms, 1, "payment_term_days")
+        found = payment_term_days_1.notna() & payment_term_days_2.notna()
+        records["payment_term_days_1"] = not_found_column(payment_term_days_1).where(found, '')
+        records["payment_term_days_2"] = not_found_column(payment_term_days_2).where(found, '')
 
     new_columns = {'filename': 'Filename',
                    'origin': 'Origin',
@@ -391,6 +665,8 @@ def documents_export_result(records):
                     20,20,20,20,20,20,20,20,20,20,
                     20,20,20,20,20,20,20,20,20,20,
                     20,20,20,20,20,20,20,20,20,20]
+    if records.empty:
+        records = records.reindex(columns=list(new_columns))
     return records, new_columns, column_size, DOCUMENT_EXPORT_SHEET_NAME
 
 
@@ -499,7 +775,7 @@ def payment_terms_export_result(records):
 
 def quality_kpis_export_result(records):
     '''
-    QualityKpi's : Modify Exported data..
+    QualityKpi's : Modify Exported data (columnar, records are returned as a DataFrame)
     '''
     new_columns = {'filename': 'Filename',
                    'document_number': 'Document Number',
@@ -531,50 +807,25 @@ def quality_kpis_export_result(records):
                     20,20,20,20,20,20,20,20,20,20,
                     20,20,20,20,20,20,20,20,20,20,20,20,20]
 
-    for key, rec in enumerate(records):
-        records[key]["liquidated_damages_percent"] = rec["liquidated_damages_main_percent"]["liquidated_damages_percent"]
-        records[key]["liquidated_damages_percent_min"] = rec["liquidated_damages_main_percent"]["liquidated_damages_percent_min"]
-        records[key]["liquidated_damages_percent_max"] = rec["liquidated_damages_main_percent"]["liquidated_damages_percent_max"]
-        records[key]["liquidated_damages_raw"] = rec["liquidated_damages_main_raw"]["liquidated_damages_raw"]
-        records[key]["liquidated_damages_raw_min"] = rec["liquidated_damages_main_raw"]["liquidated_damages_raw_min"]
-        records[key]["liquidated_damages_raw_max"] = rec["liquidated_damages_main_raw"]["liquidated_damages_raw_max"]
-        records[key]["zero_defect_target"] = rec["zero_defect"]["target"]
-        records[key]["zero_defect_liquidated_damages_min"] = rec["zero_defect"]["liquidated_damages_min"]
-        records[key]["zero_defect_liquidated_damages_max"] = rec["zero_defect"]["liquidated_damages_max"]
-        records[key]["paru_target"] = rec["paru"]["target"]
-        records[key]["paru_liquidated_damages_min"] = rec["paru"]["liquidated_damages_min"]
-        records[key]["paru_liquidated_damages_max"] = rec["paru"]["liquidated_damages_max"]
-        records[key]["sar_target"] = rec["sar"]["target"]
-        records[key]["sar_liquidated_damages_min"] = rec["sar"]["liquidated_damages_min"]
-        records[key]["sar_liquidated_damages_max"] = rec["sar"]["liquidated_damages_max"]
-        if 'actual_kpi' in rec:
-            for pt_key, pt_value in enumerate(rec["actual_kpi"]):
-                new_column_key_value = pt_key + 1
-
-                new_column_key = "{0}_{1}".format("actual_kpis_project", new_column_key_value)
-                new_column_value = "{0}_{1}".format("Project ", new_column_key_value)
-                new_columns = {**new_columns, **{new_column_key : new_column_value}}
-                column_size.append(20)
-                records[key][new_column_key] = "Not Found" if pt_value["project"]  == '-1' else pt_value["project"]
-
-                new_column_key = "{0}_{1}".format("actual_kpis_actual_zd", new_column_key_value)
-                new_column_value = "{0}_{1}".format("Actual ZD ",new_column_key_value)
-                new_columns = {**new_columns, **{new_column_key : new_column_value}}
-                column_size.append(20)
-                records[key][new_column_key] = "Not Found" if pt_value["actual_zd"]  == '-1' else pt_value["actual_zd"]
-
-                new_column_key = "{0}_{1}".format("actual_kpis_actual_sar", new_column_key_value)
-                new_column_value = "{0}_{1}".format("Actual SAR ",new_column_key_value)
-                new_columns = {**new_columns, **{new_column_key : new_column_value}}
-                column_size.append(20)
-                records[key][new_column_key] = "Not Found" if pt_value["actual_sar"]  == '-1' else pt_value["actual_sar"]
-
-                new_column_key = "{0}_{1}".format("actual_kpis_actual_paru", new_column_key_value)
-                new_column_value = "{0}_{1}".format("Actual PARU ",new_column_key_value)
-                new_columns = {**new_columns, **{new_column_key : new_column_value}}
-                column_size.append(20)
-                records[key][new_column_key] = "Not Found" if pt_value["actual_paru"]  == '-1' else pt_value["actual_paru"]
+    records = pd.DataFrame(records)
+    if not records.empty:
+        flatten_nested_columns(records, QUALITY_KPIS_NESTED_EXPORT_FIELDS)
 
+        if "actual_kpi" in records and records["actual_kpi"].dtype == object:
+            kpi_counts = records["actual_kpi"].str.len().fillna(0)
+            for pt_key in range(int(kpi_counts.max())):
+                new_column_key_value = pt_key + 1
+                for field, column_key, column_value in [("project", "actual_kpis_project", "Project "),
+                                                        ("actual_zd", "actual_kpis_actual_zd", "Actual ZD "),
+                                                        ("actual_sar", "actual_kpis_actual_sar", "Actual SAR "),
+                                                        ("actual_paru", "actual_kpis_actual_paru", "Actual PARU ")]:
+                    new_column_key = "{0}_{1}".format(column_key, new_column_key_value)
+                    new_columns[new_column_key] = "{0}_{1}".format(column_value, new_column_key_value)
+                    records[new_column_key] = not_found_column(list_item_column(records["actual_kpi"], pt_key, field))
+            column_size.extend([20] * int(kpi_counts.sum()) * 4)
+
+    if records.empty:
+        records = records.reindex(columns=list(new_columns))
     return records, new_columns, column_size, QUALITY_KPIS_EXPORT_SHEET_NAME
 
 
@@ -590,10 +841,26 @@ def get_documents_exported_data(records, requested_data, export_payment_terms):
     return records, new_columns, column_size, sheetname
 
 
-def documents_export(records, requested_data, export_payment_terms):
+@traced("export")
+def documents_export(records, requested_data, export_payment_terms, export_format=EXPORT_FORMAT_XLSX):
+    if export_format not in EXPORT_FORMATS:
+        return Response({"message": "Unsupported export format"}, status=HTTP_BAD_REQUEST)
+
     records = records.data["data"]
     records, new_columns, column_size, sheetname = get_documents_exported_data(records, requested_data, export_payment_terms)
 
+    if export_format == EXPORT_FORMAT_CSV:
+        return stream_csv_export(records, new_columns, sheetname)
+
+    if export_format == EXPORT_FORMAT_PARQUET:
+        try:
+            return parquet_export(records, new_columns, sheetname)
+        except ImportError:
+            return Response({"message": "Parquet export is not available"}, status=HTTP_BAD_REQUEST)
+
+    if settings.EXPORT_STREAMING is True:
+        return stream_xlsx_export(records, new_columns, column_size, sheetname)
+
     df = pd.DataFrame(records)
     df.rename(columns=new_columns, inplace=True)
 
@@ -609,6 +876,7 @@ def documents_export(records, requested_data, export_payment_terms):
 
     xlwriter.save()
     xlwriter.close()
+    record_export(EXPORT_FORMAT_XLSX, len(df), excel_file.tell())
     excel_file.seek(0)
 
     response = HttpResponse(excel_file.read(), content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
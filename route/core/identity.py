@@ -0,0 +1,45 @@
+"""request scoped user identity (read once from the session)"""
+import re
+
+from .constants import ROLES_ALL, ROUTE_REQUIRED_ROLES, SECTION_REQUIRED_ROLES
+
+
+class RequestIdentity:
+    '''
+    User claims of the keycloak session, read once per request. Never writes the session
+    '''
+    def __init__(self, session):
+        self.authenticated = "preferred_username" in session and "roles" in session
+        self.username = session.get("preferred_username", '')
+        roles = session.get("roles")
+        if isinstance(roles, str):
+            roles = re.findall(r"ROLE_\w+", roles)
+        self.roles = frozenset(roles or ())
+        self.groups = session.get("groups")
+
+    def has_any_role(self, roles):
+        return not self.roles.isdisjoint(roles)
+
+
+def get_identity(request):
+    '''
+    Identity of the request, built on first use
+    '''
+    identity = getattr(request, "identity", None)
+    if identity is None:
+        identity = request.identity = RequestIdentity(request.session)
+    return identity
+
+
+def get_required_roles(path):
+    '''
+    Roles allowed on the path (one of them is needed), None when the path has no role check.
+    Raise IndexError for a malformed /orch path
+    '''
+    parts = path.split('/')
+    if parts[1] != "orch":
+        return None
+    section, endpoint = parts[2], parts[3]
+    if (section, endpoint) in ROUTE_REQUIRED_ROLES:
+        return ROUTE_REQUIRED_ROLES[(section, endpoint)]
+    return SECTION_REQUIRED_ROLES.get(section, ROLES_ALL)
@@ -0,0 +1,107 @@
+"""non blocking, batched file logging (queue + background writer thread)"""
+import json
+import logging
+import os
+import queue
+import random
+import threading
+from logging.handlers import RotatingFileHandler
+
+from prometheus_client import Counter
+
+LOG_RECORDS_DROPPED = Counter("log_records_dropped_total", "Log records dropped because the log queue was full")
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    One json object per line, fields passed with extra={"data": {...}} are merged in
+    '''
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "data", None) or {})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class AsyncFileHandler(logging.Handler):
+    '''
+    Handler which only formats and enqueues records on the calling thread.
+    A background thread drains whatever is queued (up to `batch_size` records) and writes each batch
+    with a single write/flush to a size rotated file. Records below WARNING are kept with probability
+    `sample_rate`, and records are dropped (counted) instead of blocking when the queue is full.
+    '''
+    def __init__(self, filename, max_bytes=0, backup_count=0, queue_size=10000, batch_size=500,
+                 sample_rate=1.0):
+        super().__init__()
+        self.file_handler = RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+        self.file_handler.setFormatter(logging.Formatter("%(message)s"))
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.sample_rate = sample_rate
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        '''
+        Start the writer thread, again in a forked worker (threads do not survive fork)
+        '''
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(maxsize=self.queue_size)
+            self.thread = threading.Thread(target=self.run, args=(self.queue,), name="log-writer", daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def emit(self, record):
+        if record.levelno < logging.WARNING and self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(self.format(record))
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+        except Exception:
+            self.handleError(record)
+
+    def run(self, records):
+        while True:
+            batch = [records.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(records.get_nowait())
+            except queue.Empty:
+                pass
+            stop = None in batch
+            batch = [line for line in batch if line is not None]
+            if batch:
+                self.write(batch)
+            if stop:
+                return
+
+    def write(self, lines):
+        record = logging.LogRecord("", logging.INFO, "", 0, "\n".join(lines), None, None)
+        try:
+            self.file_handler.emit(record)
+        except Exception:
+            self.file_handler.handleError(record)
+
+    def close(self):
+        '''
+        Flush what is queued before the process exits
+        '''
+        if self.pid == os.getpid():
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+            self.pid = None
+        self.file_handler.close()
+        super().close()
@@ -0,0 +1,108 @@
+"""prometheus metrics of the upstream, s3, database and export work (exposed on /metrics)"""
+import json
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlsplit
+
+from botocore.exceptions import ClientError
+from prometheus_client import Counter, Histogram
+
+from .constants import (ADMIN_UPLOAD_URL, DOCUMENT_DETAIL_URL, DOCUMENT_UPLOAD_URL,
+                        DOCUMENTS_LISTING_URL)
+from .tracing import span
+
+PAYLOAD_SIZE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 104857600)
+
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+UPSTREAM_REQUEST_LATENCY = Histogram("upstream_request_latency_seconds", "Upstream (es/de) request latency",
+                                     ["upstream", "endpoint", "index", "method"])
+
+UPSTREAM_RESPONSES = Counter("upstream_responses_total", "Upstream responses by status code (error = no response)",
+                             ["upstream", "endpoint", "index", "status"])
+
+UPSTREAM_PAYLOAD_BYTES = Histogram("upstream_payload_bytes", "Upstream request/response body size",
+                                   ["upstream", "endpoint", "direction"], buckets=PAYLOAD_SIZE_BUCKETS)
+
+S3_OPERATION_LATENCY = Histogram("s3_operation_latency_seconds", "S3 operation latency", ["operation"])
+
+S3_OPERATIONS = Counter("s3_operations_total", "S3 operations by result", ["operation", "result"])
+
+VIEW_DB_QUERIES = Histogram("view_db_queries", "Database queries run per request (request thread only)", ["view"],
+                            buckets=QUERY_COUNT_BUCKETS)
+
+EXPORT_ROWS = Counter("export_rows_total", "Rows written by exports", ["format"])
+
+EXPORT_BYTES = Counter("export_bytes_total", "Bytes written by exports", ["format"])
+
+# endpoints with an id in the path are reported with the id replaced
+KNOWN_ENDPOINTS = {urlsplit(url).path for url in (ADMIN_UPLOAD_URL, DOCUMENT_DETAIL_URL,
+                                                   DOCUMENT_UPLOAD_URL, DOCUMENTS_LISTING_URL)}
+
+
+def get_upstream_labels(url, params=None):
+    '''
+    (upstream, endpoint, index) of an upstream url
+    '''
+    parts = urlsplit(url)
+    endpoint = parts.path
+    if endpoint not in KNOWN_ENDPOINTS:
+        endpoint = endpoint.rsplit('/', 1)[0] + '/{id}'
+    index = (params or {}).get("indexname") or parse_qs(parts.query).get("indexname", [""])[0]
+    return parts.netloc, endpoint, index
+
+
+def get_payload_size(body=None, json_body=None):
+    '''
+    Size of a raw request body, or of the json payload (json=) when there is no raw body
+    '''
+    if body is None:
+        return 0 if json_body is None else len(json.dumps(json_body).encode('utf-8'))
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    return 0
+
+
+@contextmanager
+def observe_upstream(method, url, params=None, body=None, json_body=None):
+    '''
+    Time an upstream call (metrics + trace span), the block sets labels["status"] / labels["response_size"]
+    '''
+    upstream, endpoint, index = get_upstream_labels(url, params)
+    labels = {"status": "error", "response_size": None}
+    started = time.perf_counter()
+    try:
+        with span("upstream", "%s %s" % (method, endpoint)):
+            yield labels
+    finally:
+        UPSTREAM_REQUEST_LATENCY.labels(upstream, endpoint, index, method).observe(time.perf_counter() - started)
+        UPSTREAM_RESPONSES.labels(upstream, endpoint, index, labels["status"]).inc()
+        UPSTREAM_PAYLOAD_BYTES.labels(upstream, endpoint, "request").observe(get_payload_size(body, json_body))
+        if labels["response_size"] is not None:
+            UPSTREAM_PAYLOAD_BYTES.labels(upstream, endpoint, "response").observe(labels["response_size"])
+
+
+@contextmanager
+def observe_s3(operation):
+    '''
+    Time an s3 call (metrics + trace span), result is "ok", the s3 error code or "error"
+    '''
+    started = time.perf_counter()
+    result = "error"
+    try:
+        with span("s3", operation):
+            yield
+        result = "ok"
+    except ClientError as e:
+        result = e.response.get('Error', {}).get('Code') or "error"
+        raise
+    finally:
+        S3_OPERATION_LATENCY.labels(operation).observe(time.perf_counter() - started)
+        S3_OPERATIONS.labels(operation, result).inc()
+
+
+def record_export(export_format, rows, size):
+    EXPORT_ROWS.labels(export_format).inc(rows)
+    EXPORT_BYTES.labels(export_format).inc(size)
@@ -1,38 +1,84 @@
-import jwt
-from django.http import HttpResponse
 import json
-import base64
-from django.conf import settings
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.db import connections
+from django.http import HttpResponse
+
+from .identity import get_identity, get_required_roles
+from .metrics import VIEW_DB_QUERIES
+
 
 class TokenVerifyMiddleware:
+    '''
+    401 unless the session is authenticated and has one of the roles of the path (get_required_roles).
+    Not registered in settings.MIDDLEWARE (as before), so these checks are not enforced:
+    views that need a role check it with get_identity(request).has_any_role(...)
+    '''
     def __init__(self,get_response):
         self.get_response = get_response
 
     def __call__(self,request):
+        if not self.is_allowed(request):
+            return HttpResponse(json.dumps({"message": 'User is not valid'}), status=401)
+        return self.get_response(request)
+
+    def is_allowed(self, request):
         try:
-            username = request.session["preferred_username"]
-            roles = request.session["roles"]
-            request.session['name'] = username
-            path = request.path.split('/')
+            identity = get_identity(request)
+            required_roles = get_required_roles(request.path)
+        except Exception as e:
+            return False
 
-            if "orch" == path[1]:
-                uam_path = path[2]
-                api_path = path[3]
+        if not identity.authenticated:
+            return False
+        return required_roles is None or identity.has_any_role(required_roles)
 
-                if uam_path == "uam" and api_path == "key-cloak-logout":
-                        return self.get_response(request)
 
-                if not ("ROLE_ADMIN" in roles or "ROLE_SUPER_ADMIN" in roles or "ROLE_SUPPORT_ADMIN" in roles or "ROLE_READ_ONLY" in roles or "ROLE_IMPORT" in roles):
-                    return HttpResponse(json.dumps({"message": 'User is not valid'}), status=401)
+class QueryCountMiddleware:
+    '''
+    Number of database queries of each request on every connection, per view (view_db_queries).
+    Queries of other threads (export jobs, background pools) are not counted. Under ASGI the wrappers are
+    installed in the request's thread sensitive worker thread, where its sync code and database queries run
+    '''
+    sync_capable = True
+    async_capable = True
 
-                if uam_path == "api" and api_path  in ["verify-document", "document-upload"]:
-                    if not ("ROLE_ADMIN" in roles or "ROLE_SUPER_ADMIN" in roles or "ROLE_SUPPORT_ADMIN" in roles or "ROLE_IMPORT" in roles):
-                        return HttpResponse(json.dumps({"message": 'User is not valid'}), status=401)
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
-                if uam_path == "uam":
-                    if not ("ROLE_ADMIN" in roles or "ROLE_SUPER_ADMIN" in roles or "ROLE_SUPPORT_ADMIN" in roles):
-                        return HttpResponse(json.dumps({"message": 'User is not valid'}), status=401)
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        queries = [0]
+        with self.count_queries(queries):
+            response = self.get_response(request)
+        self.record(request, queries[0])
+        return response
 
-        except Exception as e:
-            return HttpResponse(json.dumps({"message": 'User is not valid'}), status=401)
-        return self.get_response(request)
+    async def __acall__(self, request):
+        queries = [0]
+        # connections are per thread
+        counter = await sync_to_async(self.count_queries)(queries)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(counter.close)()
+        self.record(request, queries[0])
+        return response
+
+    def count_queries(self, queries):
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        stack = ExitStack()
+        for conn in connections.all():
+            stack.enter_context(conn.execute_wrapper(count_query))
+        return stack
+
+    def record(self, request, queries):
+        match = request.resolver_match
+        VIEW_DB_QUERIES.labels(match.view_name if match else "unresolved").observe(queries)
@@ -0,0 +1,142 @@
+"""reference data (regions, countries, supplier groups) index and version stamp"""
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from uam.models import Country, Region, RegionCountry, SupplierGroup
+
+from .versions import SharedVersion
+
+REFERENCE_DATA_MODELS = [Country, Region, RegionCountry, SupplierGroup]
+
+reference_version = SharedVersion("reference_data")
+
+
+def get_reference_version():
+    return reference_version.get()
+
+
+def bump_reference_version():
+    '''
+    Invalidate everything derived from the reference tables, in every worker
+    '''
+    return reference_version.bump()
+
+
+class ReferenceDataIndex:
+    '''
+    Process local copy of the reference tables, reloaded when the version stamp changes.
+    region_countries/regions are keyed by lower case display name,
+    supplier_groups maps a group to its [(id, name)] rows
+    '''
+    def __init__(self):
+        self.version = None
+        self.data = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        regions = list(Region.objects.values_list('id', 'display_name'))
+        region_names = {region_id: display_name for region_id, display_name in regions}
+
+        region_countries = {}
+        for region_id, country_name in RegionCountry.objects.values_list('region_id', 'country__display_name'):
+            region_countries.setdefault(region_names.get(region_id, '').lower(), []).append(country_name)
+
+        supplier_groups = {}
+        for supplier_id, supplier_group, supplier_group_name in SupplierGroup.objects.values_list(
+                'id', 'supplier_group', 'supplier_group_name').order_by('id'):
+            supplier_groups.setdefault(supplier_group, []).append((supplier_id, supplier_group_name))
+
+        return {
+            "region_names": [display_name for _, display_name in regions],
+            "country_names": list(Country.objects.values_list('display_name', flat=True)),
+            "regions": {display_name.lower(): display_name for _, display_name in regions},
+            "region_countries": region_countries,
+            "supplier_groups": supplier_groups,
+        }
+
+    def get(self):
+        version = get_reference_version()
+        if self.version != version:
+            with self.lock:
+                if self.version != version:
+                    self.data = self.load()
+                    self.version = version
+        return self.data
+
+    def region_names(self):
+        return self.get()["region_names"]
+
+    def country_names(self):
+        return self.get()["country_names"]
+
+    def region_countries(self, region):
+        '''
+        Countries of a region (case insensitive), None if the region does not exist
+        '''
+        data = self.get()
+        region = region.lower()
+        if region not in data["regions"]:
+            return None
+        return data["region_countries"].get(region, [])
+
+    def supplier_group_names(self, supplier_groups):
+        '''
+        Names of every row of the given groups in table order, a group with several rows
+        gives several names (same as filter(supplier_group__in=...))
+        '''
+        data = self.get()["supplier_groups"]
+        rows = sorted(row for supplier_group in set(supplier_groups) for row in data.get(supplier_group, []))
+        return [supplier_group_name for _, supplier_group_name in rows]
+
+
+reference_index = ReferenceDataIndex()
+
+
+def bulk_upsert_supplier_groups(supplier_groups):
+    '''
+    supplier_groups = [(supplier_group, supplier_group_name)], the last name of a group wins.
+    Diff against the current table, insert new groups / update changed names with batched statements.
+    Return {"inserted": n, "updated": n, "unchanged": n}
+    '''
+    uploaded = {str(supplier_group): str(supplier_group_name) for supplier_group, supplier_group_name in supplier_groups}
+    if not uploaded:
+        return {"inserted": 0, "updated": 0, "unchanged": 0}
+
+    existing = {}
+    for supplier in SupplierGroup.objects.only('id', 'supplier_group', 'supplier_group_name'):
+        existing.setdefault(supplier.supplier_group, []).append(supplier)
+
+    new_suppliers = []
+    changed_suppliers = []
+    unchanged = 0
+    for supplier_group, supplier_group_name in uploaded.items():
+        if supplier_group not in existing:
+            new_suppliers.append(SupplierGroup(supplier_group=supplier_group, supplier_group_name=supplier_group_name))
+            continue
+        changed = [supplier for supplier in existing[supplier_group] if supplier.supplier_group_name != supplier_group_name]
+        for supplier in changed:
+            supplier.supplier_group_name = supplier_group_name
+        if changed:
+            changed_suppliers.extend(changed)
+        else:
+            unchanged += 1
+
+    SupplierGroup.objects.bulk_create(new_suppliers, batch_size=settings.SUPPLIER_GROUP_BATCH_SIZE)
+    SupplierGroup.objects.bulk_update(changed_suppliers, ['supplier_group_name'], batch_size=settings.SUPPLIER_GROUP_BATCH_SIZE)
+
+    # bulk statements do not send post_save signals
+    if new_suppliers or changed_suppliers:
+        transaction.on_commit(bump_reference_version)
+    return {"inserted": len(new_suppliers), "updated": len(changed_suppliers), "unchanged": unchanged}
+
+
+def reference_data_changed(sender, **kwargs):
+    transaction.on_commit(bump_reference_version)
+
+
+def connect_reference_signals():
+    for model in REFERENCE_DATA_MODELS:
+        post_save.connect(reference_data_changed, sender=model, dispatch_uid="reference_data_saved_%s" % model.__name__)
+        post_delete.connect(reference_data_changed, sender=model, dispatch_uid="reference_data_deleted_%s" % model.__name__)
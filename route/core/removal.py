@@ -0,0 +1,68 @@
+"""document removal (elastic indices + s3 files)"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .constants import REMOVE_DOCUMENT_URL
+from .helper import get_s3_object_keys
+from .storage import s3_storage
+from .upstream import upstream_client
+
+S3_TARGET = "s3"
+
+
+def remove_document_from_index(filename, indexname, query_string=''):
+    '''
+    Delete one document from one elastic index, return {"status": code, "data": body}
+    '''
+    query_params = '?indexname=%s&%s' % (indexname, query_string)
+    response = upstream_client.delete(url=REMOVE_DOCUMENT_URL.format(filename.replace(" ", "")) + query_params)
+    try:
+        data = json.loads(response.content)
+    except ValueError:
+        data = {}
+    return {"status": response.status_code, "data": data}
+
+
+def remove_document_from_s3(filename):
+    '''
+    Delete source, derived files and extracted images of one document
+    '''
+    errors = []
+    for response in s3_storage.delete_keys(get_s3_object_keys(filename)):
+        errors.extend(response.get('Errors', []))
+    if errors:
+        return {"status": "failed", "errors": [error.get('Key') for error in errors]}
+    return {"status": "success"}
+
+
+def remove_documents(filenames, indices, query_string='', remove_s3=True):
+    '''
+    Remove documents from the given indices (and s3) with bounded parallelism.
+    Return {filename: {target: result}}, target is an index name or "s3"
+    result = {"status": ..., "data": ...} or {"error": message}
+    '''
+    tasks = []
+    for filename in filenames:
+        for indexname in indices:
+            tasks.append((filename, indexname))
+        if remove_s3:
+            tasks.append((filename, S3_TARGET))
+
+    def run(task):
+        filename, target = task
+        try:
+            if target == S3_TARGET:
+                return remove_document_from_s3(filename)
+            return remove_document_from_index(filename, target, query_string)
+        except Exception as e:
+            return {"error": str(e)}
+
+    results = {filename: {} for filename in filenames}
+    if not tasks:
+        return results
+    with ThreadPoolExecutor(max_workers=min(len(tasks), settings.REMOVAL_MAX_WORKERS)) as executor:
+        for (filename, target), result in zip(tasks, executor.map(run, tasks)):
+            results[filename][target] = result
+    return results
@@ -0,0 +1,165 @@
+"""shared s3 storage gateway"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO as IO
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.client import Config
+from botocore.exceptions import ClientError
+from django.conf import settings
+
+from .metrics import observe_s3
+
+S3_DELETE_BATCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def get_error_code(error):
+    return error.response.get('Error', {}).get('Code')
+
+
+class InvalidByteRange(Exception):
+    '''
+    Requested byte range starts after the end of the object (size in bytes)
+    '''
+    def __init__(self, key, size):
+        super().__init__("Range not satisfiable for %s (%s bytes)" % (key, size))
+        self.size = size
+
+
+class UnclosableFile:
+    '''
+    File object proxy ignoring close(), upload_fileobj closes the file it uploads
+    and a retried upload has to seek back to the start
+    '''
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+    def close(self):
+        pass
+
+
+class S3Storage:
+    '''
+    One lazily created, thread safe boto3 client (tuned connection pool, timeouts, retries)
+    used by every s3 helper. Batch operations run on a bounded thread pool.
+    '''
+    def __init__(self):
+        self._client = None
+        self.lock = threading.Lock()
+
+    @property
+    def bucket(self):
+        return settings.S3_BUCKET
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self.lock:
+                if self._client is None:
+                    config = Config(connect_timeout=settings.S3_CONNECT_TIMEOUT,
+                                    read_timeout=settings.S3_READ_TIMEOUT,
+                                    max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+                                    retries={'max_attempts': settings.S3_MAX_ATTEMPTS, 'mode': 'standard'})
+                    session = boto3.session.Session()
+                    self._client = session.client("s3",
+                                                  region_name=settings.S3DIRECT_REGION,
+                                                  aws_access_key_id=settings.S3_ACCESS_KEY,
+                                                  aws_secret_access_key=settings.S3_SECRET_KEY,
+                                                  endpoint_url=settings.S3_ENDPOINT_URL,
+                                                  config=config)
+        return self._client
+
+    @property
+    def transfer_config(self):
+        return TransferConfig(multipart_threshold=settings.S3_MULTIPART_THRESHOLD,
+                              multipart_chunksize=settings.S3_MULTIPART_CHUNKSIZE,
+                              max_concurrency=settings.S3_TRANSFER_MAX_CONCURRENCY)
+
+    def upload(self, fileobj, key, acl="public-read"):
+        '''
+        Upload file object (or bytes), multipart above S3_MULTIPART_THRESHOLD
+        '''
+        if isinstance(fileobj, bytes):
+            fileobj = IO(fileobj)
+        fileobj.seek(0)
+        with observe_s3("upload"):
+            self.client.upload_fileobj(UnclosableFile(fileobj), self.bucket, key, ExtraArgs={"ACL": acl}, Config=self.transfer_config)
+        return key
+
+    def get(self, key, byte_range=None):
+        '''
+        get_object response, raises InvalidByteRange when byte_range is not satisfiable
+        '''
+        kwargs = {"Bucket": self.bucket, "Key": key}
+        if byte_range:
+            kwargs["Range"] = byte_range
+        try:
+            with observe_s3("get"):
+                return self.client.get_object(**kwargs)
+        except ClientError as e:
+            if get_error_code(e) != 'InvalidRange':
+                raise
+            size = e.response['Error'].get('ActualObjectSize') or self.size(key)
+            raise InvalidByteRange(key, int(size)) from e
+
+    def size(self, key):
+        with observe_s3("head"):
+            return self.client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+
+    def exists(self, key):
+        try:
+            with observe_s3("head"):
+                self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError as e:
+            if get_error_code(e) in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def list_keys(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        pages = iter(paginator.paginate(Bucket=self.bucket, Prefix=prefix))
+        while True:
+            with observe_s3("list"):
+                page = next(pages, None)
+            if page is None:
+                return
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
+    def delete_keys(self, keys):
+        '''
+        Delete keys in batches of 1000 (s3 delete_objects limit)
+        '''
+        keys = list(keys)
+        responses = []
+        for start in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+            objects = [{'Key': key} for key in keys[start:start + S3_DELETE_BATCH_SIZE]]
+            with observe_s3("delete"):
+                responses.append(self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': objects}))
+        return responses
+
+    def run_batch(self, func, items, max_workers=None):
+        '''
+        Run func on every item concurrently, return [(item, result, error)],
+        failed items are logged and have result None
+        '''
+        def run(item):
+            try:
+                return item, func(item), None
+            except Exception as e:
+                logger.warning("s3 batch item %r failed", item, exc_info=True)
+                return item, None, str(e)
+
+        with ThreadPoolExecutor(max_workers=max_workers or settings.S3_BATCH_MAX_WORKERS) as executor:
+            return list(executor.map(run, items))
+
+
+s3_storage = S3Storage()
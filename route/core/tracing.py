@@ -0,0 +1,167 @@
+"""per request trace spans, Server-Timing header and slow request log"""
+import functools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import FileResponse
+
+slow_request_logger = logging.getLogger("app.slow_requests")
+
+current_span = ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, detail=None):
+        self.name = name
+        self.detail = detail
+        self.start = time.perf_counter()
+        self.duration = None
+        self.children = []
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+
+    def to_dict(self, origin=None):
+        origin = self.start if origin is None else origin
+        return {
+            "name": self.name,
+            "detail": self.detail,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round((self.duration or 0) * 1000, 3),
+            "children": [child.to_dict(origin) for child in self.children],
+        }
+
+
+@contextmanager
+def span(name, detail=None):
+    '''
+    Record a child span of the current one, no-op outside a traced request
+    (spans are not propagated to worker threads)
+    '''
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, detail)
+    parent.children.append(child)
+    token = current_span.set(child)
+    try:
+        yield child
+    finally:
+        child.finish()
+        current_span.reset(token)
+
+
+def traced(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_server_timing(root):
+    '''
+    Total duration and call count per span name, nested spans of the same name are counted once
+    '''
+    timings = {}
+
+    def walk(node, ancestors):
+        for child in node.children:
+            if child.name not in ancestors:
+                duration, count = timings.get(child.name, (0, 0))
+                timings[child.name] = (duration + (child.duration or 0), count + 1)
+            walk(child, ancestors | {child.name})
+
+    walk(root, frozenset())
+    metrics = ['%s;dur=%.1f;desc="%d"' % (name, duration * 1000, count) for name, (duration, count) in timings.items()]
+    metrics.append('total;dur=%.1f' % (root.duration * 1000))
+    return ", ".join(metrics)
+
+
+class TracingMiddleware:
+    '''
+    Root span of the request: adds the Server-Timing header and logs the span tree of requests
+    slower than SLOW_REQUEST_THRESHOLD_MS (app.slow_requests logger, sampled by its handler).
+    Streamed responses (other than files) get no Server-Timing, their duration includes producing the content
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not settings.TRACING_ENABLED:
+            return self.get_response(request)
+
+        root = Span("request", request.path)
+        token = current_span.set(root)
+        try:
+            response = self.get_response(request)
+        finally:
+            root.finish()
+            current_span.reset(token)
+        return self.record(request, response, root)
+
+    async def __acall__(self, request):
+        if not settings.TRACING_ENABLED:
+            return await self.get_response(request)
+
+        root = Span("request", request.path)
+        token = current_span.set(root)
+        try:
+            response = await self.get_response(request)
+        finally:
+            root.finish()
+            current_span.reset(token)
+        return self.record(request, response, root)
+
+    def record(self, request, response, root):
+        if response.streaming and not isinstance(response, FileResponse):
+            # the body is produced once the headers are sent: no Server-Timing, the request is timed
+            # until the content is exhausted (or the response closed). File responses are built before
+            # they are returned and keep the wsgi file wrapper
+            if response.is_async:
+                response.streaming_content = self.atimed_content(request, response, root, response.streaming_content)
+            else:
+                response.streaming_content = self.timed_content(request, response, root, response.streaming_content)
+            return response
+        response["Server-Timing"] = get_server_timing(root)
+        self.log_slow_request(request, response, root)
+        return response
+
+    def timed_content(self, request, response, root, content):
+        try:
+            yield from content
+        finally:
+            root.finish()
+            self.log_slow_request(request, response, root)
+
+    async def atimed_content(self, request, response, root, content):
+        try:
+            async for chunk in content:
+                yield chunk
+        finally:
+            root.finish()
+            self.log_slow_request(request, response, root)
+
+    def log_slow_request(self, request, response, root):
+        if root.duration * 1000 >= settings.SLOW_REQUEST_THRESHOLD_MS:
+            slow_request_logger.info("Slow request", extra={"data": {
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "duration_ms": round(root.duration * 1000, 3),
+                "spans": root.to_dict()["children"],
+            }})
@@ -0,0 +1,281 @@
+"""shared upstream http clients (es / de services)"""
+import asyncio
+import copy
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from django.conf import settings
+from prometheus_client import Counter
+from requests.adapters import HTTPAdapter
+
+from .metrics import observe_upstream
+
+UPSTREAM_COALESCED_REQUESTS = Counter("upstream_coalesced_requests_total",
+                                      "Upstream calls answered by an identical in-flight call")
+
+
+class UpstreamUnavailable(requests.exceptions.RequestException):
+    '''
+    Raised when an upstream cannot be reached by the async client, its circuit breaker is open
+    or its connection pool stays full for UPSTREAM_POOL_TIMEOUT seconds
+    '''
+
+
+class CircuitBreaker:
+    '''
+    Per upstream circuit breaker.
+    closed -> open after `failure_threshold` consecutive failures,
+    open -> half open after `reset_timeout` seconds (a single trial call is let through)
+    '''
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+def get_upstream(url):
+    parts = urlsplit(url)
+    return "%s://%s" % (parts.scheme, parts.netloc)
+
+
+def get_breaker(upstream):
+    '''
+    Circuit breaker of an upstream, shared by the sync and async clients
+    '''
+    with breakers_lock:
+        if upstream not in breakers:
+            breakers[upstream] = CircuitBreaker(settings.UPSTREAM_BREAKER_FAILURE_THRESHOLD,
+                                                settings.UPSTREAM_BREAKER_RESET_TIMEOUT)
+        return breakers[upstream]
+
+
+class UpstreamClient:
+    '''
+    One keep-alive connection pool and one circuit breaker per upstream host.
+    Every call is bounded by (connect, read) timeouts, and waits at most UPSTREAM_POOL_TIMEOUT
+    for one of the UPSTREAM_POOL_MAXSIZE connections (requests never bounds the pool wait itself).
+    '''
+    def __init__(self):
+        self.sessions = {}
+        self.slots = {}
+        self.lock = threading.Lock()
+
+    def get_session(self, upstream):
+        '''
+        (session, connection slots) of the upstream
+        '''
+        with self.lock:
+            if upstream not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=settings.UPSTREAM_POOL_MAXSIZE,
+                                      max_retries=0)
+                session.mount(upstream, adapter)
+                self.sessions[upstream] = session
+                self.slots[upstream] = threading.BoundedSemaphore(settings.UPSTREAM_POOL_MAXSIZE)
+            return self.sessions[upstream], self.slots[upstream]
+
+    def request(self, method, url, **kwargs):
+        '''
+        Send request through the pooled session of the upstream.
+        5xx responses and connection errors/timeouts are counted as breaker failures.
+        '''
+        upstream = get_upstream(url)
+        session, slots = self.get_session(upstream)
+        if not slots.acquire(timeout=settings.UPSTREAM_POOL_TIMEOUT):
+            raise UpstreamUnavailable("No free connection to %s" % upstream)
+        try:
+            return self.send(session, upstream, method, url, **kwargs)
+        finally:
+            slots.release()
+
+    def send(self, session, upstream, method, url, **kwargs):
+        breaker = get_breaker(upstream)
+        if not breaker.allow_request():
+            raise UpstreamUnavailable("Circuit open for %s" % upstream)
+
+        kwargs.setdefault("timeout", (settings.UPSTREAM_CONNECT_TIMEOUT, settings.UPSTREAM_READ_TIMEOUT))
+        with observe_upstream(method, url, kwargs.get("params"), kwargs.get("data"),
+                              kwargs.get("json")) as labels:
+            try:
+                response = session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException:
+                breaker.record_failure()
+                raise
+            labels["status"] = response.status_code
+            labels["response_size"] = len(response.content)
+
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+
+async def client_lifetime(client):
+    '''
+    Close the client when its event loop shuts down (asyncio.run and async_to_sync finalize the
+    async generators of the loop before closing it)
+    '''
+    try:
+        yield
+    finally:
+        await client.aclose()
+
+
+class AsyncUpstreamClient:
+    '''
+    Non blocking counterpart of UpstreamClient (httpx), used by the ASGI views.
+    Clients are bound to the running event loop, one per upstream host. The clients of a loop
+    are closed when it shuts down (short lived async_to_sync loops) and forgotten on the next call.
+    '''
+    def __init__(self):
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    async def get_client(self, upstream):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            for closed_loop in [other for other in self.clients if other.is_closed()]:
+                del self.clients[closed_loop]
+            loop_clients = self.clients.setdefault(loop, {})
+        # no other task of the loop runs before the client is stored (the lifetime starts without suspending)
+        if upstream not in loop_clients:
+            limits = httpx.Limits(max_connections=settings.ASYNC_UPSTREAM_MAX_CONNECTIONS,
+                                  max_keepalive_connections=settings.ASYNC_UPSTREAM_MAX_KEEPALIVE)
+            timeout = httpx.Timeout(settings.UPSTREAM_READ_TIMEOUT, connect=settings.UPSTREAM_CONNECT_TIMEOUT,
+                                    pool=settings.UPSTREAM_CONNECT_TIMEOUT)
+            client = httpx.AsyncClient(limits=limits, timeout=timeout)
+            lifetime = client_lifetime(client)
+            await lifetime.__anext__()
+            loop_clients[upstream] = (client, lifetime)
+        return loop_clients[upstream][0]
+
+    async def request(self, method, url, **kwargs):
+        upstream = get_upstream(url)
+        client = await self.get_client(upstream)
+        breaker = get_breaker(upstream)
+        if not breaker.allow_request():
+            raise UpstreamUnavailable("Circuit open for %s" % upstream)
+
+        with observe_upstream(method, url, kwargs.get("params"), kwargs.get("content", kwargs.get("data")),
+                              kwargs.get("json")) as labels:
+            try:
+                response = await client.request(method, url, **kwargs)
+            except httpx.HTTPError as e:
+                breaker.record_failure()
+                raise UpstreamUnavailable(str(e)) from e
+            labels["status"] = response.status_code
+            labels["response_size"] = len(response.content)
+
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request("DELETE", url, **kwargs)
+
+
+class InFlightCall:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    '''
+    Coalesce concurrent identical calls: the first caller of a key runs func, the others wait for its result.
+    When the result is shared every caller gets its own deep copy (callers may modify it).
+    '''
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = InFlightCall()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            UPSTREAM_COALESCED_REQUESTS.inc()
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        # no waiter can join once the call is removed
+        return copy.deepcopy(call.result) if call.waiters else call.result
+
+
+upstream_client = UpstreamClient()
+
+async_upstream_client = AsyncUpstreamClient()
+
+upstream_flight = SingleFlight()
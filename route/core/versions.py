@@ -0,0 +1,37 @@
+"""version stamps shared by every worker (database row, read at most once per check interval)"""
+import time
+
+from django.conf import settings
+from django.db.models import F
+
+
+class SharedVersion:
+    '''
+    Version stamp stored in the database (VersionStamp row `name`) so a bump reaches every worker.
+    The row is read at most once every SHARED_VERSION_CHECK_INTERVAL seconds per process
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.value = None
+        self.checked = 0
+
+    @property
+    def model(self):
+        from app.models import VersionStamp
+        return VersionStamp
+
+    def get(self):
+        now = time.monotonic()
+        if self.value is None or now - self.checked >= settings.SHARED_VERSION_CHECK_INTERVAL:
+            rows = self.model.objects.filter(name=self.name)
+            self.value = rows.values_list('version', flat=True).first() or 0
+            self.checked = now
+        return self.value
+
+    def bump(self):
+        rows = self.model.objects.filter(name=self.name)
+        if not rows.update(version=F('version') + 1):
+            self.model.objects.get_or_create(name=self.name)
+            rows.update(version=F('version') + 1)
+        self.value = None
+        return self.get()
@@ -35,14 +35,18 @@ LOCAL_APPS = [
 
 INSTALLED_APPS += THIRD_PARTY_APPS + LOCAL_APPS
 
+# route.core.middleware.TokenVerifyMiddleware is not registered: the route roles table is not enforced here
 MIDDLEWARE = [
+    'route.core.tracing.TracingMiddleware',
     'django_prometheus.middleware.PrometheusBeforeMiddleware',  # Mandatory
+    'route.core.middleware.QueryCountMiddleware',
     'django.middleware.security.SecurityMiddleware',  # Mandatory
     'django.contrib.sessions.middleware.SessionMiddleware',  # Mandatory
     'django.middleware.common.CommonMiddleware',  # Mandatory
     'django.contrib.auth.middleware.AuthenticationMiddleware',  # Mandatory
     'django.contrib.messages.middleware.MessageMiddleware',  # Mandatory
     'django.middleware.clickjacking.XFrameOptionsMiddleware',  # Mandatory
+    'app.profiling.ProfilingMiddleware',
     'django_prometheus.middleware.PrometheusAfterMiddleware', # Mandatory
     'corsheaders.middleware.CorsMiddleware',
 ]
@@ -59,6 +63,12 @@ SESSION_COOKIE_HTTPONLY = True
 
 SESSION_EXPIRE_AT_BROWSER_CLOSE=True
 
+# sessions are cached only in a cache shared by every worker (SESSION_CACHE_URL, redis): a per process
+# cache would keep serving logged out sessions and old roles on the other workers until the session expires
+if os.environ.get("SESSION_CACHE_URL"):
+    SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+    SESSION_CACHE_ALIAS = 'sessions'
+
 SECURE_HSTS_SECONDS=31536000
 SECURE_HSTS_INCLUDE_SUBDOMAINS=True
 SECURE_HSTS_PRELOAD=True
@@ -119,6 +129,26 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # upstream response cache, shared between pods when RESPONSE_CACHE_URL (redis) is set
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get("RESPONSE_CACHE_URL"),
+    } if os.environ.get("RESPONSE_CACHE_URL") else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'responses',
+    },
+}
+
+if os.environ.get("SESSION_CACHE_URL"):
+    CACHES['sessions'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get("SESSION_CACHE_URL"),
+    }
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -207,8 +237,122 @@ S3_BUCKET_CUSTOMER_FILES_PATH = ENV_PLAT+"/customer_files"
 S3_BUCKET_PATH =ENV_PLAT+"/contracts_dataset"
 S3_BUCKET_LOCAL_PATH = "se"
 S3_BUCKET_DE_FILES_PATH = ENV_PLAT+"/de_files"
+S3_BUCKET_EXPORTS_PATH = ENV_PLAT+"/exports/{}"
+S3_BUCKET_PROFILES_PATH = ENV_PLAT+"/profiles/{}"
 
 S3_ENDPOINT_URL = "https://xxxxxxxxxxxxxxxxxxxxxxxxxx"
 S3_ACCESS_KEY = "xxxxxxxxxxxxxxxxxxxxx"
 S3_SECRET_KEY = "xxxxxxxxxxxxxxxxxxxxx"
 S3DIRECT_REGION = "es-asia"
+
+UPSTREAM_CONNECT_TIMEOUT = 3.05
+UPSTREAM_READ_TIMEOUT = 30
+UPSTREAM_POOL_MAXSIZE = 20
+# seconds a call waits for a free pooled connection before failing with a 503
+UPSTREAM_POOL_TIMEOUT = 1
+UPSTREAM_BREAKER_FAILURE_THRESHOLD = 5
+UPSTREAM_BREAKER_RESET_TIMEOUT = 30
+ASYNC_UPSTREAM_MAX_CONNECTIONS = 500
+ASYNC_UPSTREAM_MAX_KEEPALIVE = 100
+
+S3_STREAM_CHUNK_SIZE = 65536
+
+UPLOAD_MAX_WORKERS = 8
+
+S3_CONNECT_TIMEOUT = 10
+S3_READ_TIMEOUT = 100
+S3_MAX_ATTEMPTS = 10
+S3_MAX_POOL_CONNECTIONS = 50
+S3_MULTIPART_THRESHOLD = 8388608
+S3_MULTIPART_CHUNKSIZE = 8388608
+S3_TRANSFER_MAX_CONCURRENCY = 10
+S3_BATCH_MAX_WORKERS = 8
+
+EXISTENCE_CACHE_TTL = 30
+# shared between pods with the response cache (redis when RESPONSE_CACHE_URL is set)
+EXISTENCE_CACHE_ALIAS = 'responses'
+EXISTENCE_QUERY_CHUNK_SIZE = 100
+EXISTENCE_QUERY_MAX_WORKERS = 4
+
+REMOVAL_MAX_WORKERS = 10
+
+EXPORT_STREAMING = True
+EXPORT_TMP_DIR = None
+EXPORT_PARQUET_ROW_GROUP_SIZE = 50000
+EXPORT_JOB_WORKERS = 2
+# queued/running jobs without progress for this long are failed (lost with a restarted worker)
+EXPORT_JOB_STALE_SECONDS = 3600
+
+ACCESS_SCOPE_CACHE_TTL = 3600
+
+# seconds a worker trusts its copy of a shared version stamp (reference data, response cache generation,
+# document existence), 0 reads it on every use
+SHARED_VERSION_CHECK_INTERVAL = 5
+
+SUPPLIER_GROUP_BATCH_SIZE = 1000
+
+RESPONSE_CACHE_ALIAS = 'responses'
+RESPONSE_CACHE_TTL = 30
+RESPONSE_CACHE_STALE_TTL = 60
+RESPONSE_CACHE_REFRESH_WORKERS = 4
+
+# coalesce identical concurrent searches (request_mixin cached=True, read only endpoints)
+UPSTREAM_SINGLE_FLIGHT = True
+PENDING_UPLOAD_WINDOW_MINUTES = 15
+
+REQUEST_LOG_FILE = os.environ.get("REQUEST_LOG_FILE", "/var/app_middleware_logs.log")
+REQUEST_LOG_SAMPLE_RATE = float(os.environ.get("REQUEST_LOG_SAMPLE_RATE", 1.0))
+
+# opt-in request profiling: X-Profile: <PROFILING_TOKEN> header or sampled
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "False") == "True"
+PROFILING_TOKEN = os.environ.get("PROFILING_TOKEN", "")
+PROFILING_SAMPLE_RATE = float(os.environ.get("PROFILING_SAMPLE_RATE", 0.0))
+
+TRACING_ENABLED = True
+SLOW_REQUEST_THRESHOLD_MS = 1000
+SLOW_REQUEST_LOG_FILE = os.environ.get("SLOW_REQUEST_LOG_FILE", "/var/app_slow_requests.log")
+SLOW_REQUEST_LOG_SAMPLE_RATE = float(os.environ.get("SLOW_REQUEST_LOG_SAMPLE_RATE", 1.0))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {
+            '()': 'route.core.logs.JsonFormatter',
+        },
+    },
+    'handlers': {
+        'request_log': {
+            'class': 'route.core.logs.AsyncFileHandler',
+            'formatter': 'json',
+            'filename': REQUEST_LOG_FILE,
+            'max_bytes': 50 * 1024 * 1024,
+            'backup_count': 5,
+            'queue_size': 10000,
+            'batch_size': 500,
+            'sample_rate': REQUEST_LOG_SAMPLE_RATE,
+        },
+        'slow_request_log': {
+            'class': 'route.core.logs.AsyncFileHandler',
+            'formatter': 'json',
+            'filename': SLOW_REQUEST_LOG_FILE,
+            'max_bytes': 50 * 1024 * 1024,
+            'backup_count': 5,
+            'queue_size': 1000,
+            'batch_size': 100,
+            'sample_rate': SLOW_REQUEST_LOG_SAMPLE_RATE,
+        },
+    },
+    'loggers': {
+        'app.request': {
+            'handlers': ['request_log'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'app.slow_requests': {
+            'handlers': ['slow_request_log'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
@@ -19,4 +19,5 @@ from django.conf import settings
 from app import views
 urlpatterns = [
     path('orch/api/', include('app.urls')),   # Django API's must be develop here
+    path('', include('django_prometheus.urls')),   # /metrics
 ] + static("/", document_root=settings.STATIC_ROOT)
\ No newline at end of file